@@ -1,122 +1,134 @@
 import os
 import sys
 import json
+import time
+import uuid
+import sqlite3
+import mimetypes
+from urllib.parse import urlencode
 import tempfile
 import threading
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Request, Response, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from diploma_handle import process_video, create_output_folder
+from diploma_handle import (process_job, create_output_folder, warmup_whisper,
+                             whisper_health, start_whisper_reaper, result_links,
+                             restore_cached_result, probe_media_duration, throughput_config,
+                             PRECOMPRESSED_SUFFIXES, PROFILE_MODES)
+from result_cache import ResultCache
+from job_queue import SqliteJobQueue, JobQueueFull
+from jobs import JobManager
+from video_catalog import VideoCatalog, SORT_FIELDS
+from metrics import METRICS, Registry, render
+from uploads import UploadStore, UploadError, HashingFile, partial_path, finish_partial
 
 app = Flask(__name__, static_folder='output')
-CORS(app)
+CORS(app, expose_headers=['X-Total-Count', 'Link', 'Upload-Offset'])
 
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'records')
 OUTPUT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'MOV', 'MP4', 'AVI', 'MKV'}
 
-processing_status = {
-    'is_processing': False,
-    'current_file': None,
-    'progress': 0,
-    'current_stage': '',
-    'estimated_time': 0,
-    'partial_subtitles': []
-}
-
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-print("Проверка структуры выходных файлов:")
-print(f"UPLOAD_FOLDER: {UPLOAD_FOLDER} - {'✓' if os.path.exists(UPLOAD_FOLDER) else '✗'}")
-print(f"OUTPUT_FOLDER: {OUTPUT_FOLDER} - {'✓' if os.path.exists(OUTPUT_FOLDER) else '✗'}")
+# Список обработанных видео и поиск берутся из каталога; папки результатов
+# сканируются один раз - при создании каталога или смене его версии, в фоне,
+# чтобы сервер начинал отвечать сразу (до конца индексации /api/ready отвечает 503).
+# Записи видео, чьи папки результатов удалили, убираются при каждом запуске
+catalog = VideoCatalog()
+catalog_state = {'indexing': catalog.needs_rebuild(), 'error': None}
 
-if os.path.exists(OUTPUT_FOLDER):
-    output_subfolders = [f for f in os.listdir(OUTPUT_FOLDER) if os.path.isdir(os.path.join(OUTPUT_FOLDER, f))]
-    print(f"Количество обработанных видео: {len(output_subfolders)}")
-    
-    for folder in output_subfolders:
-        folder_path = os.path.join(OUTPUT_FOLDER, folder)
-        video_file = os.path.join(folder_path, f"{folder}.mp4")
-        json_file = os.path.join(folder_path, f"{folder}_chunked.json")
-        
-        print(f"Проверка файлов для {folder}:")
-        print(f"  Видео: {os.path.exists(video_file)}")
-        print(f"  Субтитры: {os.path.exists(json_file)}")
+def rebuild_catalog(full):
+    try:
+        removed = catalog.prune(OUTPUT_FOLDER)
+        if removed:
+            print(f"Из каталога удалены видео без папок результатов: {removed}")
+        if full:
+            print(f"Каталог видео обновлён, проиндексировано результатов: {catalog.rebuild(OUTPUT_FOLDER)}")
+    except Exception as e:
+        catalog_state['error'] = str(e)
+        print(f"Ошибка индексации каталога видео: {e}")
+    finally:
+        catalog_state['indexing'] = False
+
+threading.Thread(target=rebuild_catalog, args=(catalog_state['indexing'],), name='catalog-rebuild', daemon=True).start()
+
+# Размер страницы /api/videos по умолчанию и наибольший допустимый
+VIDEOS_PER_PAGE = 50
+VIDEOS_MAX_PER_PAGE = 500
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in {ext.lower() for ext in ALLOWED_EXTENSIONS}
 
-def process_video_async(filepath, filename):
-    """Асинхронная обработка видео в отдельном потоке"""
-    global processing_status
+class UploadRequest(Request):
+    """Файл из multipart-формы /api/upload пишется сразу в UPLOAD_FOLDER (как .part)
+    и хэшируется по ходу разбора, без временного файла werkzeug"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.path == '/api/upload' and filename and allowed_file(filename):
+            target = os.path.join(UPLOAD_FOLDER, f'{secure_filename(filename)}.{uuid.uuid4().hex[:8]}')
+            return HashingFile(partial_path(target))
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = UploadRequest
+
+def save_upload(file, filepath, block_size=1 << 20):
+    """Ставит загруженный файл на место filepath и возвращает его sha256
+
+    Обычно файл уже записан UploadRequest - остаётся переименовать .part.
+    Файл заменяется, а не перезаписывается: ссылки на прежнюю загрузку
+    с тем же именем в папках результатов остаются целыми.
+    """
+    if isinstance(file.stream, HashingFile):
+        file.stream.close()
+        finish_partial(file.stream.path, filepath)
+        return file.stream.hexdigest()
     
+    out = HashingFile(partial_path(filepath))
     try:
-        if not os.path.exists(filepath):
-            print(f"ОШИБКА: Исходный файл не найден: {filepath}")
-            processing_status['is_processing'] = False
-            processing_status['current_stage'] = 'Ошибка: файл не найден'
-            processing_status['progress'] = 0
-            return
-        
-        print(f"Начало обработки файла: {filepath}")
-        print(f"Размер файла: {os.path.getsize(filepath) / (1024 * 1024):.2f} MB")
-        
-        base_name = os.path.splitext(filename)[0]
-        expected_output_dir = os.path.join(OUTPUT_FOLDER, base_name)
-        expected_video = os.path.join(expected_output_dir, f"{base_name}.mp4")
-        expected_json = os.path.join(expected_output_dir, f"{base_name}_chunked.json")
-        
-        print(f"Ожидаемый выходной каталог: {expected_output_dir}")
-        print(f"Ожидаемое видео: {expected_video}")
-        print(f"Ожидаемые субтитры: {expected_json}")
-        
-        if process_video(filepath, processing_status):
-            base_name = os.path.splitext(filename)[0]
-            
-            output_dir = os.path.join(OUTPUT_FOLDER, base_name)
-            output_video = os.path.join(output_dir, f"{base_name}.mp4")
-            output_json = os.path.join(output_dir, f"{base_name}_chunked.json")
-            
-            print(f"Проверка созданных файлов:")
-            print(f"Выходной каталог: {output_dir} - {'✓' if os.path.exists(output_dir) else '✗'}")
-            print(f"Видео: {output_video} - {'✓' if os.path.exists(output_video) else '✗'}")
-            print(f"Субтитры: {output_json} - {'✓' if os.path.exists(output_json) else '✗'}")
-            
-            processing_status = {
-                'is_processing': False,
-                'current_file': filename,
-                'progress': 100,
-                'current_stage': 'Обработка завершена',
-                'estimated_time': 0,
-                'partial_subtitles': [],
-                'video': f'/api/files/{base_name}/{base_name}.mp4',
-                'subtitles': f'/api/files/{base_name}/{base_name}_chunked.json'
-            }
-            print(f"Обработка завершена успешно. Файлы доступны по путям:")
-            print(f"Видео: {processing_status['video']}")
-            print(f"Субтитры: {processing_status['subtitles']}")
-        else:
-            processing_status['is_processing'] = False
-            processing_status['current_stage'] = 'Обработка не удалась'
-            processing_status['progress'] = 0
-            print("Обработка видео не удалась.")
-    except Exception as e:
-        processing_status['is_processing'] = False
-        processing_status['current_stage'] = f'Ошибка: {str(e)}'
-        processing_status['progress'] = 0
-        print(f"Обработка видео завершилась с ошибкой: {e}")
-        import traceback
-        traceback.print_exc()
+        while True:
+            block = file.stream.read(block_size)
+            if not block:
+                break
+            out.write(block)
+    finally:
+        out.close()
+    finish_partial(out.path, filepath)
+    return out.hexdigest()
+
+# Для каких файлов ищутся сжатые копии (их пишет save_output_files)
+PRECOMPRESSED_TYPES = ('.json',)
+
+# Как часто поток SSE проверяет задание и как часто шлёт keepalive при отсутствии событий
+SSE_POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', 0.5))
+SSE_KEEPALIVE_SECONDS = 15
+
+# queue - задания пишутся в SQLite и выполняются отдельными процессами
+#         (python -m diploma_handle worker); thread - пул потоков внутри Flask
+JOB_BACKEND = os.environ.get('JOB_BACKEND', 'queue')
+
+def warmup_model_async():
+    """Загружаем и прогреваем модель в фоне, чтобы первое задание не ждало загрузки"""
+    threading.Thread(target=warmup_whisper, name='whisper-warmup', daemon=True).start()
+
+if JOB_BACKEND == 'thread':
+    jobs = JobManager(process_job, config=throughput_config())
+    print(f"Пул обработки: {jobs.workers} рабочих потоков, очередь до {jobs.max_queued} заданий")
+    if os.environ.get('WHISPER_WARMUP', '1') != '0':
+        warmup_model_async()
+    start_whisper_reaper()
+else:
+    jobs = SqliteJobQueue(config=throughput_config())
+    print(f"Очередь заданий: {jobs.path} (до {jobs.max_queued} ожидающих заданий)")
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
-    global processing_status
-    
     if 'file' not in request.files:
         return jsonify({'error': 'Нет файла в запросе'}), 400
     
@@ -125,104 +137,415 @@ def upload_file():
         return jsonify({'error': 'Нет выбранного файла'}), 400
     
     if file and allowed_file(file.filename):
+        if jobs.stats()['queued'] >= jobs.max_queued:
+            if isinstance(file.stream, HashingFile):
+                file.stream.close()
+                os.remove(file.stream.path)
+            return jsonify({'error': 'Сервер перегружен, повторите попытку позже'}), 429, {'Retry-After': '60'}
+        
         filename = secure_filename(file.filename)
         filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
-        
-        processing_status = {
-            'is_processing': True,
-            'current_file': filename,
-            'progress': 0,
-            'current_stage': 'Инициализация обработки видео',
-            'estimated_time': 0,
-            'partial_subtitles': []
-        }
-        
-        base_name = os.path.splitext(filename)[0]
-        
-        try:
-            processing_thread = threading.Thread(
-                target=process_video_async,
-                args=(filepath, filename)
-            )
-            processing_thread.daemon = True
-            processing_thread.start()
-            
-            response = {
-                'status': 'processing',
-                'message': 'Обработка видео запущена',
-                'filename': filename,
-                'progress_url': '/api/progress'
-            }
-            return jsonify(response), 202
-            
-        except Exception as e:
-            processing_status['is_processing'] = False
-            return jsonify({'error': f'Произошла ошибка при запуске обработки: {str(e)}'}), 500
+        content_hash = save_upload(file, filepath)
+        return start_processing(filepath, filename, content_hash)
     
     return jsonify({'error': 'Недопустимый тип файла'}), 400
 
+def start_processing(filepath, filename, content_hash):
+    """Ответ на завершённую загрузку: готовый результат из кэша или новое задание"""
+    # Тот же файл уже обрабатывался с теми же параметрами - отдаём готовый результат
+    if restore_cached_result(filepath, content_hash):
+        return jsonify({
+            'status': 'success',
+            'message': 'Результат найден в кэше',
+            'filename': filename,
+            'cached': True,
+            **result_links(filename)
+        }), 200
+    
+    try:
+        # ?profile=cprofile|torch - снять профиль этого задания (см. profile_job)
+        profile = request.args.get('profile')
+        extra = {'profile': profile} if profile in PROFILE_MODES else {}
+        # Длительность из заголовка - по ней планировщик ставит короткие записи вперёд длинных
+        job = jobs.submit(filepath, filename, content_hash=content_hash,
+                          media_duration=probe_media_duration(filepath), **extra)
+    except JobQueueFull as e:
+        return jsonify({'error': f'Сервер перегружен, повторите попытку позже ({e})'}), 429, {'Retry-After': '60'}
+    except Exception as e:
+        return jsonify({'error': f'Произошла ошибка при запуске обработки: {str(e)}'}), 500
+    
+    response = {
+        'status': 'processing',
+        'message': 'Обработка видео запущена',
+        'filename': filename,
+        'job_id': job['id'],
+        'progress_url': f"/api/jobs/{job['id']}"
+    }
+    return jsonify(response), 202
+
+# Возобновляемая загрузка частями:
+#   POST /api/uploads {filename, size}       -> upload_id, offset
+#   PUT  /api/uploads/<id> (Upload-Offset: N) -> тело запроса дописывается с позиции N
+#   GET  /api/uploads/<id>                    -> текущее смещение, чтобы продолжить после обрыва
+#   POST /api/uploads/<id>/complete           -> как ответ /api/upload
+uploads = UploadStore(UPLOAD_FOLDER)
+
+def upload_error(e):
+    body = {'error': str(e)}
+    headers = {}
+    if e.offset is not None:
+        body['offset'] = e.offset
+        headers['Upload-Offset'] = str(e.offset)
+    return jsonify(body), e.status, headers
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename') or ''))
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'Недопустимый тип файла'}), 400
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        size = -1
+    if size < 0:
+        return jsonify({'error': 'Не указан размер файла'}), 400
+    if jobs.stats()['queued'] >= jobs.max_queued:
+        return jsonify({'error': 'Сервер перегружен, повторите попытку позже'}), 429, {'Retry-After': '60'}
+    
+    state = uploads.create(filename, size)
+    state['upload_url'] = f"/api/uploads/{state['upload_id']}"
+    return jsonify(state), 201, {'Location': state['upload_url'], 'Upload-Offset': '0'}
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    state = uploads.status(upload_id)
+    if state is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    return jsonify(state), 200, {'Upload-Offset': str(state['offset'])}
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+def upload_chunk(upload_id):
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', '')))
+    except ValueError:
+        return jsonify({'error': 'Не указан заголовок Upload-Offset'}), 400
+    try:
+        state = uploads.append(upload_id, offset, request.stream, request.content_length)
+    except UploadError as e:
+        return upload_error(e)
+    return jsonify(state), 200, {'Upload-Offset': str(state['offset'])}
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    # Пока очередь полна, сессия остаётся - complete можно повторить позже
+    if jobs.stats()['queued'] >= jobs.max_queued:
+        return jsonify({'error': 'Сервер перегружен, повторите попытку позже'}), 429, {'Retry-After': '60'}
+    try:
+        sha256 = (request.get_json(silent=True) or {}).get('sha256')
+        filepath, filename, content_hash = uploads.complete(upload_id, sha256 and str(sha256))
+    except UploadError as e:
+        return upload_error(e)
+    return start_processing(filepath, filename, content_hash)
+
 @app.route('/api/files/<folder>/<filename>', methods=['GET'])
 def get_file(folder, filename):
-    folder_path = os.path.join(OUTPUT_FOLDER, folder)
-    file_path = os.path.join(folder_path, filename)
+    file_path = safe_join(OUTPUT_FOLDER, folder, filename)
+    if file_path is None or not os.path.isfile(file_path):
+        return jsonify({'error': 'Файл не найден'}), 404
     
-    print(f"Запрос файла: {file_path}")
-    if os.path.exists(file_path):
-        print(f"Файл найден: {file_path}")
-    else:
-        print(f"ОШИБКА: Файл не найден: {file_path}")
-        print(f"Содержимое папки {folder_path}:")
-        if os.path.exists(folder_path):
-            for f in os.listdir(folder_path):
-                print(f"- {f}")
-        else:
-            print(f"Папка {folder_path} не существует")
+    # Готовая сжатая копия, если клиент её принимает и она не старше оригинала
+    served, encoding = file_path, None
+    compressible = file_path.endswith(PRECOMPRESSED_TYPES)
+    if compressible:
+        source_mtime = os.stat(file_path).st_mtime_ns
+        for candidate, suffix in PRECOMPRESSED_SUFFIXES.items():
+            if request.accept_encodings[candidate] <= 0:
+                continue
+            try:
+                if os.stat(file_path + suffix).st_mtime_ns >= source_mtime:
+                    served, encoding = file_path + suffix, candidate
+                    break
+            except OSError:
+                continue
+    
+    stat = os.stat(served)
     
-    return send_from_directory(folder_path, filename)
+    response = send_file(
+        served,
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        conditional=True,
+        etag=f'{stat.st_size:x}-{stat.st_mtime_ns:x}' + (f'-{encoding}' if encoding else ''),
+        last_modified=stat.st_mtime
+    )
+    # Папка результата переиспользуется при повторной загрузке файла с тем же именем,
+    # поэтому кэш всегда перепроверяет файл по ETag (неизменный файл - ответ 304 без тела)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if compressible:
+        response.vary.add('Accept-Encoding')
+    return response
 
 @app.route('/api/videos', methods=['GET'])
 def list_videos():
-    processed_videos = []
-    
-    for folder in os.listdir(OUTPUT_FOLDER):
-        folder_path = os.path.join(OUTPUT_FOLDER, folder)
-        if os.path.isdir(folder_path):
-            mp4_file = os.path.join(folder_path, f"{folder}.mp4")
-            json_file = os.path.join(folder_path, f"{folder}_chunked.json")
-            
-            print(f"Проверка файлов в папке {folder}:")
-            print(f"- Видео: {mp4_file} - {'✓' if os.path.exists(mp4_file) else '✗'}")
-            print(f"- Субтитры: {json_file} - {'✓' if os.path.exists(json_file) else '✗'}")
-            
-            if os.path.exists(mp4_file) and os.path.exists(json_file):
-                processed_videos.append({
-                    'name': folder,
-                    'video': f'/api/files/{folder}/{folder}.mp4',
-                    'subtitles': f'/api/files/{folder}/{folder}_chunked.json'
-                })
-    
-    return jsonify(processed_videos), 200
+    """Страница каталога: ?page=1&per_page=50&sort=created_at&order=desc
 
-@app.route('/api/progress', methods=['GET'])
-def check_progress():
-    global processing_status
+    Всего записей - в X-Total-Count, соседние страницы - в заголовке Link.
+    """
+    try:
+        page = int(request.args.get('page', 1))
+        per_page = int(request.args.get('per_page', VIDEOS_PER_PAGE))
+    except ValueError:
+        return jsonify({'error': 'page и per_page должны быть целыми числами'}), 400
+    sort = request.args.get('sort', 'created_at')
+    order = request.args.get('order', 'desc')
+    if page < 1 or not 1 <= per_page <= VIDEOS_MAX_PER_PAGE:
+        return jsonify({'error': f'page >= 1, per_page от 1 до {VIDEOS_MAX_PER_PAGE}'}), 400
+    if sort not in SORT_FIELDS or order not in ('asc', 'desc'):
+        return jsonify({'error': f"sort: {', '.join(SORT_FIELDS)}; order: asc или desc"}), 400
     
-    if (not processing_status['is_processing'] and 
-        processing_status['progress'] == 100 and
-        processing_status['current_file']):
-        
-        base_name = os.path.splitext(processing_status['current_file'])[0]
-        processed_response = {
+    videos, total = catalog.list(per_page, (page - 1) * per_page, sort, order == 'desc')
+    last_page = max(1, -(-total // per_page))
+    
+    def page_url(number):
+        return f'{request.base_url}?' + urlencode({'page': number, 'per_page': per_page, 'sort': sort, 'order': order})
+    
+    links = [f'<{page_url(1)}>; rel="first"', f'<{page_url(last_page)}>; rel="last"']
+    if page > 1:
+        links.append(f'<{page_url(min(page - 1, last_page))}>; rel="prev"')
+    if page < last_page:
+        links.append(f'<{page_url(page + 1)}>; rel="next"')
+    
+    headers = {'X-Total-Count': str(total), 'Link': ', '.join(links)}
+    return jsonify(videos), 200, headers
+
+# Наибольшее число результатов на одну страницу /api/search
+SEARCH_MAX_LIMIT = 100
+
+@app.route('/api/search', methods=['GET'])
+def search_transcripts():
+    """Поиск фразы по всем транскрипциям: ?q=...&limit=20&offset=0[&video=имя]
+
+    Слова ищутся в пределах одного сегмента, последнее - как префикс;
+    запрос в кавычках ищется как точная фраза. Для слишком частых запросов
+    ranked = false: сначала идут новые сегменты, total - нижняя граница.
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Не указан запрос q'}), 400
+    try:
+        limit = int(request.args.get('limit', 20))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'error': 'limit и offset должны быть целыми числами'}), 400
+    if not 1 <= limit <= SEARCH_MAX_LIMIT or offset < 0:
+        return jsonify({'error': f'limit от 1 до {SEARCH_MAX_LIMIT}, offset >= 0'}), 400
+    
+    started = time.perf_counter()
+    try:
+        results, total, ranked = catalog.search(query, limit, offset, request.args.get('video') or None)
+    except sqlite3.OperationalError as e:
+        return jsonify({'error': f'Некорректный запрос: {e}'}), 400
+    return jsonify({
+        'query': query,
+        'total': total,
+        'ranked': ranked,
+        'results': results,
+        'took_ms': round((time.perf_counter() - started) * 1000, 2)
+    }), 200, {'X-Total-Count': str(total)}
+
+def job_response(job):
+    """Формат ответа о задании, совместимый с прежним /api/progress"""
+    if job['state'] == 'done':
+        return {
+            'id': job['id'],
+            'state': job['state'],
             'is_processing': False,
+            'current_file': job['current_file'],
             'progress': 100,
             'current_stage': 'Обработка завершена',
-            'video': f'/api/files/{base_name}/{base_name}.mp4',
-            'subtitles': f'/api/files/{base_name}/{base_name}_chunked.json'
+            'estimated_time': 0,
+            'video': job.get('video'),
+            'subtitles': job.get('subtitles'),
+            'last_subtitle_id': job.get('last_subtitle_id'),
+            'profile_file': job.get('profile_file')
         }
-        return jsonify(processed_response), 200
+    job.pop('filepath', None)
+    return job
+
+def parse_since_id(value):
+    """Курсор субтитров: None без значения, иначе id чанка не меньше -1 (ValueError для остального)"""
+    if value is None or value == '':
+        return None
+    since_id = int(value)
+    if since_id < -1:
+        raise ValueError(f'since_id меньше -1: {since_id}')
+    return since_id
+
+def since_id_arg():
+    """Курсор ?since_id=N: в ответ попадают только чанки субтитров с id больше N"""
+    return parse_since_id(request.args.get('since_id'))
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        since_id = since_id_arg()
+    except ValueError:
+        return jsonify({'error': 'since_id должен быть целым числом не меньше -1'}), 400
+    job = jobs.get(job_id, since_id)
+    if job is None:
+        return jsonify({'error': 'Задание не найдено'}), 404
+    return jsonify(job_response(job)), 200
+
+def sse_event(event, data, event_id=None):
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return '\n'.join(lines) + '\n\n'
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events: 'status' при смене этапа/прогресса, 'subtitles' - только новые чанки,
+    'end' - финальный статус. Переподключение продолжает с Last-Event-ID (id последнего чанка)."""
+    try:
+        cursor = parse_since_id(request.headers.get('Last-Event-ID') or request.args.get('since_id'))
+    except ValueError:
+        return jsonify({'error': 'since_id должен быть целым числом не меньше -1'}), 400
+    if jobs.get(job_id, cursor) is None:
+        return jsonify({'error': 'Задание не найдено'}), 404
+    
+    def stream(cursor):
+        last_status = None
+        last_sent = time.time()
+        while True:
+            job = jobs.get(job_id, cursor)
+            if job is None:
+                yield sse_event('error', {'error': 'Задание не найдено'})
+                return
+            subtitles = job.pop('partial_subtitles', None) or []
+            if subtitles:
+                cursor = subtitles[-1]['id']
+                yield sse_event('subtitles', subtitles, cursor)
+                last_sent = time.time()
+            status = job_response(job)
+            if job['state'] in ('done', 'failed'):
+                yield sse_event('end', status, cursor)
+                return
+            if status != last_status:
+                yield sse_event('status', status, cursor)
+                last_status = status
+                last_sent = time.time()
+            elif time.time() - last_sent >= SSE_KEEPALIVE_SECONDS:
+                yield ': keepalive\n\n'
+                last_sent = time.time()
+            time.sleep(SSE_POLL_INTERVAL)
+    
+    return Response(stream_with_context(stream(cursor)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'stats': jobs.stats(), 'jobs': jobs.list_jobs()}), 200
+
+@app.route('/api/progress', methods=['GET'])
+def check_progress():
+    """Статус последнего загруженного задания (для клиентов без job_id), поддерживает ?since_id"""
+    try:
+        job = jobs.latest(since_id_arg())
+    except ValueError:
+        return jsonify({'error': 'since_id должен быть целым числом не меньше -1'}), 400
+    if job is None:
+        return jsonify({
+            'is_processing': False,
+            'current_file': None,
+            'progress': 0,
+            'current_stage': '',
+            'estimated_time': 0,
+            'partial_subtitles': []
+        }), 200
+    return jsonify(job_response(job)), 200
+
+@app.route('/api/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(ResultCache().stats()), 200
+
+@app.route('/api/cache', methods=['DELETE'])
+def invalidate_cache():
+    """Сброс кэша результатов (например, после смены модели): ?model=<имя> или целиком"""
+    removed = ResultCache().invalidate(request.args.get('model'))
+    return jsonify({'removed': removed}), 200
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    response = {'status': 'ok', 'job_backend': JOB_BACKEND, 'jobs': jobs.stats(),
+                'real_time_factors': jobs.real_time_factors.table()}
+    if JOB_BACKEND == 'thread':
+        response['model'] = whisper_health()
+    return jsonify(response), 200
+
+def writable_dir(path):
+    return os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK)
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    """Готовность принимать задания (для проб и start.sh); /api/health - только признак жизни
+
+    503, пока не доступна очередь, папки загрузок и результатов недоступны
+    для записи или каталог ещё индексируется после запуска.
+    """
+    checks = {
+        'uploads': writable_dir(UPLOAD_FOLDER),
+        'output': writable_dir(OUTPUT_FOLDER),
+        'catalog': not catalog_state['indexing'] and catalog_state['error'] is None
+    }
+    response = {'job_backend': JOB_BACKEND}
+    try:
+        stats = jobs.stats()
+        checks['jobs'] = True
+        response['jobs'] = stats
+    except sqlite3.Error as e:
+        checks['jobs'] = False
+        response['error'] = str(e)
+    if catalog_state['error']:
+        response['catalog_error'] = catalog_state['error']
+    if JOB_BACKEND == 'thread':
+        # Модель грузится в фоне; задания принимаются и до её загрузки, а ждут её уже в очереди
+        response['model'] = {key: value for key, value in whisper_health().items()
+                             if key in ('state', 'warmed_up', 'last_error')}
+    else:
+        response['workers'] = response.get('jobs', {}).get('workers')
+    response['checks'] = checks
+    response['status'] = 'ready' if all(checks.values()) else 'not_ready'
+    return jsonify(response), 200 if all(checks.values()) else 503
+
+# Состояние очереди - снимается в момент запроса /metrics
+queue_metrics = Registry()
+QUEUE_JOBS = queue_metrics.gauge('ksr_queue_jobs', 'Задания в очереди по состоянию', ('state',))
+QUEUE_WORKERS = queue_metrics.gauge('ksr_queue_workers', 'Живые рабочие процессы')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Метрики в текстовом формате Prometheus
+
+    В режиме thread конвейер работает в этом процессе; в режиме queue каждый
+    рабочий процесс присылает свой снимок с heartbeat, и его серии помечены
+    меткой worker.
+    """
+    stats = jobs.stats()
+    QUEUE_JOBS.set(stats['queued'], state='queued')
+    QUEUE_JOBS.set(stats['running'], state='running')
+    QUEUE_WORKERS.set(stats['workers'])
     
-    return jsonify(processing_status), 200
+    sources = [(queue_metrics.snapshot(), {}), (METRICS.snapshot(), {})]
+    if JOB_BACKEND == 'queue':
+        sources.extend((snapshot, {'worker': worker_id}) for worker_id, snapshot in jobs.worker_metrics())
+    return Response(render(sources), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
+    # use_reloader=False: иначе модель загружается дважды (в процессе-наблюдателе и в рабочем)
+    app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=False) 
\ No newline at end of file
@@ -0,0 +1,211 @@
+import os
+import time
+import socket
+import uuid
+import threading
+from collections import OrderedDict
+
+from job_queue import JobQueueFull, RealTimeFactors
+from scheduler import schedule, estimate_wait, expected_seconds, job_real_time_factor
+
+# Примерный объём памяти на одно одновременное задание (активации, аудио, признаки)
+JOB_MEMORY_BYTES = int(os.environ.get('JOB_MEMORY_GB', 3)) * 1024 ** 3
+# Сколько потоков torch приходится на одно задание при расчёте размера пула
+THREADS_PER_JOB = int(os.environ.get('THREADS_PER_JOB', 4))
+
+
+class JobStatus(dict):
+    """Per-job status dict whose writes are serialized by a lock
+
+    process_video keeps writing status['...'] exactly as before; readers take
+    a consistent copy with snapshot().
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.RLock()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+
+    def update(self, *args, **kwargs):
+        with self._lock:
+            super().update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            return super().setdefault(key, default)
+
+    def snapshot(self, since_id=None):
+        """Copy of the status; with since_id only the subtitle chunks after that id"""
+        with self._lock:
+            data = dict(self)
+            subtitles = self.get('partial_subtitles') or []
+            # Курсор - id чанка (как chunk_id в SqliteJobQueue), а не позиция в списке
+            data['partial_subtitles'] = [chunk for chunk in subtitles if since_id is None or chunk['id'] > since_id]
+            data['last_subtitle_id'] = subtitles[-1]['id'] if subtitles else -1
+            return data
+
+
+def _total_memory_bytes():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def default_worker_count():
+    """Concurrent jobs the host can afford, limited by both cores and RAM"""
+    by_cpu = max(1, (os.cpu_count() or 1) // max(1, THREADS_PER_JOB))
+    memory = _total_memory_bytes()
+    by_memory = max(1, int(memory // JOB_MEMORY_BYTES)) if memory else 1
+    return min(by_cpu, by_memory)
+
+
+class JobManager:
+    """Bounded pool of worker threads consuming a queue of processing jobs
+
+    runner(job) does the work and fills job (a JobStatus) with progress; it
+    must return True on success. submit raises JobQueueFull once max_queued
+    jobs are already waiting, so callers can answer 429 instead of piling up.
+    A free thread takes the job the scheduler puts first (shortest expected
+    time with aging); finished jobs update the real-time factor of config.
+    """
+
+    def __init__(self, runner, workers=None, max_queued=None, keep_finished=200, config=None,
+                 real_time_factors=None):
+        self.workers = workers or int(os.environ.get('MAX_CONCURRENT_JOBS', 0)) or default_worker_count()
+        self.max_queued = max_queued if max_queued is not None else int(os.environ.get('MAX_QUEUED_JOBS', 20))
+        self.keep_finished = keep_finished
+        self._runner = runner
+        self.config = config
+        self.real_time_factors = real_time_factors or RealTimeFactors()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = threading.Condition(self._lock)
+        self._queued_ids = []
+        self._running = 0
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, filepath, filename, **extra):
+        with self._lock:
+            if len(self._queued_ids) >= self.max_queued:
+                raise JobQueueFull(f'В очереди уже {len(self._queued_ids)} заданий')
+            job_id = uuid.uuid4().hex[:12]
+            job = JobStatus({
+                'id': job_id,
+                'state': 'queued',
+                'is_processing': True,
+                'current_file': filename,
+                'filepath': filepath,
+                'progress': 0,
+                'current_stage': 'В очереди на обработку',
+                'estimated_time': 0,
+                'partial_subtitles': [],
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None
+            }, **extra)
+            self._jobs[job_id] = job
+            self._queued_ids.append(job_id)
+            self._forget_old_jobs()
+            self._pending.notify()
+        return job
+
+    def get(self, job_id, since_id=None):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return self._with_queue_position(job.snapshot(since_id))
+
+    def latest(self, since_id=None):
+        with self._lock:
+            job = next(reversed(self._jobs.values()), None)
+        return self._with_queue_position(job.snapshot(since_id)) if job else None
+
+    def list_jobs(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [self._summary(job.snapshot()) for job in reversed(jobs)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'running': self._running,
+                'queued': len(self._queued_ids),
+                'max_queued': self.max_queued
+            }
+
+    def _with_queue_position(self, data):
+        if data['state'] == 'queued':
+            real_time_factor = self.real_time_factors.estimate(self.config, socket.gethostname())
+            with self._lock:
+                queued = [self._jobs[job_id] for job_id in self._queued_ids]
+                running = [job for job in self._jobs.values() if job['state'] == 'running']
+                position, eta = estimate_wait(data['id'], queued, running, self.workers, time.time(), real_time_factor)
+            if position is not None:
+                data['queue_position'] = position
+                data['estimated_time'] = eta
+        return data
+
+    def _summary(self, data):
+        data['subtitles_count'] = len(data.pop('partial_subtitles', None) or [])
+        data.pop('filepath', None)
+        return data
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['state'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job_id]
+
+    def _next_job(self):
+        while True:
+            with self._lock:
+                while not self._queued_ids:
+                    self._pending.wait()
+            # RTF читается после ожидания: за время простоя его могли обновить другие воркеры
+            real_time_factor = self.real_time_factors.estimate(self.config, socket.gethostname())
+            with self._lock:
+                if not self._queued_ids:
+                    continue
+                queued = [self._jobs[job_id] for job_id in self._queued_ids]
+                job = schedule(queued, time.time(), real_time_factor)[0]
+                self._queued_ids.remove(job['id'])
+                self._running += 1
+            return job, real_time_factor
+
+    def _work(self):
+        while True:
+            job, real_time_factor = self._next_job()
+            job.update({
+                'state': 'running',
+                'started_at': time.time(),
+                'current_stage': 'Инициализация обработки видео',
+                'estimated_time': int(expected_seconds(job, real_time_factor)),
+                'expected_real_time_factor': real_time_factor
+            })
+            try:
+                succeeded = self._runner(job)
+            except Exception as e:
+                job['current_stage'] = f'Ошибка: {str(e)}'
+                succeeded = False
+            job.update({
+                'state': 'done' if succeeded else 'failed',
+                'is_processing': False,
+                'finished_at': time.time()
+            })
+            if not succeeded:
+                job['progress'] = 0
+            elif self.config and job_real_time_factor(job):
+                try:
+                    self.real_time_factors.record(self.config, job_real_time_factor(job))
+                except Exception as e:
+                    print(f"Не удалось записать RTF задания: {e}")
+            with self._lock:
+                self._running -= 1
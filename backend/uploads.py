@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import tempfile
+import threading
+
+# Незавершённые загрузки старше этого срока удаляются
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))
+UPLOAD_BLOCK_SIZE = 1 << 20
+
+
+class UploadError(Exception):
+    """Raised for requests that do not fit the state of an upload session"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class HashingFile:
+    """Writable file that feeds every written block into a sha256 digest"""
+
+    def __init__(self, path, mode='wb', digest=None):
+        self.path = path
+        self.digest = digest or hashlib.sha256()
+        self._file = open(path, mode)
+
+    def write(self, data):
+        self.digest.update(data)
+        return self._file.write(data)
+
+    def seek(self, *args):
+        # werkzeug перематывает поток файла в начало после разбора формы - для нас это no-op
+        return self._file.tell()
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, *args):
+        return b''
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def partial_path(filepath):
+    """Where an upload to filepath is written until it is complete"""
+    return f'{filepath}.part'
+
+
+def finish_partial(part_path, filepath):
+    """Move a completed upload into place without copying
+
+    os.replace swaps the directory entry: outputs hardlinked to an earlier
+    upload of the same name keep the old data.
+    """
+    os.replace(part_path, filepath)
+
+
+class UploadStore:
+    """Resumable uploads written straight into the upload folder
+
+    A session is created with the file name and total size; chunks are then
+    appended at the current offset (a chunk for any other offset is refused
+    with the offset to resume from) and hashed as they arrive. complete()
+    renames the .part file to its final name. Session metadata lives in
+    <upload_dir>/.sessions so an interrupted upload survives a server restart;
+    the running digest is rebuilt from the data on disk in that case.
+    """
+
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        self.sessions_dir = os.path.join(upload_dir, '.sessions')
+        os.makedirs(self.sessions_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._digests = {}
+        self._busy = set()
+
+    def _session_path(self, upload_id):
+        return os.path.join(self.sessions_dir, f'{upload_id}.json')
+
+    def _load(self, upload_id):
+        if not upload_id.isalnum():
+            return None
+        try:
+            with open(self._session_path(upload_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _describe(self, session):
+        offset = os.path.getsize(session['part']) if os.path.exists(session['part']) else 0
+        return {
+            'upload_id': session['id'],
+            'filename': session['filename'],
+            'size': session['size'],
+            'offset': offset,
+            'complete': offset == session['size']
+        }
+
+    def create(self, filename, size):
+        self.expire()
+        upload_id = uuid.uuid4().hex
+        filepath = os.path.join(self.upload_dir, filename)
+        session = {
+            'id': upload_id,
+            'filename': filename,
+            'filepath': filepath,
+            'part': partial_path(f'{filepath}.{upload_id}'),
+            'size': int(size),
+            'created_at': time.time()
+        }
+        open(session['part'], 'wb').close()
+        with open(self._session_path(upload_id), 'w', encoding='utf-8') as f:
+            json.dump(session, f, ensure_ascii=False)
+        self._digests[upload_id] = hashlib.sha256()
+        return self._describe(session)
+
+    def status(self, upload_id):
+        session = self._load(upload_id)
+        return self._describe(session) if session else None
+
+    def _digest(self, session):
+        digest = self._digests.get(session['id'])
+        if digest is None:
+            # Сервер перезапускался - пересчитываем хэш уже принятой части
+            digest = hashlib.sha256()
+            with open(session['part'], 'rb') as f:
+                for block in iter(lambda: f.read(UPLOAD_BLOCK_SIZE), b''):
+                    digest.update(block)
+            self._digests[session['id']] = digest
+        return digest
+
+    def append(self, upload_id, offset, stream, length=None):
+        """Append the request body at offset; returns the session state after the write
+
+        A chunk that would run past the declared size is refused whole with 413
+        before anything is written: by its length when the client sent one,
+        otherwise after buffering it in a temporary file.
+        """
+        session = self._load(upload_id)
+        if session is None:
+            raise UploadError('Загрузка не найдена', 404)
+        with self._lock:
+            if upload_id in self._busy:
+                raise UploadError('Часть этой загрузки уже принимается', 409)
+            self._busy.add(upload_id)
+        try:
+            current = os.path.getsize(session['part'])
+            if offset != current:
+                raise UploadError('Неверное смещение части', 409, current)
+            remaining = session['size'] - current
+            if length is not None and length > remaining:
+                raise UploadError('Данных больше, чем объявленный размер файла', 413, current)
+            with tempfile.SpooledTemporaryFile(max_size=UPLOAD_BLOCK_SIZE, dir=self.upload_dir) as chunk:
+                received = 0
+                # Читаем на байт больше остатка, чтобы заметить лишние данные до записи
+                while received <= remaining:
+                    block = stream.read(min(UPLOAD_BLOCK_SIZE, remaining + 1 - received))
+                    if not block:
+                        break
+                    chunk.write(block)
+                    received += len(block)
+                if received > remaining:
+                    raise UploadError('Данных больше, чем объявленный размер файла', 413, current)
+                chunk.seek(0)
+                out = HashingFile(session['part'], 'ab', self._digest(session))
+                try:
+                    shutil.copyfileobj(chunk, out, UPLOAD_BLOCK_SIZE)
+                finally:
+                    out.close()
+            return self._describe(session)
+        finally:
+            with self._lock:
+                self._busy.discard(upload_id)
+
+    def _discard(self, upload_id, session):
+        for path in (session['part'], self._session_path(upload_id)):
+            if os.path.exists(path):
+                os.remove(path)
+        self._digests.pop(upload_id, None)
+
+    def complete(self, upload_id, sha256=None):
+        """Move a fully received upload into place; returns (filepath, filename, sha256)
+
+        If the client passes the sha256 of its file and the received data does
+        not match it, the session is discarded and 422 is raised: the upload
+        has to start over.
+        """
+        session = self._load(upload_id)
+        if session is None:
+            raise UploadError('Загрузка не найдена', 404)
+        state = self._describe(session)
+        if not state['complete']:
+            raise UploadError('Файл получен не полностью', 409, state['offset'])
+        content_hash = self._digest(session).hexdigest()
+        if sha256 and sha256.lower() != content_hash:
+            self._discard(upload_id, session)
+            raise UploadError('Контрольная сумма файла не совпадает', 422)
+        finish_partial(session['part'], session['filepath'])
+        os.remove(self._session_path(upload_id))
+        self._digests.pop(upload_id, None)
+        return session['filepath'], session['filename'], content_hash
+
+    def expire(self, ttl=None):
+        """Remove sessions (and their partial data) not completed within ttl seconds"""
+        deadline = time.time() - (UPLOAD_SESSION_TTL if ttl is None else ttl)
+        removed = 0
+        for name in os.listdir(self.sessions_dir):
+            upload_id = name.rsplit('.', 1)[0]
+            session = self._load(upload_id)
+            if session is None or session['created_at'] >= deadline or upload_id in self._busy:
+                continue
+            self._discard(upload_id, session)
+            removed += 1
+        return removed
@@ -0,0 +1,96 @@
+import os
+import subprocess
+import numpy as np
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SAMPLE_RATE = 16000
+# Меняется при изменении генератора - старые файлы в FIXTURES_DIR не переиспользуются
+GENERATOR_VERSION = 1
+
+
+def speech_like_pcm(seconds, seed=0, sample_rate=SAMPLE_RATE):
+    """Deterministic int16 signal with the rhythm of speech
+
+    "Syllables" of 120-320 ms (a voiced harmonic tone with a gliding pitch
+    and formant-like emphasis, plus a little breath noise) form phrases of
+    1-6 s separated by 0.3-1.5 s pauses over a quiet noise floor, so the
+    VAD, the window cutting and the decoder all see realistic work. It is
+    not real speech: token counts and therefore RTF differ from lectures,
+    use --media with recordings for absolute numbers.
+    """
+    rng = np.random.default_rng(seed)
+    total = int(seconds * sample_rate)
+    signal = rng.normal(0.0, 0.002, total).astype(np.float32)
+    position = int(rng.uniform(0.2, 0.8) * sample_rate)
+    while position < total:
+        phrase_end = min(total, position + int(rng.uniform(1.0, 6.0) * sample_rate))
+        pitch = rng.uniform(95.0, 230.0)
+        while position < phrase_end:
+            length = int(rng.uniform(0.12, 0.32) * sample_rate)
+            t = np.arange(length) / sample_rate
+            f0 = pitch * (1.0 + rng.uniform(-0.08, 0.08) * t / max(t[-1], 1e-3))
+            phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+            formant = rng.uniform(500.0, 2500.0)
+            syllable = np.zeros(length, dtype=np.float32)
+            for harmonic in range(1, 12):
+                weight = np.exp(-((harmonic * pitch - formant) / 600.0) ** 2) + 0.3 / harmonic
+                syllable += weight * np.sin(harmonic * phase)
+            syllable += rng.normal(0.0, 0.15, length)
+            syllable *= np.hanning(length) * rng.uniform(0.05, 0.2) / 3.0
+            end = min(total, position + length)
+            signal[position:end] += syllable[:end - position]
+            position = end + int(rng.uniform(0.0, 0.08) * sample_rate)
+        position = phrase_end + int(rng.uniform(0.3, 1.5) * sample_rate)
+    return (np.clip(signal, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def synthetic_video(seconds, seed=0, directory=None):
+    """Path of an mp4 (small test-pattern video + AAC speech_like_pcm audio), generated once and reused"""
+    from diploma_handle import _ffmpeg_executable, write_wav
+
+    directory = directory or FIXTURES_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'synthetic_{int(seconds)}s_seed{seed}_v{GENERATOR_VERSION}.mp4')
+    if os.path.exists(path):
+        return path
+
+    executable = _ffmpeg_executable()
+    if executable is None:
+        raise RuntimeError('ffmpeg не найден: установите ffmpeg или imageio-ffmpeg')
+    wav_path = path[:-4] + '.wav'
+    write_wav(speech_like_pcm(seconds, seed), wav_path)
+    try:
+        subprocess.run([
+            executable, '-nostdin', '-v', 'error', '-y',
+            '-f', 'lavfi', '-i', f'testsrc=size=320x240:rate=10:duration={seconds}',
+            '-i', wav_path,
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-b:a', '64k', '-shortest',
+            # Без меток времени в контейнере файл получается одинаковым при каждой генерации
+            '-map_metadata', '-1', '-fflags', '+bitexact',
+            path + '.tmp.mp4'
+        ], check=True)
+        os.replace(path + '.tmp.mp4', path)
+    finally:
+        os.remove(wav_path)
+    return path
+
+
+def media_excerpt(media_path, seconds, directory=None):
+    """First `seconds` of a real recording as a fixture (stream copy, generated once)"""
+    from diploma_handle import _ffmpeg_executable
+
+    directory = directory or FIXTURES_DIR
+    os.makedirs(directory, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(media_path))[0]
+    extension = os.path.splitext(media_path)[1] or '.mp4'
+    path = os.path.join(directory, f'{base_name}_{int(seconds)}s{extension}')
+    if os.path.exists(path):
+        return path
+    executable = _ffmpeg_executable()
+    if executable is None:
+        raise RuntimeError('ffmpeg не найден: установите ffmpeg или imageio-ffmpeg')
+    subprocess.run([executable, '-nostdin', '-v', 'error', '-y', '-i', media_path, '-t', str(seconds),
+                    '-c', 'copy', path + '.tmp' + extension], check=True)
+    os.replace(path + '.tmp' + extension, path)
+    return path
@@ -0,0 +1,349 @@
+"""Stage-by-stage benchmark of the processing pipeline
+
+    python -m benchmarks.pipeline --lengths 30,120 --beams 1,5 --batch-sizes 1,8 --threads 4,8
+    python -m benchmarks.pipeline --media records/lecture.mp4 --lengths 300 --baseline benchmarks/results/old.json
+
+Every configuration runs in a fresh process, so the model load and peak RSS
+belong to that configuration alone. Results are written as JSON (by default
+to benchmarks/results/) and can be compared with an earlier run via --baseline.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import itertools
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+from contextlib import contextmanager, redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.fixtures import synthetic_video, media_excerpt
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+RESULTS_FORMAT_VERSION = 1
+STAGES = ('extraction', 'features', 'generate', 'batch_decode', 'smart_chunking', 'saving')
+
+
+class StageTimer:
+    """Wall time and call count per stage, collected by wrapping the pipeline functions"""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.calls = dict.fromkeys(STAGES, 0)
+        self.generated_tokens = 0
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+        self.calls[stage] += 1
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+
+@contextmanager
+def instrument(pipeline, timer, processor, model):
+    """Time features/generate/batch_decode inside the unchanged transcribe_windows code path"""
+    originals = {name: getattr(pipeline, name) for name in ('window_features',)}
+    decode = pipeline.decode_with_offsets
+    generate = model.generate
+    pad_token_id = model.generation_config.pad_token_id
+
+    def timed_generate(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            outputs = generate(*args, **kwargs)
+        finally:
+            timer.add('generate', time.perf_counter() - start)
+        sequences = getattr(outputs, 'sequences', outputs)
+        timer.generated_tokens += int((sequences != pad_token_id).sum()) if pad_token_id is not None else sequences.numel()
+        return outputs
+
+    for name, function in originals.items():
+        setattr(pipeline, name, timer.wrap('features', function))
+    model.generate = timed_generate
+    pipeline.decode_with_offsets = timer.wrap('batch_decode', decode)
+    try:
+        yield timer
+    finally:
+        for name, function in originals.items():
+            setattr(pipeline, name, function)
+        pipeline.decode_with_offsets = decode
+        del model.generate
+
+
+def run_once(pipeline, processor, model, media_path, batch_size):
+    """Process media_path once the way process_video does, with every stage timed separately"""
+    timer = StageTimer()
+    run_start = time.perf_counter()
+
+    # Извлечение: декодирование аудиодорожки и нарезка на окна по VAD. В process_video
+    # оно идёт потоком параллельно с распознаванием, здесь - заранее, чтобы измерить отдельно
+    start = time.perf_counter()
+    pcm = pipeline.decode_audio_pcm(media_path)
+    windows = list(pipeline.speech_windows(pipeline.iter_pcm_windows(pcm)))
+    timer.add('extraction', time.perf_counter() - start)
+    audio_seconds = len(pcm) / pipeline.SAMPLE_RATE
+
+    segments = []
+    start = time.perf_counter()
+    with instrument(pipeline, timer, processor, model):
+        for new_segments in pipeline.transcribe_windows(windows, processor, model, batch_size=batch_size,
+                                                        audio_duration=audio_seconds):
+            segments.extend(new_segments)
+    transcribe_seconds = time.perf_counter() - start
+
+    chunked_segments = timer.wrap('smart_chunking', pipeline.smart_chunking)(segments, **pipeline.CHUNKING_PARAMS)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_paths = {
+            'base_dir': output_dir,
+            'transcription_json': os.path.join(output_dir, 'bench_transcription.json'),
+            'transcription_txt': os.path.join(output_dir, 'bench_transcription.txt'),
+            'chunked_json': os.path.join(output_dir, 'bench_chunked.json')
+        }
+        text = " ".join(segment['text'] for segment in segments if segment['text'])
+        timer.wrap('saving', pipeline.save_output_files)(text, segments, chunked_segments, output_paths)
+
+    total_seconds = time.perf_counter() - run_start
+    measured = timer.seconds['features'] + timer.seconds['generate'] + timer.seconds['batch_decode']
+    return {
+        'audio_seconds': round(audio_seconds, 2),
+        'windows': len(windows),
+        'segments': len(segments),
+        'subtitles': len(chunked_segments),
+        'generated_tokens': timer.generated_tokens,
+        'total_seconds': round(total_seconds, 4),
+        'stages': {stage: round(seconds, 4) for stage, seconds in timer.seconds.items()},
+        'stage_calls': timer.calls,
+        # Батчирование, разметка чанков по времени, журнал - всё, что в transcribe_windows вне трёх стадий
+        'transcribe_overhead_seconds': round(max(0.0, transcribe_seconds - measured), 4)
+    }
+
+
+def run_configuration(config, media_path, repeat=1, warmup=0, verbose=False):
+    """Load the model for config in this process and benchmark media_path; runs in a child process"""
+    os.environ['WHISPER_MODEL_NAME'] = config['model']
+    # Результаты бенчмарка не должны попадать в каталог и поисковый индекс сервиса
+    os.environ['VIDEO_CATALOG_DB'] = os.path.join(tempfile.mkdtemp(prefix='ksr-bench-'), 'catalog.sqlite3')
+
+    log = sys.stdout if verbose else open(os.devnull, 'w')
+    try:
+        with redirect_stdout(log):
+            import diploma_handle as pipeline
+
+            threads = pipeline.configure_torch_threads(config['threads'], config.get('interop_threads') or 0)
+            pipeline.DECODING_PARAMS['num_beams'] = config['beams']
+
+            load_start = time.perf_counter()
+            processor, model = pipeline.initialize_whisper(config['backend'])
+            load_seconds = time.perf_counter() - load_start
+            if model is None:
+                return {'config': config, 'media': os.path.basename(media_path),
+                        'error': f"модель {config['model']} не загружена"}
+
+            runs = [run_once(pipeline, processor, model, media_path, config['batch_size'])
+                    for _ in range(warmup + repeat)][warmup:]
+    except Exception as e:
+        return {'config': config, 'media': os.path.basename(media_path), 'error': f'{type(e).__name__}: {e}'}
+    finally:
+        if log is not sys.stdout:
+            log.close()
+
+    total = statistics.median(run['total_seconds'] for run in runs)
+    audio_seconds = runs[0]['audio_seconds']
+    stages = {stage: round(statistics.median(run['stages'][stage] for run in runs), 4) for stage in STAGES}
+    return {
+        'config': config,
+        'media': os.path.basename(media_path),
+        'audio_seconds': audio_seconds,
+        'windows': runs[0]['windows'],
+        'torch_threads': threads,
+        'load_seconds': round(load_seconds, 2),
+        'peak_rss_mb': pipeline._peak_rss_mb(),
+        'total_seconds': round(total, 4),
+        'stages': stages,
+        'real_time_factor': round(total / audio_seconds, 4) if audio_seconds else None,
+        'generate_real_time_factor': round(stages['generate'] / audio_seconds, 4) if audio_seconds else None,
+        'throughput': {
+            'audio_seconds_per_second': round(audio_seconds / total, 3) if total else None,
+            'windows_per_second': round(runs[0]['windows'] / total, 3) if total else None,
+            'tokens_per_second': round(runs[0]['generated_tokens'] / stages['generate'], 2) if stages['generate'] else None
+        },
+        'runs': runs
+    }
+
+
+def configurations(args):
+    """Cartesian product of the values given on the command line"""
+    for backend, beams, batch_size, threads in itertools.product(
+            args.backends, args.beams, args.batch_sizes, args.threads):
+        yield {
+            'model': args.model,
+            'backend': backend,
+            'beams': beams,
+            'batch_size': batch_size,
+            'threads': threads,
+            'interop_threads': args.interop_threads
+        }
+
+
+def environment():
+    def version(module):
+        try:
+            return __import__(module).__version__
+        except Exception:
+            return None
+
+    def git(*command):
+        try:
+            return subprocess.run(['git', *command], cwd=ROOT_DIR, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except Exception:
+            return None
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'torch': version('torch'),
+        'transformers': version('transformers'),
+        'numpy': version('numpy'),
+        'git_commit': git('rev-parse', 'HEAD'),
+        'git_dirty': bool(git('status', '--porcelain', '--untracked-files=no'))
+    }
+
+
+def result_key(result):
+    config = result['config']
+    return (config['model'], config['backend'], config['beams'], config['batch_size'], config['threads'],
+            result.get('media'))
+
+
+def compare_results(report, baseline):
+    """Relative change of total and per-stage time against a baseline report, per matching configuration"""
+    previous = {result_key(result): result for result in baseline['results'] if 'error' not in result}
+    comparison = []
+    for result in report['results']:
+        before = previous.get(result_key(result))
+        if 'error' in result or before is None:
+            continue
+        entry = {'config': result['config'], 'media': result['media']}
+        for name, now, then in [('total', result['total_seconds'], before['total_seconds']),
+                                *((stage, result['stages'][stage], before['stages'][stage]) for stage in STAGES)]:
+            entry[name] = round((now - then) / then * 100, 1) if then else None
+        comparison.append(entry)
+    return comparison
+
+
+def print_report(report):
+    print(f"\n{'media':<28} {'backend':<7} {'beams':>5} {'batch':>5} {'thr':>4} {'RTF':>7} {'RSS MB':>8}  "
+          + ' '.join(f'{stage[:10]:>10}' for stage in STAGES))
+    for result in report['results']:
+        config = result['config']
+        prefix = (f"{result.get('media', '-'):<28} {config['backend']:<7} {config['beams']:>5} "
+                  f"{config['batch_size']:>5} {config['threads']:>4}")
+        if 'error' in result:
+            print(f"{prefix} ошибка: {result['error']}")
+            continue
+        print(f"{prefix} {result['real_time_factor']:>7} {result['peak_rss_mb'] or 0:>8.0f}  "
+              + ' '.join(f"{result['stages'][stage]:>10.3f}" for stage in STAGES))
+    for entry in report.get('comparison', []):
+        config = entry['config']
+        changes = ', '.join(f'{name} {value:+.1f}%' for name, value in entry.items()
+                            if name not in ('config', 'media') and value is not None)
+        print(f"Изменение {entry['media']} {config['backend']}/beams={config['beams']}/batch={config['batch_size']}"
+              f"/threads={config['threads']}: {changes}")
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.pipeline', description=__doc__.split('\n')[0])
+    parser.add_argument('--media', action='append', default=[],
+                        help='запись для замеров (можно несколько); без неё используется синтетическое видео')
+    parser.add_argument('--lengths', type=_int_list, default=[30, 120],
+                        help='длительности фрагментов, сек (через запятую)')
+    parser.add_argument('--seed', type=int, default=0, help='зерно генератора синтетического аудио')
+    parser.add_argument('--model', default=os.environ.get('WHISPER_MODEL_NAME', 'openai/whisper-medium'))
+    parser.add_argument('--backends', default='fp32', type=lambda value: value.split(','))
+    parser.add_argument('--beams', type=_int_list, default=[5])
+    parser.add_argument('--batch-sizes', type=_int_list, default=[8])
+    parser.add_argument('--threads', type=_int_list, default=[os.cpu_count() or 1])
+    parser.add_argument('--interop-threads', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='сколько замеров на конфигурацию (берётся медиана)')
+    parser.add_argument('--warmup', type=int, default=0, help='сколько прогонов не учитывать')
+    parser.add_argument('--output', default=None, help='файл отчёта JSON (по умолчанию benchmarks/results/)')
+    parser.add_argument('--baseline', default=None, help='предыдущий отчёт для сравнения')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='код возврата 1, если общее время выросло больше чем на столько процентов')
+    parser.add_argument('--verbose', action='store_true', help='показывать вывод конвейера')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    media = []
+    for seconds in args.lengths:
+        if args.media:
+            media.extend(media_excerpt(path, seconds) for path in args.media)
+        else:
+            media.append(synthetic_video(seconds, args.seed))
+
+    report = {
+        'format': RESULTS_FORMAT_VERSION,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': environment(),
+        'settings': {name: value for name, value in vars(args).items()
+                     if name not in ('output', 'baseline', 'max_regression', 'verbose')},
+        'results': []
+    }
+
+    context = multiprocessing.get_context('spawn')
+    for config in configurations(args):
+        for media_path in media:
+            print(f"Замер {os.path.basename(media_path)}: {config}")
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_configuration, config, media_path, args.repeat, args.warmup,
+                                         args.verbose).result()
+            report['results'].append(result)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            report['comparison'] = compare_results(report, json.load(f))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"pipeline_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print_report(report)
+    print(f"\nОтчёт: {output}")
+
+    if args.max_regression is not None:
+        regressions = [entry for entry in report.get('comparison', [])
+                       if entry['total'] is not None and entry['total'] > args.max_regression]
+        if regressions:
+            print(f"Регрессия больше {args.max_regression}% в {len(regressions)} конфигурациях")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
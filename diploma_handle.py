@@ -1,35 +1,239 @@
 import json
-import torch
-import librosa
+import sys
+import atexit
+import importlib
 import numpy as np
-from transformers import WhisperForConditionalGeneration, WhisperProcessor
-import moviepy.editor as mp
 import os
+import gzip
 import time
 import shutil
 import re
-import tkinter as tk
-from tkinter import filedialog
+import gc
+import wave
+import subprocess
+import uuid
+import socket
+import threading
+import queue
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from result_cache import ResultCache, cache_key, link_or_copy
+from video_catalog import VideoCatalog, entry_from_files
+from metrics import METRICS
+from scheduler import DEFAULT_REAL_TIME_FACTOR, job_real_time_factor
+
+
+class _LazyModule:
+    """Module imported on first attribute access
+
+    torch and transformers take seconds to import; the web server, the queue
+    CLI and the benchmarks import this file long before (or without ever)
+    touching the model.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+
+torch = _LazyModule('torch')
+transformers = _LazyModule('transformers')
+
+WHISPER_MODEL_NAME = os.environ.get('WHISPER_MODEL_NAME', 'openai/whisper-medium')
+# fp32 - исходные веса; int8 - динамическая квантизация Linear-слоёв (только CPU)
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'fp32')
+INFERENCE_BACKENDS = ('fp32', 'int8')
+# Потоки torch: 0 - оставить значение torch по умолчанию
+TORCH_NUM_THREADS = int(os.environ.get('TORCH_NUM_THREADS', 0))
+TORCH_INTEROP_THREADS = int(os.environ.get('TORCH_INTEROP_THREADS', 0))
+# Где хранятся квантизованные веса, чтобы квантизация выполнялась один раз
+QUANTIZED_MODEL_DIR = os.environ.get(
+    'QUANTIZED_MODEL_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'ksrecognition')
+)
+# Через сколько секунд простоя модель выгружается из памяти (0 - никогда)
+WHISPER_IDLE_TIMEOUT = int(os.environ.get('WHISPER_IDLE_TIMEOUT', 1800))
+# Сколько 15-секундных окон отправлять в один вызов generate
+WHISPER_BATCH_SIZE = int(os.environ.get('WHISPER_BATCH_SIZE', 8))
+# Спекулятивное декодирование: маленький Whisper из локальной папки предлагает токены,
+# основная модель проверяет их за один проход. Результат совпадает с жадным декодированием
+WHISPER_DRAFT_MODEL_PATH = os.environ.get('WHISPER_DRAFT_MODEL_PATH', '')
+SPECULATIVE_DRAFT_TOKENS = int(os.environ.get('SPECULATIVE_DRAFT_TOKENS', 5))
+# Шардированная транскрибация: окна одного видео делятся между SHARD_WORKERS процессами,
+# у каждого своя копия модели (память растёт в SHARD_WORKERS раз) и SHARD_THREADS потоков torch
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', 0))
+SHARD_THREADS = int(os.environ.get('SHARD_THREADS', 0))
+SAMPLE_RATE = 16000
+# Параметры generate; входят в ключ кэша результатов, поэтому меняются только здесь
+DECODING_PARAMS = {
+    'max_length': 448,
+    'return_timestamps': True,
+    'language': "kazakh",
+    'task': "transcribe",
+    'num_beams': 3,          # Увеличили num_beams
+    'temperature': 0.2,      # Уменьшили temperature
+    # 'no_repeat_ngram_size': 3, # Пока закомментируем
+    'length_penalty': 1.0,
+    'repetition_penalty': 1.0
+}
+# Жадное декодирование (temperature 0 - без сэмплирования): им повторяются зациклившиеся окна,
+# и ему в точности равен спекулятивный режим
+GREEDY_DECODING_PARAMS = dict(DECODING_PARAMS, num_beams=1, temperature=0.0)
+CHUNKING_PARAMS = {'max_duration': 8.0, 'max_sentences': 3}
+# Защита от зацикливания generate: повтор n-граммы подряд или слишком много токенов для окна
+REPETITION_GUARD_PARAMS = {
+    'max_period': 8,             # длина повторяющегося фрагмента, токенов
+    'min_repeats': 4,            # сколько раз подряд он должен повториться
+    'tokens_per_second': 12,     # правдоподобный предел токенов на секунду аудио
+    'base_tokens': 16
+}
+SEGMENT_DURATION = 15  # Вернем 15 секунд, т.к. будем полагаться на чанки модели
+# Сколько декодированных окон может ждать транскрибации (ограничивает память потока)
+AUDIO_QUEUE_WINDOWS = int(os.environ.get('AUDIO_QUEUE_WINDOWS', 16))
+# Энергетический VAD перед generate: тихие участки не отправляются в модель
+VAD_ENABLED = os.environ.get('VAD_ENABLED', '1') != '0'
+VAD_MARGIN_DB = float(os.environ.get('VAD_MARGIN_DB', 12))
+# Сохранять ли .wav рядом с видео (для транскрибации он больше не нужен)
+WRITE_WAV = os.environ.get('WRITE_WAV', '0') == '1'
+# Сколько секунд аудио задания должно быть распознано, чтобы оценка времени шла по его собственной скорости
+ETA_MEASURED_AUDIO_SECONDS = 60
+# Какие файлы команда batch считает видео (как ALLOWED_EXTENSIONS в backend/app.py)
+BATCH_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+# Профилирование каждого задания: cprofile или torch (для одного задания - параметр ?profile= при загрузке)
+PROFILE_JOBS = os.environ.get('PROFILE_JOBS', '')
+PROFILE_MODES = ('cprofile', 'torch')
+
+# Метрики конвейера; backend/app.py отдаёт их на /metrics
+STAGE_SECONDS = METRICS.histogram('ksr_stage_seconds', 'Время стадии обработки, сек', ('stage',))
+WINDOW_GENERATE_SECONDS = METRICS.histogram(
+    'ksr_window_generate_seconds', 'Задержка generate в пересчёте на одно окно, сек',
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+)
+WINDOW_AUDIO_SECONDS = METRICS.histogram(
+    'ksr_window_audio_seconds', 'Длительность окна речи, переданного в generate, сек',
+    buckets=(0.5, 1.0, 2.0, 4.0, 6.0, 8.0, 10.0, 12.0, 15.0, 20.0, 30.0)
+)
+AUDIO_SECONDS = METRICS.counter('ksr_audio_seconds_total', 'Секунды речи, прошедшие через generate')
+WINDOWS_TOTAL = METRICS.counter('ksr_windows_total', 'Окна, переданные в generate')
+TOKENS_TOTAL = METRICS.counter('ksr_generated_tokens_total', 'Токены, созданные generate (без заполнения)')
+SEGMENTS_TOTAL = METRICS.counter('ksr_segments_total', 'Сегменты транскрипции с временными метками')
+REPETITION_FALLBACKS = METRICS.counter('ksr_repetition_fallbacks_total',
+                                       'Окна, повторённые жадным декодированием из-за зацикливания')
+SWALLOWED_EXCEPTIONS = METRICS.counter('ksr_swallowed_exceptions_total',
+                                       'Исключения, перехваченные без остановки задания', ('where', 'type'))
+JOBS_TOTAL = METRICS.counter('ksr_jobs_total', 'Завершённые задания', ('result',))
+JOB_SECONDS = METRICS.histogram('ksr_job_seconds', 'Время обработки задания, сек')
+REAL_TIME_FACTOR = METRICS.histogram(
+    'ksr_real_time_factor', 'Отношение времени транскрибации к длительности аудио',
+    buckets=(0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0)
+)
+
+# Процессный реестр модели: загружаем один раз и переиспользуем между заданиями
+_whisper_registry = {
+    'processor': None,
+    'model': None,
+    'model_name': None,
+    'backend': None,
+    'device': None,
+    'state': 'unloaded',
+    'real_time_factor': None,
+    'loaded_at': None,
+    'last_used': None,
+    'load_seconds': None,
+    'warmed_up': False,
+    'in_use': 0,
+    'loads': 0,
+    'evictions': 0,
+    'last_error': None,
+    'draft_model': None,
+    'draft_model_path': None,
+    'speculative': None
+}
+_whisper_lock = threading.RLock()
+_whisper_reaper = None
+_shard_pool = None
+_shard_pool_lock = threading.Lock()
  
 def create_output_folder(video_path):
+   output_paths = result_paths(video_path)
+   os.makedirs(output_paths['base_dir'], exist_ok=True)
+   return output_paths
+
+def result_paths(video_path):
+   """Paths of the result files of video_path, without creating its output folder"""
    base_name = os.path.splitext(os.path.basename(video_path))[0]
    backend_dir = os.path.dirname(os.path.abspath(__file__))
    if not os.path.basename(backend_dir) == 'backend':
        backend_dir = os.path.join(backend_dir, 'backend')
    output_dir = os.path.join(backend_dir, 'output', base_name)
    
-   os.makedirs(output_dir, exist_ok=True)
    return {
        'base_dir': output_dir,
        'video': os.path.join(output_dir, f"{base_name}.mp4"),
        'audio': os.path.join(output_dir, f"{base_name}.wav"),
+       'pcm': os.path.join(output_dir, f"{base_name}.pcm"),
        'transcription_json': os.path.join(output_dir, f"{base_name}_transcription.json"),
        'transcription_txt': os.path.join(output_dir, f"{base_name}_transcription.txt"),
-       'chunked_json': os.path.join(output_dir, f"{base_name}_chunked.json")
+       'chunked_json': os.path.join(output_dir, f"{base_name}_chunked.json"),
+       'journal': os.path.join(output_dir, f"{base_name}_journal.jsonl")
    }
  
-def initialize_whisper():
-    """Initialize Whisper model with optimized settings"""
+def configure_torch_threads(num_threads=None, interop_threads=None):
+    """Apply explicit intra-op / inter-op thread counts (TORCH_NUM_THREADS, TORCH_INTEROP_THREADS)"""
+    num_threads = TORCH_NUM_THREADS if num_threads is None else num_threads
+    interop_threads = TORCH_INTEROP_THREADS if interop_threads is None else interop_threads
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # Число inter-op потоков можно задать только до первой параллельной операции
+            print(f"Не удалось изменить число inter-op потоков: {e}")
+    return {'num_threads': torch.get_num_threads(), 'interop_threads': torch.get_num_interop_threads()}
+
+def _quantized_model_path(model_name):
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+    return os.path.join(QUANTIZED_MODEL_DIR, f"{safe_name}-int8-torch{torch.__version__.split('+')[0]}.pt")
+
+def _quantize_dynamic(model):
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def _load_int8_whisper(model_name):
+    """Whisper with int8 dynamically quantized Linear layers, quantized once and cached on disk"""
+    cache_path = _quantized_model_path(model_name)
+    if os.path.exists(cache_path):
+        print(f"Загрузка квантизованных весов из {cache_path}")
+        model = transformers.WhisperForConditionalGeneration(transformers.WhisperConfig.from_pretrained(model_name))
+        model.generation_config = transformers.GenerationConfig.from_pretrained(model_name)
+        model = _quantize_dynamic(model.eval())
+        model.load_state_dict(torch.load(cache_path, weights_only=False))
+        return model
+    
+    print(f"Квантизация {model_name} в int8 (выполняется один раз)...")
+    model = _quantize_dynamic(transformers.WhisperForConditionalGeneration.from_pretrained(model_name).eval())
+    os.makedirs(QUANTIZED_MODEL_DIR, exist_ok=True)
+    torch.save(model.state_dict(), cache_path + '.tmp')
+    os.replace(cache_path + '.tmp', cache_path)
+    print(f"Квантизованные веса сохранены в {cache_path}")
+    return model
+
+def initialize_whisper(backend=None):
+    """Initialize Whisper model with optimized settings
+
+    backend is 'fp32' or 'int8' (INFERENCE_BACKEND by default); int8 always runs on CPU.
+    """
+    backend = backend or INFERENCE_BACKEND
+    if backend not in INFERENCE_BACKENDS:
+        print(f"Неизвестный режим инференса {backend}, используется fp32")
+        backend = 'fp32'
     try:
         # # Пока закомментируем загрузку локальной модели для теста
         # model_path = "/Users/maru/Desktop/My Projects/University/Diploma/1400-1400 step"
@@ -53,11 +257,17 @@ def initialize_whisper():
         # import traceback
         # traceback.print_exc() # Можно раскомментировать для детальной ошибки, если она будет не из-за принуждения
         
-        print("Использую стандартную модель Whisper (openai/whisper-medium)...")
-        model_name = "openai/whisper-medium"
+        model_name = WHISPER_MODEL_NAME
+        print(f"Использую стандартную модель Whisper ({model_name}, {backend})...")
+        threads = configure_torch_threads()
+        print(f"Потоки torch: {threads['num_threads']} intra-op, {threads['interop_threads']} inter-op")
+        load_start = time.time()
         try:
-            processor = WhisperProcessor.from_pretrained(model_name)
-            model = WhisperForConditionalGeneration.from_pretrained(model_name)
+            processor = transformers.WhisperProcessor.from_pretrained(model_name)
+            if backend == 'int8':
+                model = _load_int8_whisper(model_name)
+            else:
+                model = transformers.WhisperForConditionalGeneration.from_pretrained(model_name)
         except Exception as model_load_err:
             print(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось загрузить даже стандартную модель {model_name}: {model_load_err}")
             print("Убедитесь, что есть интернет-соединение и модель доступна в Hugging Face.")
@@ -68,253 +278,1340 @@ def initialize_whisper():
         model.generation_config.language = "kazakh" # Указываем язык для стандартной модели
         model.generation_config.task = "transcribe"
         
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = "cuda" if torch.cuda.is_available() and backend == 'fp32' else "cpu"
         print(f"Стандартная модель будет использовать устройство: {device}")
-        return processor, model.to(device)
- 
-def copy_video_and_extract_audio(video_path, output_paths, status=None):
-   try:
-       if status:
-           status['progress'] = 5
-           status['current_stage'] = 'Копирование видео и извлечение аудио'
-           status['estimated_time'] = 60
-       
-       shutil.copy2(video_path, output_paths['video'])
-       
-       if status:
-           status['progress'] = 10
-       
-       with mp.VideoFileClip(video_path) as video:
-           video.audio.write_audiofile(
-               output_paths['audio'],
-               fps=16000,
-               codec='pcm_s16le',
-               verbose=False
-           )
-           
-       if status:
-           status['progress'] = 20
-           
-       return True
-   except Exception as e:
-       print(f"Video/audio processing failed: {e}")
-       return False
- 
-def transcribe_with_timestamps(audio_path, processor, model, status=None):
-    """Efficient transcription with JSON-ready output, используя result['chunks']"""
+        model = model.eval().to(device)
+        STAGE_SECONDS.observe(time.time() - load_start, stage='model_load')
+        return processor, model
+
+def get_whisper():
+    """Return the process-wide (processor, model) pair, loading it on first use"""
+    with _whisper_lock:
+        if _whisper_registry['model'] is None:
+            _whisper_registry['state'] = 'loading'
+            load_start = time.time()
+            processor, model = initialize_whisper()
+            if model is None:
+                _whisper_registry['state'] = 'failed'
+                _whisper_registry['last_error'] = f'Не удалось загрузить модель {WHISPER_MODEL_NAME}'
+                return None, None
+            _whisper_registry.update({
+                'processor': processor,
+                'model': model,
+                'model_name': WHISPER_MODEL_NAME,
+                'backend': INFERENCE_BACKEND,
+                'real_time_factor': None,
+                'device': str(model.device),
+                'state': 'ready',
+                'loaded_at': time.time(),
+                'load_seconds': round(time.time() - load_start, 2),
+                'warmed_up': False,
+                'last_error': None
+            })
+            _whisper_registry['loads'] += 1
+            print(f"Модель {WHISPER_MODEL_NAME} загружена в реестр за {_whisper_registry['load_seconds']} сек")
+        _whisper_registry['last_used'] = time.time()
+        return _whisper_registry['processor'], _whisper_registry['model']
+
+def load_draft_whisper(model, draft_path=None):
+    """Load the small draft Whisper from a local folder onto the main model's device
+
+    The draft must share the main model's tokenizer (any multilingual Whisper
+    checkpoint does), otherwise its tokens cannot be verified.
+    """
+    draft_path = draft_path or WHISPER_DRAFT_MODEL_PATH
+    draft = transformers.WhisperForConditionalGeneration.from_pretrained(draft_path, local_files_only=True)
+    if draft.config.vocab_size != model.config.vocab_size:
+        raise ValueError(f'Словарь черновой модели ({draft.config.vocab_size}) не совпадает '
+                         f'со словарём основной ({model.config.vocab_size})')
+    return draft.eval().to(model.device)
+
+def get_draft_whisper():
+    """Return the process-wide draft model, or None when speculative decoding is off or unavailable"""
+    if not WHISPER_DRAFT_MODEL_PATH:
+        return None
+    with _whisper_lock:
+        if _whisper_registry['draft_model'] is None:
+            _, model = get_whisper()
+            if model is None:
+                return None
+            try:
+                _whisper_registry['draft_model'] = load_draft_whisper(model)
+                _whisper_registry['draft_model_path'] = WHISPER_DRAFT_MODEL_PATH
+                print(f"Черновая модель для спекулятивного декодирования загружена из {WHISPER_DRAFT_MODEL_PATH}")
+            except Exception as e:
+                _whisper_registry['last_error'] = f'Не удалось загрузить черновую модель: {e}'
+                print(f"Не удалось загрузить черновую модель {WHISPER_DRAFT_MODEL_PATH}: {e}")
+                return None
+        return _whisper_registry['draft_model']
+
+@contextmanager
+def whisper_session():
+    """Borrow the cached model for one job; idle eviction skips borrowed models"""
+    with _whisper_lock:
+        processor, model = get_whisper()
+        _whisper_registry['in_use'] += 1
     try:
-        if status:
-            status['progress'] = 25
-            status['current_stage'] = 'Загрузка аудио для транскрибации'
-            status['estimated_time'] = 120
-            print("Начало транскрибации...")
-        
-        audio = librosa.load(audio_path, sr=16000)[0].astype(np.float32)
-        audio_duration = len(audio) / 16000  # в секундах
-        print(f"Загружено аудио длительностью {audio_duration:.1f} секунд")
-        
-        segment_duration = 15  # Вернем 15 секунд, т.к. будем полагаться на чанки модели
-        segments = []
-        
-        for start_time in range(0, int(audio_duration), segment_duration):
+        yield processor, model
+    finally:
+        with _whisper_lock:
+            _whisper_registry['in_use'] -= 1
+            _whisper_registry['last_used'] = time.time()
+
+def warmup_whisper():
+    """Load the model and run one tiny generate so the first real job starts hot"""
+    try:
+        with whisper_session() as (processor, model):
+            if model is None:
+                return False
+            if _whisper_registry['warmed_up']:
+                return True
+            warmup_start = time.time()
+            input_features = processor(
+                np.zeros(16000, dtype=np.float32),
+                sampling_rate=16000,
+                return_tensors="pt"
+            ).input_features.to(model.device)
+            with torch.no_grad():
+                model.generate(input_features, max_length=8, language="kazakh", task="transcribe")
+            _whisper_registry['warmed_up'] = True
+            print(f"Прогрев модели выполнен за {time.time() - warmup_start:.1f} сек")
+            return True
+    except Exception as e:
+        _whisper_registry['last_error'] = f'Ошибка прогрева: {e}'
+        print(f"Ошибка прогрева модели: {e}")
+        return False
+
+def record_real_time_factor(transcribe_seconds, audio_seconds):
+    """Fold one job's real-time factor into the registry's running average"""
+    real_time_factor = transcribe_seconds / audio_seconds
+    with _whisper_lock:
+        previous = _whisper_registry['real_time_factor']
+        _whisper_registry['real_time_factor'] = round(
+            real_time_factor if previous is None else 0.7 * previous + 0.3 * real_time_factor, 4
+        )
+    return real_time_factor
+
+def whisper_health():
+    """Snapshot of the model registry suitable for a health endpoint"""
+    registry = _whisper_registry
+    now = time.time()
+    return {
+        'model_name': registry['model_name'] or WHISPER_MODEL_NAME,
+        'backend': registry['backend'] or INFERENCE_BACKEND,
+        # Пока модель не загружалась, torch не импортирован - не импортируем его ради ответа
+        'torch_threads': torch.get_num_threads() if 'torch' in sys.modules else None,
+        'real_time_factor': registry['real_time_factor'],
+        'state': registry['state'],
+        'device': registry['device'],
+        'warmed_up': registry['warmed_up'],
+        'in_use': registry['in_use'],
+        'loads': registry['loads'],
+        'evictions': registry['evictions'],
+        'load_seconds': registry['load_seconds'],
+        'uptime_seconds': round(now - registry['loaded_at'], 1) if registry['loaded_at'] else None,
+        'idle_seconds': round(now - registry['last_used'], 1) if registry['last_used'] else None,
+        'idle_timeout': WHISPER_IDLE_TIMEOUT,
+        'draft_model_path': WHISPER_DRAFT_MODEL_PATH or None,
+        'shard_workers': SHARD_WORKERS if SHARD_WORKERS > 1 else None,
+        'speculative': speculative_summary(registry['speculative']) if registry['speculative'] else None,
+        'last_error': registry['last_error']
+    }
+
+def evict_idle_whisper(idle_timeout=None):
+    """Unload the cached model if nobody has used it for idle_timeout seconds"""
+    if idle_timeout is None:
+        idle_timeout = WHISPER_IDLE_TIMEOUT
+    with _whisper_lock:
+        if _whisper_registry['model'] is None or _whisper_registry['in_use'] > 0:
+            return False
+        if time.time() - (_whisper_registry['last_used'] or 0) < idle_timeout:
+            return False
+        _whisper_registry.update({
+            'processor': None,
+            'model': None,
+            'draft_model': None,
+            'device': None,
+            'state': 'evicted',
+            'loaded_at': None,
+            'warmed_up': False
+        })
+        _whisper_registry['evictions'] += 1
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    print(f"Модель выгружена после простоя более {idle_timeout} сек")
+    return True
+
+def start_whisper_reaper(idle_timeout=None, interval=60):
+    """Start a daemon thread that periodically evicts the idle model"""
+    global _whisper_reaper
+    if idle_timeout is None:
+        idle_timeout = WHISPER_IDLE_TIMEOUT
+    if idle_timeout <= 0 or (_whisper_reaper and _whisper_reaper.is_alive()):
+        return _whisper_reaper
+
+    def reap():
+        while True:
+            time.sleep(interval)
             try:
-                end_time = min(start_time + segment_duration, audio_duration)
-                segment_start_sample = start_time * 16000
-                segment_end_sample = int(end_time * 16000)
-                audio_segment = audio[segment_start_sample:segment_end_sample]
-                
-                if status:
-                    status['progress'] = 30 + int((start_time / audio_duration) * 40)
-                    status['current_stage'] = f'Обработка сегментов'
-                    print(f"Обработка сегмента {start_time}-{end_time} секунд")
-                
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-                
-                input_features = processor(
-                    audio_segment, 
-                    sampling_rate=16000, 
-                    return_tensors="pt"
-                ).input_features.to(model.device)
-                
-                outputs = model.generate(
-                    input_features,
-                    max_length=448,
-                    return_timestamps=True,
-                    language="kazakh",
-                    task="transcribe",
-                    num_beams=3,          # Увеличили num_beams
-                    temperature=0.2,      # Уменьшили temperature
-                    # no_repeat_ngram_size=3, # Пока закомментируем
-                    length_penalty=1.0,
-                    repetition_penalty=1.0
-                )
-                
-                result = processor.batch_decode(outputs, output_offsets=True)[0]
-                print(f"Результат декодирования сегмента {start_time}-{end_time}: {result}")
-                
-                if 'chunks' in result and result['chunks']:
-                    print(f"Найдено {len(result['chunks'])} чанков в сегменте")
-                    for chunk in result['chunks']:
-                        # Временные метки чанка относительны начала аудио_сегмента
-                        chunk_start_relative = float(chunk['timestamp'][0])
-                        chunk_end_relative = float(chunk['timestamp'][1] if chunk['timestamp'][1] else chunk['timestamp'][0] + 1.0)
-                        
-                        # Пересчитываем в абсолютные временные метки относительно всего аудио
-                        chunk_start_absolute = chunk_start_relative + start_time
-                        chunk_end_absolute = chunk_end_relative + start_time
-                        
-                        # Ограничиваем концом аудиофайла
-                        chunk_end_absolute = min(chunk_end_absolute, audio_duration)
-
-                        if chunk_start_absolute < chunk_end_absolute: # Убедимся, что чанк имеет длительность
-                            segments.append({
-                                "id": len(segments),
-                                "start": round(chunk_start_absolute, 2),
-                                "end": round(chunk_end_absolute, 2),
-                                "text": chunk['text'].strip()
-                            })
-                            print(f"Добавлен чанк: [{round(chunk_start_absolute,2)}-{round(chunk_end_absolute,2)}] {chunk['text'].strip()}")
-                elif 'text' in result and result['text'].strip(): # Если чанков нет, но есть общий текст
-                    print(f"Чанки не найдены, используем полный текст сегмента: {result['text']}")
-                    segments.append({
-                        "id": len(segments),
-                        "start": round(start_time, 2),
-                        "end": round(end_time, 2),
-                        "text": result['text'].strip()
-                    })
-                else:
-                    print(f"В сегменте {start_time}-{end_time} не найдено ни чанков, ни текста.")
-
-                del input_features
-                del outputs
-                del result
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-                
+                evict_idle_whisper(idle_timeout)
             except Exception as e:
-                print(f"Ошибка при обработке сегмента {start_time}-{end_time}: {e}")
-                import traceback
-                traceback.print_exc() # Более подробный вывод ошибки
+                print(f"Ошибка при выгрузке модели: {e}")
+
+    _whisper_reaper = threading.Thread(target=reap, name='whisper-reaper', daemon=True)
+    _whisper_reaper.start()
+    return _whisper_reaper
+ 
+def _ffmpeg_executable():
+    """ffmpeg from PATH, falling back to the binary bundled with imageio-ffmpeg"""
+    executable = shutil.which('ffmpeg')
+    if executable:
+        return executable
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return None
+
+def decode_audio_pcm(media_path, sample_rate=SAMPLE_RATE, mmap_path=None):
+    """Decode the audio track to mono 16-bit PCM by piping ffmpeg output into memory
+
+    Returns an int16 array; samples are converted to float32 only per block when
+    features are computed. With mmap_path the PCM is streamed to that file and
+    returned as a read-only np.memmap instead of being held in RAM.
+    """
+    executable = _ffmpeg_executable()
+    if executable is None:
+        raise RuntimeError('ffmpeg не найден: установите ffmpeg или imageio-ffmpeg')
+    
+    command = [
+        executable, '-nostdin', '-v', 'error',
+        '-i', media_path,
+        '-vn', '-ac', '1', '-ar', str(sample_rate),
+        '-f', 's16le', '-acodec', 'pcm_s16le', '-'
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    read_size = 1 << 20
+    
+    if mmap_path:
+        with open(mmap_path, 'wb') as f:
+            shutil.copyfileobj(process.stdout, f, read_size)
+    else:
+        pcm_bytes = bytearray()
+        while True:
+            data = process.stdout.read(read_size)
+            if not data:
+                break
+            pcm_bytes += data
+    
+    error_output = process.stderr.read().decode('utf-8', errors='replace')
+    if process.wait() != 0:
+        raise RuntimeError(f'ffmpeg завершился с кодом {process.returncode}: {error_output.strip()}')
+    
+    if mmap_path:
+        if os.path.getsize(mmap_path) < 2:
+            return np.zeros(0, dtype=np.int16)
+        return np.memmap(mmap_path, dtype=np.int16, mode='r')
+    usable = len(pcm_bytes) - len(pcm_bytes) % 2
+    return np.frombuffer(pcm_bytes, dtype=np.int16, count=usable // 2)
+
+def write_wav(pcm, path, sample_rate=SAMPLE_RATE):
+    """Write an int16 PCM buffer as a mono WAV file"""
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(np.ascontiguousarray(pcm, dtype=np.int16).tobytes())
+
+def probe_media_duration(media_path):
+    """Duration of a media file in seconds from the ffmpeg header, or None if unknown"""
+    executable = _ffmpeg_executable()
+    if executable is None:
+        return None
+    try:
+        result = subprocess.run(
+            [executable, '-nostdin', '-hide_banner', '-i', media_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=30
+        )
+    except Exception as e:
+        print(f"Не удалось определить длительность {media_path}: {e}")
+        return None
+    match = re.search(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr.decode('utf-8', errors='replace'))
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def iter_pcm_windows(pcm, window_seconds=SEGMENT_DURATION, sample_rate=SAMPLE_RATE):
+    """Yield (start, end, pcm_view) windows over an in-memory PCM buffer, including the tail"""
+    window_samples = int(window_seconds * sample_rate)
+    for sample_start in range(0, len(pcm), window_samples):
+        window = pcm[sample_start:sample_start + window_samples]
+        yield sample_start / sample_rate, (sample_start + len(window)) / sample_rate, window
+
+def stream_audio_windows(media_path, window_seconds=SEGMENT_DURATION, queue_size=None,
+                         sample_rate=SAMPLE_RATE, wav_path=None):
+    """Yield (start, end, pcm) windows while ffmpeg is still decoding the file
+
+    A decoder thread reads fixed-size int16 windows from the ffmpeg pipe into a
+    bounded queue, so transcription starts after the first window instead of
+    after the whole file and memory stays at queue_size windows. With wav_path
+    the PCM is also written to a WAV file as it streams.
+    """
+    if queue_size is None:
+        queue_size = AUDIO_QUEUE_WINDOWS
+    executable = _ffmpeg_executable()
+    if executable is None:
+        raise RuntimeError('ffmpeg не найден: установите ffmpeg или imageio-ffmpeg')
+    
+    command = [
+        executable, '-nostdin', '-v', 'error',
+        '-i', media_path,
+        '-vn', '-ac', '1', '-ar', str(sample_rate),
+        '-f', 's16le', '-acodec', 'pcm_s16le', '-'
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    windows = queue.Queue(maxsize=max(1, queue_size))
+    stop = threading.Event()
+    end_of_stream = object()
+    window_bytes = int(window_seconds * sample_rate) * 2
+    
+    def put(item):
+        while not stop.is_set():
+            try:
+                windows.put(item, timeout=0.5)
+                return True
+            except queue.Full:
                 continue
-        
-        if not segments:
-            print("Не удалось получить ни одного сегмента после полной обработки")
-            return None, None
-        
-        segments.sort(key=lambda x: x['start'])
-        
-        # Логика объединения близких сегментов (если потребуется, пока оставим простой список чанков)
-        # merged_segments = []
-        # current_segment = None
-        # for segment in segments:
-        #     if not current_segment:
-        #         current_segment = segment
-        #     else:
-        #         if (segment['start'] - current_segment['end'] < 1.0 and 
-        #             segment['end'] - current_segment['start'] < 10.0): # Макс. длина объединенного сегмента 10 сек
-        #             current_segment['end'] = segment['end']
-        #             current_segment['text'] = current_segment['text'] + " " + segment['text']
-        #         else:
-        #             merged_segments.append(current_segment)
-        #             current_segment = segment
-        # if current_segment:
-        #     merged_segments.append(current_segment)
-        # final_segments = merged_segments
-
-        final_segments = segments # Пока используем直接 чанки
+        return False
+    
+    def decode():
+        wav_file = None
+        try:
+            if wav_path:
+                wav_file = wave.open(wav_path, 'wb')
+                wav_file.setnchannels(1)
+                wav_file.setsampwidth(2)
+                wav_file.setframerate(sample_rate)
+            sample_start = 0
+            read_seconds = 0.0
+            while not stop.is_set():
+                read_start = time.perf_counter()
+                data = process.stdout.read(window_bytes)
+                read_seconds += time.perf_counter() - read_start
+                data = data[:len(data) - len(data) % 2]
+                if not data:
+                    break
+                if wav_file:
+                    wav_file.writeframes(data)
+                pcm = np.frombuffer(data, dtype=np.int16)
+                if not put((sample_start / sample_rate, (sample_start + len(pcm)) / sample_rate, pcm)):
+                    return
+                sample_start += len(pcm)
+            error_output = process.stderr.read().decode('utf-8', errors='replace')
+            if process.wait() != 0 and not stop.is_set():
+                put(RuntimeError(f'ffmpeg завершился с кодом {process.returncode}: {error_output.strip()}'))
+                return
+            # Только ожидание данных от ffmpeg, без простоя на полной очереди окон
+            STAGE_SECONDS.observe(read_seconds, stage='extraction')
+            put(end_of_stream)
+        except Exception as e:
+            put(e)
+        finally:
+            if wav_file:
+                wav_file.close()
+    
+    decoder = threading.Thread(target=decode, name='audio-decoder', daemon=True)
+    decoder.start()
+    try:
+        while True:
+            item = windows.get()
+            if item is end_of_stream:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        if process.poll() is None:
+            process.kill()
+        decoder.join(timeout=5)
 
-        if status:
-            status['progress'] = 70
-            status['current_stage'] = 'Обработка сегментов завершена (используя чанки модели)'
-            status['partial_subtitles'] = final_segments
-            print(f"Всего получено {len(final_segments)} чанков после обработки")
-        
-        full_text = " ".join(segment['text'] for segment in final_segments if segment['text'])
+class SpeechWindowizer:
+    """Energy-based VAD that turns a stream of PCM blocks into speech-aligned windows
+
+    Frame energy (dBFS, 30 ms frames) is compared with an adaptive threshold:
+    a running noise floor (10th percentile of frame energies) plus
+    VAD_MARGIN_DB, clamped to [min_db, max_db]. Windows start at speech, end
+    in the first pause of at least min_silence seconds and never exceed
+    max_seconds; when no pause fits, the window is cut at the quietest frame
+    of its last seconds instead of mid-word. Windows with less than
+    min_speech seconds of speech are dropped and never reach generate.
+    """
+
+    def __init__(self, sample_rate=SAMPLE_RATE, max_seconds=SEGMENT_DURATION, frame_seconds=0.03,
+                 min_silence=0.5, padding=0.2, min_speech=0.3, margin_db=None,
+                 min_db=-55.0, max_db=-35.0, cut_search_seconds=3.0):
+        self.sample_rate = sample_rate
+        self.frame_samples = int(frame_seconds * sample_rate)
+        self.max_frames = int(max_seconds / frame_seconds)
+        self.min_silence_frames = max(1, int(min_silence / frame_seconds))
+        self.padding_frames = int(padding / frame_seconds)
+        self.min_speech_frames = max(1, int(min_speech / frame_seconds))
+        self.cut_search_frames = max(1, int(cut_search_seconds / frame_seconds))
+        self.margin_db = VAD_MARGIN_DB if margin_db is None else margin_db
+        self.min_db = min_db
+        self.max_db = max_db
+        self.noise_floor = None
+        self.buffer = np.zeros(0, dtype=np.int16)
+        self.buffer_start = 0
+        self.skipped_samples = 0
+        self.total_samples = 0
+        self.windows = 0
+
+    def _frame_energies(self, pcm):
+        n_frames = -(-len(pcm) // self.frame_samples)
+        frames = np.zeros(n_frames * self.frame_samples, dtype=np.float32)
+        frames[:len(pcm)] = pcm
+        frames = frames.reshape(n_frames, self.frame_samples) / 32768.0
+        return 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+
+    def _speech_mask(self, energies):
+        floor = self.noise_floor if self.noise_floor is not None else self.min_db
+        threshold = min(max(floor + self.margin_db, self.min_db), self.max_db)
+        raw = energies > threshold
+        if self.padding_frames and raw.any():
+            kernel = np.ones(2 * self.padding_frames + 1)
+            return raw, np.convolve(raw.astype(np.float32), kernel, mode='same') > 0
+        return raw, raw
+
+    def _advance(self, samples, skipped):
+        self.buffer = self.buffer[samples:]
+        self.buffer_start += samples
+        if skipped:
+            self.skipped_samples += samples
+
+    def _find_end(self, speech, energies, n_frames):
+        limit = min(self.max_frames, n_frames)
+        run = 0
+        for j in range(1, min(limit + self.min_silence_frames, n_frames)):
+            if speech[j]:
+                run = 0
+                continue
+            run += 1
+            if run >= self.min_silence_frames:
+                return j - run + 1
+        if limit < self.max_frames:
+            return limit
+        # Паузы нет - режем в самом тихом кадре последних секунд окна
+        search_start = max(1, limit - self.cut_search_frames)
+        return search_start + int(np.argmin(energies[search_start:limit])) + 1
+
+    def _split(self, final):
+        fs = self.frame_samples
+        while len(self.buffer):
+            pcm = self.buffer if final else self.buffer[:len(self.buffer) // fs * fs]
+            if not len(pcm):
+                return
+            energies = self._frame_energies(pcm)
+            n_frames = len(energies)
+            raw, speech = self._speech_mask(energies)
+            speech_frames = np.flatnonzero(speech)
+            
+            if not len(speech_frames):
+                keep = 0 if final else min(n_frames, self.min_silence_frames)
+                self._advance(min(len(self.buffer), (n_frames - keep) * fs), skipped=True)
+                return
+            if speech_frames[0] > 0:
+                self._advance(int(speech_frames[0]) * fs, skipped=True)
+                continue
+            if not final and n_frames < self.max_frames + self.min_silence_frames:
+                return
+            
+            end = self._find_end(speech, energies, n_frames)
+            end_sample = min(end * fs, len(self.buffer))
+            if raw[:end].sum() < self.min_speech_frames:
+                self._advance(end_sample, skipped=True)
+                continue
+            start_time = self.buffer_start / self.sample_rate
+            window = self.buffer[:end_sample]
+            self._advance(end_sample, skipped=False)
+            self.windows += 1
+            yield start_time, self.buffer_start / self.sample_rate, window
+
+    def feed(self, pcm):
+        """Add a block of int16 PCM; yields every window that can already be closed"""
+        pcm = np.asarray(pcm, dtype=np.int16)
+        self.total_samples += len(pcm)
+        if len(pcm) >= self.frame_samples:
+            floor = float(np.percentile(self._frame_energies(pcm), 10))
+            self.noise_floor = floor if self.noise_floor is None else 0.7 * self.noise_floor + 0.3 * floor
+        self.buffer = np.concatenate([self.buffer, pcm]) if len(self.buffer) else pcm
+        yield from self._split(final=False)
+
+    def finish(self):
+        """Flush the tail of the stream, including the final partial second"""
+        yield from self._split(final=True)
+
+def speech_windows(blocks, status=None, **vad_options):
+    """Re-window a stream of (start, end, pcm) blocks along speech with SpeechWindowizer
+
+    With VAD_ENABLED=0 the blocks are passed through unchanged.
+    """
+    if not VAD_ENABLED:
+        yield from blocks
+        return
+    
+    windowizer = SpeechWindowizer(**vad_options)
+    for _, _, pcm in blocks:
+        yield from windowizer.feed(pcm)
+    yield from windowizer.finish()
+    
+    total_seconds = windowizer.total_samples / windowizer.sample_rate
+    skipped_seconds = windowizer.skipped_samples / windowizer.sample_rate
+    print(f"VAD: окон с речью {windowizer.windows}, пропущено тишины {skipped_seconds:.1f} из {total_seconds:.1f} сек")
+    if status:
+        status['vad_skipped_seconds'] = round(skipped_seconds, 1)
+
+def _mel_filters(feature_extractor):
+    """Mel filterbank as a (n_mels, n_freq) tensor regardless of transformers version"""
+    mel_filters = torch.from_numpy(np.asarray(feature_extractor.mel_filters, dtype=np.float32))
+    if mel_filters.shape[0] == feature_extractor.n_fft // 2 + 1:
+        mel_filters = mel_filters.T
+    return mel_filters.contiguous()
+
+def window_log_mel(pcm, feature_extractor, mel_filters=None, window=None):
+    """Encoder input of one window, the same as WhisperFeatureExtractor computes it
+
+    The window is zero-padded to 30 s, run through a centered STFT with
+    reflect padding (last frame dropped) and the mel filterbank, then
+    clamped to 8 below its own maximum and scaled. Frames whose STFT window
+    lies entirely in the zero padding are log10(1e-10) = -10, so they are
+    filled instead of computed. Returns a (n_mels, nb_max_frames) tensor.
+    """
+    n_fft = feature_extractor.n_fft
+    n_frames = feature_extractor.nb_max_frames
+    if mel_filters is None:
+        mel_filters = _mel_filters(feature_extractor)
+    if window is None:
+        window = torch.hann_window(n_fft)
+    
+    samples = np.asarray(pcm[:feature_extractor.n_samples])
+    if samples.dtype == np.int16:
+        # PCM переводим во float32 только для текущего окна
+        samples = samples.astype(np.float32) / 32768.0
+    # После len + n_fft идут одни нули: отражение на краю этого отрезка тоже даёт нули, как в полном окне
+    audio = torch.zeros(min(feature_extractor.n_samples, len(samples) + n_fft), dtype=torch.float32)
+    audio[:len(samples)] = torch.from_numpy(np.ascontiguousarray(samples, dtype=np.float32))
+    
+    with torch.no_grad():
+        stft = torch.stft(audio, n_fft, feature_extractor.hop_length, window=window,
+                          center=True, pad_mode='reflect', return_complex=True)
+        computed = min(n_frames, stft.shape[1])
+        log_mel = torch.full((mel_filters.shape[0], n_frames), -10.0)
+        log_mel[:, :computed] = torch.clamp(mel_filters @ (stft[:, :computed].abs() ** 2), min=1e-10).log10()
+        log_mel = torch.maximum(log_mel, log_mel.max() - 8.0)
+    return (log_mel + 4.0) / 4.0
+
+def window_features(pcms, feature_extractor):
+    """(batch, n_mels, nb_max_frames) encoder inputs for a batch of window PCM buffers"""
+    mel_filters = _mel_filters(feature_extractor)
+    window = torch.hann_window(feature_extractor.n_fft)
+    return torch.stack([window_log_mel(pcm, feature_extractor, mel_filters, window) for pcm in pcms])
+
+class RepetitionGuard:
+    """Force end-of-text for sequences stuck in a repetition loop or over their token budget
+
+    A logits processor by duck typing: LogitsProcessorList only calls it, so it
+    does not need the transformers base class (imported lazily, see _LazyModule).
+
+    A row is stopped when its text tokens (timestamps ignored) end with the
+    same fragment of up to max_period tokens repeated min_repeats times, or
+    when it has produced more tokens than base_tokens + tokens_per_second *
+    window length. fired maps the batch index of every stopped window to the
+    reason, so the caller can re-decode just those windows.
+    """
+
+    def __init__(self, window_seconds, num_beams, eos_token_id, timestamp_begin,
+                 max_period=8, min_repeats=4, tokens_per_second=12, base_tokens=16):
+        self.budgets = [int(base_tokens + tokens_per_second * seconds) for seconds in window_seconds]
+        self.num_beams = num_beams
+        self.eos_token_id = eos_token_id
+        self.timestamp_begin = timestamp_begin
+        self.max_period = max_period
+        self.min_repeats = min_repeats
+        self.prompt_length = None
+        self.fired = {}
+
+    def _looping(self, tokens):
+        text_tokens = [token for token in tokens if token < self.timestamp_begin]
+        for period in range(1, self.max_period + 1):
+            span = period * self.min_repeats
+            if len(text_tokens) < span:
+                break
+            tail = text_tokens[-span:]
+            if all(tail[i] == tail[i % period] for i in range(period, span)):
+                return True
+        return False
+
+    def __call__(self, input_ids, scores):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+        generated = input_ids.shape[1] - self.prompt_length
+        if generated < self.min_repeats:
+            return scores
         
-        return full_text, final_segments
+        rows = input_ids[:, self.prompt_length:].tolist()
+        for row, tokens in enumerate(rows):
+            item = row // self.num_beams
+            if tokens and tokens[-1] == self.eos_token_id:
+                continue
+            if generated >= self.budgets[item]:
+                reason = 'token_budget'
+            elif self._looping(tokens):
+                reason = 'repetition'
+            else:
+                continue
+            scores[row, :] = -float('inf')
+            scores[row, self.eos_token_id] = 0.0
+            self.fired.setdefault(item, reason)
+        return scores
+
+def _repetition_guard(windows, model, num_beams):
+    generation_config = model.generation_config
+    return RepetitionGuard(
+        [end_time - start_time for start_time, end_time in windows],
+        num_beams,
+        generation_config.eos_token_id,
+        generation_config.no_timestamps_token_id + 1,
+        **REPETITION_GUARD_PARAMS
+    )
+
+def _whisper_logits_processors(generation_config, begin_index, device, extra=()):
+    """The processors generate applies to greedy Whisper decoding with timestamps, in the same order"""
+    processors = transformers.LogitsProcessorList()
+    if generation_config.begin_suppress_tokens:
+        processors.append(transformers.SuppressTokensAtBeginLogitsProcessor(
+            generation_config.begin_suppress_tokens, begin_index=begin_index, device=device))
+    if generation_config.suppress_tokens:
+        processors.append(transformers.SuppressTokensLogitsProcessor(generation_config.suppress_tokens, device=device))
+    processors.append(transformers.WhisperTimeStampLogitsProcessor(generation_config, begin_index=begin_index))
+    processors.extend(extra)
+    return processors
+
+def _decoder_step(model, encoder_states, input_ids, cache):
+    outputs = model(encoder_outputs=(encoder_states,), decoder_input_ids=input_ids,
+                    past_key_values=cache, use_cache=True)
+    return outputs.logits[0], outputs.past_key_values
+
+def _crop_cache(cache, length):
+    """Drop the cached positions after the first length ones
+
+    A negative crop (tokens to remove) means the same in every transformers
+    version; a positive one (the length to keep) is deprecated in 5.x.
+    """
+    excess = cache.get_seq_length() - length
+    if excess > 0:
+        cache.crop(-excess)
+
+def _speculative_pass(input_features, prompt, model, draft, target_processors, draft_processors, max_length,
+                      draft_tokens, counters):
+    """One greedy decoding pass over a 30 s feature block; returns the new tokens, end-of-text included"""
+    eos_token_id = model.generation_config.eos_token_id
+    device = model.device
+    target_states = model.get_encoder()(input_features).last_hidden_state
+    draft_states = draft.get_encoder()(input_features.to(draft.dtype)).last_hidden_state
+    draft_cache = None
+    ids = torch.tensor([prompt], device=device)
+
+    # Первый токен: проход основной модели по всему промпту
+    logits, target_cache = _decoder_step(model, target_states, ids, None)
+    next_token = target_processors(ids, logits[-1:]).argmax(-1, keepdim=True)
+    ids = torch.cat([ids, next_token], dim=1)
+    counters['target_passes'] += 1
+
+    while ids[0, -1].item() != eos_token_id and ids.shape[1] < max_length:
+        # Черновая модель жадно предлагает до draft_tokens токенов
+        candidates = ids
+        draft_seen = draft_cache.get_seq_length() if draft_cache is not None else 0
+        for _ in range(min(draft_tokens, max_length - ids.shape[1] - 1)):
+            draft_logits, draft_cache = _decoder_step(draft, draft_states, candidates[:, draft_seen:], draft_cache)
+            draft_seen = candidates.shape[1]
+            token = draft_processors(candidates, draft_logits[-1:]).argmax(-1, keepdim=True)
+            candidates = torch.cat([candidates, token], dim=1)
+            if token.item() == eos_token_id:
+                break
+        proposal_length = candidates.shape[1] - ids.shape[1]
+        counters['draft_tokens'] += proposal_length
+
+        # Основная модель проверяет все предложенные токены одним проходом
+        target_seen = target_cache.get_seq_length()
+        logits, target_cache = _decoder_step(model, target_states, candidates[:, target_seen:], target_cache)
+        logits = logits[-(proposal_length + 1):]
+        counters['target_passes'] += 1
+        matched = 0
+        for i in range(proposal_length + 1):
+            prefix = candidates[:, :ids.shape[1] + i]
+            token = target_processors(prefix, logits[i:i + 1]).argmax(-1, keepdim=True)
+            if i < proposal_length and token.item() == candidates[0, ids.shape[1] + i].item():
+                matched += 1
+                if token.item() == eos_token_id:
+                    break
+                continue
+            break
+        counters['accepted_tokens'] += matched
+        verified = ids.shape[1] + matched
+        ids = candidates[:, :verified]
+        if matched == proposal_length and ids[0, -1].item() == eos_token_id:
+            break
+        ids = torch.cat([ids, token], dim=1)
+        # Отбрасываем из кэшей позиции отвергнутых токенов
+        _crop_cache(target_cache, verified)
+        if draft_cache is not None:
+            _crop_cache(draft_cache, verified)
+    return ids[0, len(prompt):].tolist()
+
+def _segment_cut(tokens, timestamp_begin, seek_frames, input_stride):
+    """Tokens generate keeps from one decoding pass and how many feature frames it then skips
+
+    The same rule as WhisperGenerationMixin._retrieve_segment: a pass that
+    does not end with a single timestamp is cut after its last pair of
+    timestamps, and decoding resumes from that time; otherwise the whole
+    block is consumed.
+    """
+    is_timestamp = [token >= timestamp_begin for token in tokens]
+    pairs = [i + 1 for i in range(len(tokens) - 1) if is_timestamp[i] and is_timestamp[i + 1]]
+    if not pairs or is_timestamp[-2:] == [False, True]:
+        return tokens, seek_frames
+    last = pairs[-1] + 1
+    return tokens[:last], (tokens[last - 2] - timestamp_begin) * input_stride
+
+def speculative_generate(input_features, processor, model, draft, logits_processor=(), max_length=None,
+                         draft_tokens=None, stats=None):
+    """Greedy decoding of one window where the draft model proposes tokens and model verifies them
+
+    Every token is still chosen as the argmax of model's processed logits,
+    and the passes are cut and continued ("seek") the way Whisper's generate
+    does it: a pass that stops in the middle of a segment is cut after its
+    last pair of timestamps and decoding starts again from that point of the
+    audio. So the output (timestamps included) is the same as model.generate
+    with GREEDY_DECODING_PARAMS for a single window (Whisper samples at any
+    temperature above zero); the draft only decides how many tokens one
+    forward pass of the large model can confirm. Up to floating-point ties:
+    verifying several tokens at once may round differently from one-token
+    steps. logits_processor runs after the standard Whisper processors, on
+    the verified positions only. stats is updated with generated_tokens,
+    target_passes, draft_tokens, accepted_tokens and windows.
+    """
+    generation_config = model.generation_config
+    max_length = max_length or DECODING_PARAMS['max_length']
+    draft_tokens = max(1, draft_tokens or SPECULATIVE_DRAFT_TOKENS)
+    prompt = [generation_config.decoder_start_token_id] + [
+        token for _, token in processor.get_decoder_prompt_ids(
+            language=DECODING_PARAMS['language'], task=DECODING_PARAMS['task'], no_timestamps=False)
+    ]
+    begin_index = len(prompt)
+    # Как и generate у Whisper, max_length ограничивает число новых токенов
+    max_length = min(begin_index + max_length, model.config.max_target_positions)
+    eos_token_id = generation_config.eos_token_id
+    timestamp_begin = generation_config.no_timestamps_token_id + 1
+    device = model.device
+    # Признаки каждого прохода - блок по 30 сек; кадров признаков на позицию энкодера
+    segment_frames = processor.feature_extractor.nb_max_frames
+    input_stride = model.model.encoder.conv1.stride[0] * model.model.encoder.conv2.stride[0]
+    total_frames = input_features.shape[-1]
+    counters = {'target_passes': 0, 'draft_tokens': 0, 'accepted_tokens': 0}
+
+    tokens = []
+    seek = 0
+    with torch.no_grad():
+        while seek < total_frames:
+            block = input_features[..., seek:seek + segment_frames]
+            if block.shape[-1] < segment_frames:
+                block = torch.nn.functional.pad(block, (0, segment_frames - block.shape[-1]))
+            target_processors = _whisper_logits_processors(generation_config, begin_index, device, logits_processor)
+            draft_processors = _whisper_logits_processors(generation_config, begin_index, device)
+            generated = _speculative_pass(block, prompt, model, draft, target_processors, draft_processors,
+                                          max_length, draft_tokens, counters)
+            if generated and generated[-1] == eos_token_id:
+                generated = generated[:-1]
+            seek_frames = min(total_frames - seek, segment_frames)
+            kept, offset = _segment_cut(generated, timestamp_begin, seek_frames, input_stride)
+            tokens += kept
+            # Пара <|0.00|><|0.00|> не сдвинула бы seek - generate зациклился бы, мы переходим к следующему блоку
+            seek += offset if offset > 0 else seek_frames
+
+    if stats is not None:
+        stats['generated_tokens'] = stats.get('generated_tokens', 0) + len(tokens)
+        for key, value in counters.items():
+            stats[key] = stats.get(key, 0) + value
+        stats['windows'] = stats.get('windows', 0) + 1
+    return torch.tensor([tokens], dtype=torch.long, device=device)
+
+def speculative_summary(stats):
+    """Acceptance rate and tokens confirmed per large-model pass from speculative_generate counters"""
+    summary = dict(stats)
+    summary['acceptance_rate'] = round(stats['accepted_tokens'] / stats['draft_tokens'], 4) \
+        if stats.get('draft_tokens') else None
+    summary['tokens_per_target_pass'] = round(stats['generated_tokens'] / stats['target_passes'], 3) \
+        if stats.get('target_passes') else None
+    return summary
+
+def record_speculative_stats(stats):
+    """Fold one job's speculative decoding counters into the registry totals"""
+    with _whisper_lock:
+        totals = _whisper_registry['speculative'] or {}
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+        _whisper_registry['speculative'] = totals
+
+def _count_tokens(sequences, model):
+    """Tokens in generate output, not counting padding"""
+    sequences = getattr(sequences, 'sequences', sequences)
+    pad_token_id = model.generation_config.pad_token_id
+    if pad_token_id is None:
+        return int(sequences.numel())
+    return int((sequences != pad_token_id).sum())
+
+def _generate_windows(input_features, windows, processor, model, events=None, draft_model=None, speculative_stats=None):
+    """Run one batched generate over the features of several (start, end) windows and decode each with offsets
+
+    Windows whose beam search was cut short by RepetitionGuard are decoded
+    once more greedily (still guarded); each such event is appended to events
+    as {'index', 'reason', 'fallback_stopped'}. With a draft_model the windows
+    are decoded one by one with speculative_generate (greedy, so there is no
+    fallback and events carry only 'index' and 'reason').
+    """
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    
+    input_features = input_features.to(model.device)
+    
+    if draft_model is not None:
+        results = []
+        for row, window in enumerate(windows):
+            guard = _repetition_guard([window], model, 1)
+            generate_start = time.perf_counter()
+            tokens = speculative_generate(input_features[row:row + 1], processor, model, draft_model,
+                                          [guard], stats=speculative_stats)
+            elapsed = time.perf_counter() - generate_start
+            STAGE_SECONDS.observe(elapsed, stage='generate')
+            WINDOW_GENERATE_SECONDS.observe(elapsed)
+            TOKENS_TOTAL.inc(_count_tokens(tokens, model))
+            with STAGE_SECONDS.time(stage='batch_decode'):
+                results.extend(decode_with_offsets(processor, tokens))
+            if guard.fired and events is not None:
+                events.append({'index': row, 'reason': guard.fired[0]})
+        del input_features
+        return results
+    
+    guard = _repetition_guard(windows, model, DECODING_PARAMS.get('num_beams', 1))
+    generate_start = time.perf_counter()
+    with torch.no_grad():
+        outputs = model.generate(input_features, logits_processor=transformers.LogitsProcessorList([guard]), **DECODING_PARAMS)
+    elapsed = time.perf_counter() - generate_start
+    STAGE_SECONDS.observe(elapsed, stage='generate')
+    for _ in windows:
+        WINDOW_GENERATE_SECONDS.observe(elapsed / len(windows))
+    TOKENS_TOTAL.inc(_count_tokens(outputs, model))
+    
+    with STAGE_SECONDS.time(stage='batch_decode'):
+        results = decode_with_offsets(processor, outputs)
+    
+    if guard.fired:
+        rows = sorted(guard.fired)
+        print(f"Зацикливание generate в окнах {rows}: повтор жадным декодированием")
+        REPETITION_FALLBACKS.inc(len(rows))
+        greedy_guard = _repetition_guard([windows[row] for row in rows], model, 1)
+        with STAGE_SECONDS.time(stage='generate_fallback'), torch.no_grad():
+            greedy_outputs = model.generate(
+                input_features[rows],
+                logits_processor=transformers.LogitsProcessorList([greedy_guard]),
+                **GREEDY_DECODING_PARAMS
+            )
+        TOKENS_TOTAL.inc(_count_tokens(greedy_outputs, model))
+        for i, result in enumerate(decode_with_offsets(processor, greedy_outputs)):
+            results[rows[i]] = result
+            if events is not None:
+                events.append({
+                    'index': rows[i],
+                    'reason': guard.fired[rows[i]],
+                    'fallback_stopped': greedy_guard.fired.get(i)
+                })
+        del greedy_outputs
+    
+    del input_features
+    del outputs
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    
+    return results
+
+def decode_with_offsets(processor, sequences):
+    """{'text', 'offsets'} of every row of generated token ids
+
+    Rows are decoded one at a time: batch_decode with output_offsets only
+    handles a list of sequences in transformers 4.x, 5.x passes the whole
+    batch to the offset computation, which accepts a single sequence.
+    """
+    return [processor.decode(row, skip_special_tokens=True, output_offsets=True) for row in sequences]
+
+def _append_window_chunks(result, start_time, end_time, audio_duration, segments):
+    """Map the timestamped offsets of one decoded window to absolute time and append them to segments
+
+    result is decode_with_offsets output: each offset has a (start, end)
+    timestamp relative to the window start. Text after the last closing
+    timestamp (a window cut mid-sentence) becomes a segment up to the window
+    end; a window decoded without any timestamps becomes a single segment.
+    """
+    print(f"Результат декодирования сегмента {start_time}-{end_time}: {result}")
+    end_limit = min(end_time, audio_duration) if audio_duration else end_time
+    text = result.get('text') or ''
+    covered = ''
+    last_end = start_time
+    
+    for offset in result.get('offsets') or []:
+        covered += offset['text']
+        chunk_text = offset['text'].strip()
+        # Временные метки относительны начала окна; конец ограничиваем окном и концом аудио
+        chunk_start = start_time + float(offset['timestamp'][0])
+        chunk_end = min(start_time + float(offset['timestamp'][1]), end_limit)
+        if chunk_text and chunk_start < chunk_end:
+            segments.append({
+                "id": len(segments),
+                "start": round(chunk_start, 2),
+                "end": round(chunk_end, 2),
+                "text": chunk_text
+            })
+            last_end = chunk_end
+    
+    rest = text[len(covered):] if text.startswith(covered) else ''
+    if rest.strip() and last_end < end_limit:
+        segments.append({
+            "id": len(segments),
+            "start": round(last_end, 2),
+            "end": round(end_limit, 2),
+            "text": rest.strip()
+        })
+
+def _transcribe_batch(batch, processor, model, segments, status=None, audio_duration=None,
+                      draft_model=None, speculative_stats=None, journal=None):
+    """Transcribe one batch of (start, end, pcm) windows and append their chunks to segments
+
+    Returns the number of seconds spent on feature extraction.
+    """
+    span_start = batch[0][0]
+    span_end = batch[-1][1]
     
+    if status:
+        if audio_duration:
+            status['progress'] = 30 + int((span_start / audio_duration) * 40)
+        status['current_stage'] = f'Обработка сегментов'
+        print(f"Обработка сегментов {span_start}-{span_end} секунд ({len(batch)} окон)")
+    
+    feature_start = time.time()
+    windows = [(start_time, end_time) for start_time, end_time, _ in batch]
+    input_features = window_features([pcm for _, _, pcm in batch], processor.feature_extractor)
+    feature_seconds = time.time() - feature_start
+    STAGE_SECONDS.observe(feature_seconds, stage='features')
+    WINDOWS_TOTAL.inc(len(batch))
+    for _, _, pcm in batch:
+        WINDOW_AUDIO_SECONDS.observe(len(pcm) / SAMPLE_RATE)
+        AUDIO_SECONDS.inc(len(pcm) / SAMPLE_RATE)
+    
+    events = []
+    try:
+        results = _generate_windows(input_features, windows, processor, model, events, draft_model, speculative_stats)
     except Exception as e:
-        print(f"Критическая ошибка транскрибации: {e}")
+        SWALLOWED_EXCEPTIONS.inc(where='batch', type=type(e).__name__)
+        print(f"Ошибка при пакетной обработке сегментов {span_start}-{span_end}: {e}")
         import traceback
-        traceback.print_exc()
-        return None, None
- 
+        traceback.print_exc() # Более подробный вывод ошибки
+        if len(batch) == 1:
+            return feature_seconds
+        # Повторяем окна по одному, чтобы одно плохое окно не потеряло весь батч
+        results = []
+        events = []
+        for index, window in enumerate(windows):
+            try:
+                window_events = []
+                results.extend(_generate_windows(input_features[index:index + 1], [window], processor, model, window_events,
+                                                 draft_model, speculative_stats))
+                events.extend(dict(event, index=index) for event in window_events)
+            except Exception as window_error:
+                SWALLOWED_EXCEPTIONS.inc(where='window', type=type(window_error).__name__)
+                print(f"Ошибка при обработке сегмента {window[0]}-{window[1]}: {window_error}")
+                results.append(None)
+    
+    for event in events:
+        start_time, end_time, _ = batch[event.pop('index')]
+        event.update({'start': round(start_time, 2), 'end': round(end_time, 2)})
+        print(f"Ранняя остановка generate в окне {event['start']}-{event['end']}: {event['reason']}")
+        if status:
+            status['repetition_events'] = status.get('repetition_events', []) + [event]
+    
+    for (start_time, end_time, _), result in zip(batch, results):
+        if result is not None:
+            produced = len(segments)
+            _append_window_chunks(result, start_time, end_time, audio_duration or end_time, segments)
+            SEGMENTS_TOTAL.inc(len(segments) - produced)
+            if journal is not None:
+                journal.record(start_time, end_time, segments[produced:])
+    
+    return feature_seconds
+
+def transcribe_windows(windows, processor, model, status=None, batch_size=None, audio_duration=None,
+                       draft_model=None, journal=None):
+    """Transcribe an iterable of (start, end, pcm) windows as they arrive
+
+    Windows are grouped batch_size at a time (WHISPER_BATCH_SIZE by default),
+    one generate and one decode pass per batch. Yields the list of segments
+    each batch produced, so callers can chunk and publish them immediately.
+    With a draft_model every window is decoded greedily by speculative_generate
+    and the acceptance statistics end up in status['speculative_decoding'].
+    With a journal (TranscriptionJournal) every finished window is recorded,
+    and windows it already holds are replayed instead of transcribed.
+    """
+    if batch_size is None:
+        batch_size = WHISPER_BATCH_SIZE
+    batch_size = max(1, int(batch_size))
+    
+    segments = []
+    feature_seconds = 0.0
+    batch = []
+    generate_calls = 0
+    resumed_windows = 0
+    speculative_stats = {} if draft_model is not None else None
+    
+    def run(batch):
+        nonlocal feature_seconds, generate_calls
+        produced = len(segments)
+        feature_seconds += _transcribe_batch(batch, processor, model, segments, status, audio_duration,
+                                             draft_model, speculative_stats, journal)
+        generate_calls += 1
+        return segments[produced:]
+    
+    for window in windows:
+        replayed = journal.lookup(window[0], window[1]) if journal is not None else None
+        if replayed is not None:
+            # Окно уже есть в журнале: досчитываем накопленный батч, чтобы не нарушить порядок
+            if batch:
+                yield run(batch)
+                batch = []
+            produced = len(segments)
+            segments.extend(dict(segment, id=len(segments) + i) for i, segment in enumerate(replayed))
+            resumed_windows += 1
+            yield segments[produced:]
+            continue
+        batch.append(window)
+        if len(batch) < batch_size:
+            continue
+        yield run(batch)
+        batch = []
+    
+    if batch:
+        yield run(batch)
+    
+    if resumed_windows:
+        print(f"Из журнала восстановлено окон: {resumed_windows}")
+        if status:
+            status['resumed_windows'] = resumed_windows
+    print(f"Вызовов generate: {generate_calls}, время вычисления признаков: {feature_seconds:.2f} сек")
+    if status:
+        status['feature_seconds'] = round(feature_seconds, 2)
+    if speculative_stats:
+        record_speculative_stats(speculative_stats)
+        summary = speculative_summary(speculative_stats)
+        print(f"Спекулятивное декодирование: доля принятых черновых токенов {summary['acceptance_rate']}, "
+              f"{summary['tokens_per_target_pass']} токенов на проход основной модели")
+        if status:
+            status['speculative_decoding'] = summary
+
+def shard_thread_budget(workers):
+    """torch threads per shard process: SHARD_THREADS, or the cores split evenly between workers"""
+    return SHARD_THREADS or max(1, (os.cpu_count() or 1) // workers)
+
+def _init_shard_worker(num_threads):
+    global TORCH_NUM_THREADS, TORCH_INTEROP_THREADS
+    # initialize_whisper снова вызывает configure_torch_threads - бюджет должен пережить загрузку модели
+    TORCH_NUM_THREADS, TORCH_INTEROP_THREADS = num_threads, 1
+    configure_torch_threads()
+
+def _peak_rss_mb():
+    try:
+        import resource
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    except (ImportError, OSError):
+        return None
+
+def _transcribe_shard(windows, audio_duration):
+    """Shard process side: transcribe a group of (start, end, pcm) windows with this process's model"""
+    processor, model = get_whisper()
+    if model is None:
+        raise RuntimeError(f'Не удалось загрузить модель {WHISPER_MODEL_NAME} в процессе {os.getpid()}')
+    status = {'shard_pid': os.getpid()}
+    segments = []
+    for new_segments in transcribe_windows(windows, processor, model, status, len(windows),
+                                           audio_duration, get_draft_whisper()):
+        segments.extend(new_segments)
+    speculative = status.get('speculative_decoding') or {}
+    return {
+        # Метрики процесса с прошлой группы - родитель добавит их к своим
+        'metrics': METRICS.snapshot(reset=True),
+        'segments': segments,
+        'repetition_events': status.get('repetition_events', []),
+        'speculative': {key: value for key, value in speculative.items()
+                        if key not in ('acceptance_rate', 'tokens_per_target_pass')},
+        'pid': os.getpid(),
+        'peak_rss_mb': _peak_rss_mb()
+    }
+
+def get_shard_pool(workers=None):
+    """Process-wide pool of shard processes; each keeps its model loaded between jobs"""
+    global _shard_pool
+    workers = workers or SHARD_WORKERS
+    with _shard_pool_lock:
+        if _shard_pool is not None and _shard_pool._max_workers != workers:
+            _shard_pool.shutdown(wait=True)
+            _shard_pool = None
+        if _shard_pool is None:
+            threads = shard_thread_budget(workers)
+            print(f"Запуск {workers} процессов транскрибации по {threads} потоков torch")
+            _shard_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_shard_worker,
+                initargs=(threads,)
+            )
+        return _shard_pool
+
+def shutdown_shard_pool():
+    """Stop the shard processes; called on exit and when a worker or batch run ends"""
+    global _shard_pool
+    with _shard_pool_lock:
+        if _shard_pool is not None:
+            _shard_pool.shutdown(wait=True)
+            _shard_pool = None
+
+# Веб-сервер не знает, когда закончилось последнее задание - пул закрывается при выходе
+atexit.register(shutdown_shard_pool)
+
+def transcribe_windows_sharded(windows, status=None, audio_duration=None, workers=None, batch_size=None,
+                               journal=None):
+    """Transcribe (start, end, pcm) windows across a pool of processes
+
+    Windows are grouped and handed to idle processes as they arrive (at most
+    two groups per process in flight, so memory stays bounded); groups are
+    small enough that a file of audio_duration seconds keeps every process
+    busy. Results are yielded per group in window order, so the segments come
+    out in timestamp order, renumbered as one sequence. The journal, if any,
+    is kept by this (parent) process exactly as in transcribe_windows.
+    """
+    workers = workers or SHARD_WORKERS
+    batch_size = max(1, int(batch_size or WHISPER_BATCH_SIZE))
+    if audio_duration:
+        expected_windows = -(-audio_duration // SEGMENT_DURATION)
+        batch_size = max(1, min(batch_size, int(-(-expected_windows // workers))))
+    pool = get_shard_pool(workers)
+
+    pending = deque()
+    produced = 0
+    resumed_windows = 0
+    speculative = {}
+    shard_processes = {}
+
+    def collect(item):
+        nonlocal produced
+        group_windows, future = item
+        if future is None:
+            # Окно из журнала
+            replayed = [dict(segment, id=produced + i) for i, segment in enumerate(group_windows)]
+            produced += len(replayed)
+            return replayed
+        result = future.result()
+        if journal is not None:
+            # Сегмент относится к последнему окну, начавшемуся не позже него
+            for index, (start_time, end_time) in enumerate(group_windows):
+                next_start = group_windows[index + 1][0] if index + 1 < len(group_windows) else float('inf')
+                journal.record(start_time, end_time, [segment for segment in result['segments']
+                                                      if (index == 0 or segment['start'] >= start_time)
+                                                      and segment['start'] < next_start])
+        for segment in result['segments']:
+            segment['id'] = produced
+            produced += 1
+        METRICS.merge(result['metrics'])
+        for key, value in result['speculative'].items():
+            speculative[key] = speculative.get(key, 0) + value
+        shard_processes[result['pid']] = result['peak_rss_mb']
+        if status:
+            if result['repetition_events']:
+                status['repetition_events'] = status.get('repetition_events', []) + result['repetition_events']
+            if audio_duration and result['segments']:
+                status['progress'] = 30 + int((result['segments'][-1]['end'] / audio_duration) * 40)
+            status['current_stage'] = f'Обработка сегментов ({workers} процессов)'
+        return result['segments']
+
+    def submit(group):
+        pending.append(([(start_time, end_time) for start_time, end_time, _ in group],
+                        pool.submit(_transcribe_shard, group, audio_duration)))
+
+    group = []
+    for window in windows:
+        replayed = journal.lookup(window[0], window[1]) if journal is not None else None
+        if replayed is not None:
+            if group:
+                submit(group)
+                group = []
+            pending.append((replayed, None))
+            resumed_windows += 1
+        else:
+            group.append(window)
+            if len(group) < batch_size:
+                continue
+            submit(group)
+            group = []
+        while pending and (len(pending) >= 2 * workers or pending[0][1] is None or pending[0][1].done()):
+            yield collect(pending.popleft())
+    if group:
+        submit(group)
+    while pending:
+        yield collect(pending.popleft())
+    if resumed_windows:
+        print(f"Из журнала восстановлено окон: {resumed_windows}")
+        if status:
+            status['resumed_windows'] = resumed_windows
+
+    print(f"Шардированная транскрибация: {workers} процессов, пиковая память (МБ): {shard_processes}")
+    if speculative:
+        record_speculative_stats(speculative)
+    if status:
+        status['shards'] = {
+            'workers': workers,
+            'threads_per_worker': shard_thread_budget(workers),
+            'peak_rss_mb': max((rss for rss in shard_processes.values() if rss), default=None)
+        }
+        if speculative:
+            status['speculative_decoding'] = speculative_summary(speculative)
+
+class SmartChunker:
+   """Incremental hybrid chunker combining sentence structure and duration limits
+
+   feed() takes one transcribed segment at a time and yields every chunk it
+   closes; finish() yields the last open chunk. Sentences are found with one
+   precompiled pattern and their times come from running character offsets
+   within the segment, so the work is linear in the transcript length and
+   repeated sentences get their own times.
+   """
+
+   SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+
+   def __init__(self, max_duration=8.0, max_sentences=3, first_id=0):
+       self.max_duration = max_duration
+       self.max_sentences = max_sentences
+       self.next_id = first_id
+       self.current = []
+
+   def _sentences(self, text):
+       position = 0
+       for boundary in self.SENTENCE_BOUNDARY.finditer(text):
+           yield position, text[position:boundary.start()]
+           position = boundary.end()
+       yield position, text[position:]
+
+   def _close(self):
+       chunk = {
+           "id": self.next_id,
+           "start": self.current[0]['start'],
+           "end": self.current[-1]['end'],
+           "text": " ".join(s['text'] for s in self.current)
+       }
+       self.next_id += 1
+       self.current = []
+       return chunk
+
+   def feed(self, seg):
+       text = seg['text']
+       time_per_char = (seg['end'] - seg['start']) / len(text) if text else 0
+       
+       for offset, sentence in self._sentences(text):
+           if not sentence:
+               continue
+           
+           sentence_start = seg['start'] + time_per_char * offset
+           sentence_end = sentence_start + time_per_char * len(sentence)
+           
+           if (self.current and
+               ((sentence_end - self.current[0]['start'] > self.max_duration) or
+                (len(self.current) >= self.max_sentences) or
+                sentence.endswith(('.', '!', '?')))):
+               yield self._close()
+           
+           self.current.append({
+               "text": sentence,
+               "start": round(float(sentence_start), 2),
+               "end": round(float(sentence_end), 2)
+           })
+
+   def finish(self):
+       if self.current:
+           yield self._close()
+
+def iter_smart_chunks(segments, max_duration=8.0, max_sentences=3):
+   """Hybrid approach combining sentence structure and duration limits
+
+   Consumes segments lazily from any iterable (for example, straight from
+   transcribe_windows) and yields each chunk as soon as it is closed.
+   """
+   chunker = SmartChunker(max_duration, max_sentences)
+   for seg in segments:
+       yield from chunker.feed(seg)
+   yield from chunker.finish()
+
 def smart_chunking(segments, max_duration=8.0, max_sentences=3, status=None):
    """Hybrid approach combining sentence structure and duration limits"""
    if status:
        status['progress'] = 70
        status['current_stage'] = 'Создание умных чанков'
        status['estimated_time'] = 30
+       status['partial_subtitles'] = []
    
    chunks = []
-   current_chunk = []
-   
-   total_segments = len(segments)
-   processed_sentences = 0
-   total_sentences = sum(len(re.split(r'(?<=[.!?])\s+', seg['text'])) for seg in segments)
+   total_end = segments[-1]['end'] if segments else 0
    
-   for i, seg in enumerate(segments):
+   for chunk in iter_smart_chunks(segments, max_duration, max_sentences):
+       chunks.append(chunk)
        if status:
-           segment_progress = min(15, 15 * (i / total_segments))
-           status['progress'] = 70 + segment_progress
-           status['current_stage'] = f'Создание умных чанков (сегмент {i+1}/{total_segments})'
-       
-       sentences = re.split(r'(?<=[.!?])\s+', seg['text'])
-       time_per_char = (seg['end'] - seg['start']) / len(seg['text']) if seg['text'] else 0
-       
-       for j, sentence in enumerate(sentences):
-           processed_sentences += 1
-           
-           if not sentence:
-               continue
-               
-           sentence_start = seg['start'] + (time_per_char * seg['text'].find(sentence))
-           sentence_end = sentence_start + (time_per_char * len(sentence))
-           
-           sentence_data = {
-               "text": sentence,
-               "start": round(float(sentence_start), 2),
-               "end": round(float(sentence_end), 2)
-           }
-           
-           if (current_chunk and
-               ((sentence_end - current_chunk[0]['start'] > max_duration) or
-                (len(current_chunk) >= max_sentences) or
-                sentence.endswith(('.', '!', '?')))):
-               
-               chunks.append({
-                   "id": len(chunks),
-                   "start": current_chunk[0]['start'],
-                   "end": current_chunk[-1]['end'],
-                   "text": " ".join(s['text'] for s in current_chunk)
-               })
-               
-               if status:
-                   sentence_progress = min(20, 20 * (processed_sentences / total_sentences))
-                   status['progress'] = 70 + sentence_progress
-                   status['partial_subtitles'] = chunks
-                   status['current_stage'] = f'Создание умных чанков ({len(chunks)} чанков создано)'
-               
-               current_chunk = []
-               
-           current_chunk.append(sentence_data)
-   
-   if current_chunk:
-       chunks.append({
-           "id": len(chunks),
-           "start": current_chunk[0]['start'],
-           "end": current_chunk[-1]['end'],
-           "text": " ".join(s['text'] for s in current_chunk)
-       })
+           status['progress'] = 70 + int(min(20, 20 * (chunk['end'] / total_end))) if total_end else 70
+           status['partial_subtitles'].append(chunk)
+           status['current_stage'] = f'Создание умных чанков ({len(chunks)} чанков создано)'
    
    if status:
        status['progress'] = 90
        status['current_stage'] = f'Умные чанки созданы ({len(chunks)} чанков)'
-       status['partial_subtitles'] = chunks
    
    return chunks
  
+# Сжатые копии субтитров рядом с оригиналом: /api/files отдаёт их по Accept-Encoding
+PRECOMPRESSED_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+PRECOMPRESSED_OUTPUTS = ('chunked_json', 'transcription_json')
+
+def write_precompressed(path):
+   """Write path.gz (and path.br when the brotli package is installed) next to path"""
+   with open(path, 'rb') as f:
+       data = f.read()
+   copies = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+   try:
+       import brotli
+       copies['br'] = brotli.compress(data, quality=11)
+   except ImportError:
+       pass
+   for encoding, payload in copies.items():
+       target = path + PRECOMPRESSED_SUFFIXES[encoding]
+       with open(target + '.tmp', 'wb') as f:
+           f.write(payload)
+       os.replace(target + '.tmp', target)
+
 def save_output_files(text, segments, chunked_segments, output_paths, status=None):
    try:
        if status:
@@ -342,6 +1639,11 @@ def save_output_files(text, segments, chunked_segments, output_paths, status=Non
        with open(output_paths['transcription_txt'], 'w', encoding='utf-8') as f:
            f.write(text)
        
+       for name in PRECOMPRESSED_OUTPUTS:
+           write_precompressed(output_paths[name])
+       
+       index_transcript(output_paths, segments)
+       
        if status:
            status['progress'] = 100
            status['current_stage'] = f'Обработка завершена, создано {len(chunked_segments)} субтитров'
@@ -354,27 +1656,120 @@ def save_output_files(text, segments, chunked_segments, output_paths, status=Non
        
        print(f"Failed to save output files: {e}")
        return False
- 
-def process_video(video_path, status=None):
+
+class TranscriptionJournal:
+   """Append-only JSONL record of transcribed windows that lets a restarted job skip them
+
+   The first line holds a fingerprint of the media and pipeline_params(); a
+   journal with a different fingerprint is discarded. Every following line
+   is one finished window {"start", "end", "segments"}, flushed and fsynced
+   as soon as the window is done. A line torn by a killed process is cut off.
+   """
+
+   def __init__(self, path, fingerprint):
+       self.path = path
+       self.fingerprint = fingerprint
+       self.done = {}
+       self._file = None
+       self._load()
+
+   @staticmethod
+   def _key(start, end):
+       return round(start, 3), round(end, 3)
+
+   def _load(self):
+       if not os.path.exists(self.path):
+           return
+       with open(self.path, 'rb') as f:
+           data = f.read()
+       # Последняя строка без перевода строки - запись оборвалась при падении процесса
+       valid_length = data.rfind(b'\n') + 1
+       lines = data[:valid_length].decode('utf-8').splitlines()
+       try:
+           header = json.loads(lines[0]) if lines else {}
+       except ValueError:
+           header = {}
+       if header.get('fingerprint') != self.fingerprint:
+           print(f"Журнал {os.path.basename(self.path)} относится к другим данным или параметрам - начинаем заново")
+           os.remove(self.path)
+           return
+       for line in lines[1:]:
+           entry = json.loads(line)
+           self.done[self._key(entry['start'], entry['end'])] = entry['segments']
+       if valid_length < len(data):
+           with open(self.path, 'r+b') as f:
+               f.truncate(valid_length)
+       print(f"Найден журнал транскрибации: готово окон {len(self.done)}")
+
+   def lookup(self, start, end):
+       """Segments of an already transcribed window, or None"""
+       return self.done.get(self._key(start, end))
+
+   def record(self, start, end, segments):
+       if self._file is None:
+           is_new = not os.path.exists(self.path)
+           self._file = open(self.path, 'a', encoding='utf-8')
+           if is_new:
+               self._write({'fingerprint': self.fingerprint, 'created_at': time.time()})
+       self._write({'start': start, 'end': end, 'segments': segments})
+       self.done[self._key(start, end)] = segments
+
+   def _write(self, entry):
+       self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+       self._file.flush()
+       os.fsync(self._file.fileno())
+
+   def close(self):
+       if self._file is not None:
+           self._file.close()
+           self._file = None
+
+   def remove(self):
+       """Drop the journal once the job's results are saved"""
+       self.close()
+       if os.path.exists(self.path):
+           os.remove(self.path)
+
+def journal_fingerprint(video_path, content_hash=None):
+   """Identity of the media (content hash, or name and size) together with pipeline_params()"""
+   media = content_hash or f"{os.path.basename(video_path)}:{os.path.getsize(video_path)}"
+   return cache_key(media, pipeline_params())
+
+def process_video(video_path, status=None, pcm=None):
+   """Transcribe one video into its output folder; pcm is its already decoded audio (run_batch)"""
    start_time = time.time()
+   # Закрываются и в finally: при ошибке журнал не должен оставаться открытым, а копирование - идти дальше
+   journal = None
+   copy_thread = None
    
    try:
        output_paths = create_output_folder(video_path)
        print(f"Created output folder: {output_paths['base_dir']}")
        
+       # Оценки оставшегося времени: до первых замеров - по скользящему RTF этого хоста и конфигурации
+       # (планировщик кладёт его в задание), затем - по скорости самого задания
+       expected_rtf = ((status.get('expected_real_time_factor') if status else None)
+                       or _whisper_registry['real_time_factor'] or DEFAULT_REAL_TIME_FACTOR)
        if status:
            video_size_mb = os.path.getsize(video_path) / (1024 * 1024)
-           estimated_total_time = max(60, int(video_size_mb * 0.5))
-           status['estimated_time'] = estimated_total_time
+           if status.get('media_duration'):
+               status['estimated_time'] = int(status['media_duration'] * expected_rtf)
            status['current_stage'] = f'Инициализация обработки видео ({video_size_mb:.1f} MB)'
        
        print("Initializing Whisper model...")
        if status:
            status['progress'] = 2
            status['current_stage'] = 'Инициализация модели Whisper'
-           status['estimated_time'] = 10
        
-       processor, model = initialize_whisper()
+       # В шардированном режиме модели живут в процессах пула, здесь она не нужна
+       if SHARD_WORKERS > 1:
+           get_shard_pool()
+       else:
+           processor, model = get_whisper()
+           if model is None:
+               if status:
+                   status['current_stage'] = 'Ошибка: модель Whisper не загружена'
+               return False
        
        if status:
            elapsed_time = time.time() - start_time
@@ -382,46 +1777,118 @@ def process_video(video_path, status=None):
            status['current_stage'] = f'Модель Whisper инициализирована за {elapsed_time:.1f} сек'
        
        print("Processing video and audio...")
-       if not copy_video_and_extract_audio(video_path, output_paths, status):
-           return False
-       
        if status:
-           elapsed_time = time.time() - start_time
-           remaining_percent = 100 - status['progress']
-           if status['progress'] > 0:
-               new_estimate = int((elapsed_time / status['progress']) * remaining_percent)
-               status['estimated_time'] = max(10, new_estimate)
+           status['current_stage'] = 'Копирование видео и потоковое извлечение аудио'
+           status['partial_subtitles'] = []
+       
+       # Видео связывается (hardlink/reflink) или копируется параллельно с декодированием и транскрибацией
+       copy_errors = []
+       def copy_video():
+           try:
+               link_or_copy(video_path, output_paths['video'])
+           except Exception as copy_error:
+               copy_errors.append(copy_error)
+       copy_thread = threading.Thread(target=copy_video, name='video-copy', daemon=True)
+       copy_thread.start()
+       
+       if pcm is None:
+           audio_duration = probe_media_duration(video_path)
+           if audio_duration:
+               print(f"Длительность аудио по заголовку: {audio_duration:.1f} секунд")
+           blocks = stream_audio_windows(video_path, wav_path=output_paths['audio'] if WRITE_WAV else None)
+       else:
+           audio_duration = len(pcm) / SAMPLE_RATE
+           if WRITE_WAV:
+               write_wav(pcm, output_paths['audio'])
+           blocks = iter_pcm_windows(pcm)
+       windows = speech_windows(blocks, status)
+       # Готовые окна пишутся в журнал: перезапущенное задание продолжит с места падения
+       journal = TranscriptionJournal(output_paths['journal'],
+                                      journal_fingerprint(video_path, status.get('content_hash') if status else None))
+       segments = []
+       chunked_segments = []
+       first_subtitle_time = None
+       
+       def produced_segments():
+           if SHARD_WORKERS > 1:
+               for new_segments in transcribe_windows_sharded(windows, status, audio_duration, journal=journal):
+                   segments.extend(new_segments)
+                   yield from new_segments
+               return
+           with whisper_session() as (processor, model):
+               draft_model = get_draft_whisper()
+               for new_segments in transcribe_windows(windows, processor, model, status, audio_duration=audio_duration,
+                                                      draft_model=draft_model, journal=journal):
+                   segments.extend(new_segments)
+                   yield from new_segments
        
        print("Transcribing audio...")
-       text, segments = transcribe_with_timestamps(output_paths['audio'], processor, model, status)
-       if not text:
+       transcribe_start = time.time()
+       # Умные чанки строятся по мере появления сегментов, а не после всей транскрибации
+       for chunk in iter_smart_chunks(produced_segments(), **CHUNKING_PARAMS):
+           chunked_segments.append(chunk)
+           if first_subtitle_time is None:
+               first_subtitle_time = time.time() - start_time
+               print(f"Первый субтитр готов через {first_subtitle_time:.1f} сек")
+           if status:
+               status['partial_subtitles'].append(chunk)
+               if audio_duration:
+                   # Своя скорость задания надёжнее общей, когда распознано достаточно аудио
+                   measured_rtf = (time.time() - transcribe_start) / chunk['end'] if chunk['end'] > 0 else None
+                   rate = measured_rtf if measured_rtf and chunk['end'] >= ETA_MEASURED_AUDIO_SECONDS else expected_rtf
+                   status['estimated_time'] = max(5, int((audio_duration - chunk['end']) * rate))
+       
+       transcribe_seconds = time.time() - transcribe_start
+       journal.close()
+       copy_thread.join()
+       if copy_errors:
+           raise copy_errors[0]
+       
+       audio_seconds = audio_duration or (segments[-1]['end'] if segments else 0)
+       if audio_seconds:
+           real_time_factor = record_real_time_factor(transcribe_seconds, audio_seconds)
+           print(f"Транскрибация: {transcribe_seconds:.1f} сек на {audio_seconds:.1f} сек аудио, RTF {real_time_factor:.3f}")
+           if status:
+               status['real_time_factor'] = round(real_time_factor, 3)
+               status['inference_backend'] = INFERENCE_BACKEND
+       
+       if not segments:
+           print("Не удалось получить ни одного сегмента после полной обработки")
+           if status:
+               status['current_stage'] = 'Не удалось распознать речь'
            return False
        
-       if status:
-           elapsed_time = time.time() - start_time
-           remaining_percent = 100 - status['progress']
-           if status['progress'] > 0:
-               new_estimate = int((elapsed_time / status['progress']) * remaining_percent)
-               status['estimated_time'] = max(5, new_estimate)
+       text = " ".join(segment['text'] for segment in segments if segment['text'])
        
-       print("Processing chunks...")
-       chunked_segments = smart_chunking(segments, status=status)
+       if status:
+           status['progress'] = 90
+           status['current_stage'] = f'Умные чанки созданы ({len(chunked_segments)} чанков)'
+           if first_subtitle_time is not None:
+               status['first_subtitle_seconds'] = round(first_subtitle_time, 2)
        
        print("Saving results...")
-       if not save_output_files(text, segments, chunked_segments, output_paths, status):
+       with STAGE_SECONDS.time(stage='saving'):
+           saved = save_output_files(text, segments, chunked_segments, output_paths, status)
+       if not saved:
            return False
+       journal.remove()
        
        if status:
            total_time = time.time() - start_time
            status['progress'] = 100
            status['current_stage'] = f'Обработка завершена за {total_time:.1f} секунд'
            status['estimated_time'] = 0
+           # Для каталога видео (catalog_result)
+           status['audio_duration'] = round(audio_seconds, 2)
+           status['segment_count'] = len(segments)
+           status['subtitle_count'] = len(chunked_segments)
+           status['processing_seconds'] = round(total_time, 2)
        
        print("\n=== Processing complete ===")
        print(f"Total time: {time.time() - start_time:.2f} seconds")
        print("\nOutput files:")
        for key, path in output_paths.items():
-           if key != 'base_dir':
+           if key != 'base_dir' and os.path.exists(path):
                print(f"- {os.path.basename(path)}")
        
        print("\nSample chunk:")
@@ -439,8 +1906,588 @@ def process_video(video_path, status=None):
        import traceback
        traceback.print_exc()
        return False
+   finally:
+       if journal is not None:
+           journal.close()
+       if copy_thread is not None:
+           copy_thread.join()
  
+def result_links(filename):
+   """API paths of the video and subtitles produced for an uploaded file"""
+   base_name = os.path.splitext(os.path.basename(filename))[0]
+   return {
+       'video': f'/api/files/{base_name}/{base_name}.mp4',
+       'subtitles': f'/api/files/{base_name}/{base_name}_chunked.json'
+   }
+
+def pipeline_params():
+   """Everything besides the media itself that determines the produced subtitles"""
+   return {
+       'model': WHISPER_MODEL_NAME,
+       'backend': INFERENCE_BACKEND,
+       # Спекулятивный режим даёт ровно результат жадного декодирования
+       'decoding': GREEDY_DECODING_PARAMS if WHISPER_DRAFT_MODEL_PATH else DECODING_PARAMS,
+       'chunking': CHUNKING_PARAMS,
+       'window_seconds': SEGMENT_DURATION,
+       # Растёт, когда при тех же параметрах меняется результат (2 - сегменты по offsets,
+       # 3 - признаки каждого окна отдельно, как в WhisperFeatureExtractor)
+       'pipeline_version': 3
+   }
+
+def throughput_config():
+   """Configuration key of the rolling real-time factors: what changes the speed of a job on one host"""
+   num_beams = 1 if WHISPER_DRAFT_MODEL_PATH else DECODING_PARAMS.get('num_beams', 1)
+   return (f"{WHISPER_MODEL_NAME}|{INFERENCE_BACKEND}|beams={num_beams}|shards={max(1, SHARD_WORKERS)}"
+           f"|threads={TORCH_NUM_THREADS or 'auto'}|draft={'yes' if WHISPER_DRAFT_MODEL_PATH else 'no'}")
+
+def record_job_throughput(job, real_time_factors):
+   """Fold a finished job into the rolling real-time factor of this host and throughput_config()"""
+   real_time_factor = job_real_time_factor(job)
+   if real_time_factor is None:
+       return
+   try:
+       real_time_factors.record(throughput_config(), real_time_factor)
+   except Exception as e:
+       SWALLOWED_EXCEPTIONS.inc(where='throughput', type=type(e).__name__)
+       print(f"Не удалось записать RTF задания: {e}")
+
+def restore_cached_result(video_path, content_hash):
+   """Materialize the cached result of an identical earlier upload for video_path
+
+   Returns the output paths on a hit, None on a miss.
+   """
+   try:
+       cache = ResultCache()
+       key = cache_key(content_hash, pipeline_params())
+       if cache.lookup(key) is None:
+           return None
+       output_paths = create_output_folder(video_path)
+       if not cache.restore(key, output_paths):
+           return None
+       for name in PRECOMPRESSED_OUTPUTS:
+           write_precompressed(output_paths[name])
+       link_or_copy(video_path, output_paths['video'])
+       index_transcript(output_paths)
+       catalog_result(output_paths, content_hash=content_hash)
+       print(f"Результат для {os.path.basename(video_path)} взят из кэша ({key[:12]})")
+       return output_paths
+   except Exception as e:
+       SWALLOWED_EXCEPTIONS.inc(where='cache_restore', type=type(e).__name__)
+       print(f"Ошибка чтения кэша результатов: {e}")
+       return None
+
+def index_transcript(output_paths, segments=None):
+   """Put the transcript segments of a result into the search index behind /api/search"""
+   try:
+       if segments is None:
+           with open(output_paths['transcription_json'], encoding='utf-8') as f:
+               segments = json.load(f)
+       VideoCatalog().index_transcript(os.path.basename(output_paths['base_dir']), segments)
+   except Exception as e:
+       SWALLOWED_EXCEPTIONS.inc(where='search_index', type=type(e).__name__)
+       print(f"Не удалось обновить поисковый индекс: {e}")
+
+def catalog_result(output_paths, job=None, content_hash=None):
+   """Add a finished result to the video catalog behind /api/videos
+
+   Stats come from the job status when it is given, otherwise they are
+   read back from the saved files (results restored from the cache).
+   """
+   name = os.path.basename(output_paths['base_dir'])
+   try:
+       if job is None:
+           entry = entry_from_files(output_paths['base_dir'], name)
+           if entry is None:
+               return
+           entry.pop('created_at')
+           entry['content_hash'] = content_hash
+       else:
+           entry = {
+               'name': name,
+               **result_links(job['current_file']),
+               'duration': job.get('audio_duration'),
+               'segment_count': job.get('segment_count'),
+               'subtitle_count': job.get('subtitle_count'),
+               'processing_seconds': job.get('processing_seconds'),
+               'real_time_factor': job.get('real_time_factor'),
+               'content_hash': job.get('content_hash')
+           }
+       VideoCatalog().record(**entry)
+   except Exception as e:
+       SWALLOWED_EXCEPTIONS.inc(where='catalog', type=type(e).__name__)
+       print(f"Не удалось обновить каталог видео: {e}")
+
+def store_cached_result(content_hash, output_paths):
+   params = pipeline_params()
+   try:
+       ResultCache().store(cache_key(content_hash, params), content_hash, params, output_paths)
+   except Exception as e:
+       SWALLOWED_EXCEPTIONS.inc(where='cache_store', type=type(e).__name__)
+       print(f"Не удалось сохранить результат в кэш: {e}")
+
+@contextmanager
+def profile_job(job, output_paths):
+   """Profile the with-block when the job (or PROFILE_JOBS) asks for it
+
+   cprofile writes <name>_profile.prof (open with pstats or snakeviz), torch
+   writes a Chrome trace <name>_trace.json with operator shapes; both go to
+   the job's output folder, are linked from job['profile_file'] and the top
+   entries are printed. cProfile sees only the thread that runs the job, and
+   neither sees the shard processes (SHARD_WORKERS > 1).
+   """
+   mode = job.get('profile') or PROFILE_JOBS
+   if mode not in PROFILE_MODES:
+       yield
+       return
+   
+   name = os.path.basename(output_paths['base_dir'])
+   if mode == 'cprofile':
+       import cProfile
+       import pstats
+       import io
+       profiler = cProfile.Profile()
+       try:
+           profiler.enable()
+       except ValueError as e:
+           # В процессе уже работает другой профилировщик (параллельное задание)
+           print(f"[{job['id']}] Профилирование пропущено: {e}")
+           yield
+           return
+       try:
+           yield
+       finally:
+           profiler.disable()
+           filename = f'{name}_profile.prof'
+           profiler.dump_stats(os.path.join(output_paths['base_dir'], filename))
+           summary = io.StringIO()
+           pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(25)
+           print(summary.getvalue())
+           job['profile_file'] = f'/api/files/{name}/{filename}'
+       return
+   
+   from torch.profiler import profile, ProfilerActivity
+   activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+   with profile(activities=activities, record_shapes=True) as profiler:
+       yield
+   filename = f'{name}_trace.json'
+   profiler.export_chrome_trace(os.path.join(output_paths['base_dir'], filename))
+   print(profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=25))
+   job['profile_file'] = f'/api/files/{name}/{filename}'
+
+def process_job(job):
+   """Run process_video for one queued job and fill in the links to its results"""
+   filepath = job['filepath']
+   filename = job['current_file']
+   
+   if not os.path.exists(filepath):
+       print(f"ОШИБКА: Исходный файл не найден: {filepath}")
+       job['current_stage'] = 'Ошибка: файл не найден'
+       return False
+   
+   print(f"[{job['id']}] Начало обработки файла: {filepath}")
+   print(f"[{job['id']}] Размер файла: {os.path.getsize(filepath) / (1024 * 1024):.2f} MB")
+   
+   output_paths = create_output_folder(filepath)
+   job_start = time.time()
+   with profile_job(job, output_paths):
+       succeeded = process_video(filepath, job)
+   JOBS_TOTAL.inc(result='success' if succeeded else 'failure')
+   JOB_SECONDS.observe(time.time() - job_start)
+   
+   if not succeeded:
+       if not job['current_stage'].startswith('Ошибка'):
+           job['current_stage'] = 'Обработка не удалась'
+       print(f"[{job['id']}] Обработка видео не удалась.")
+       return False
+   
+   if job.get('real_time_factor'):
+       REAL_TIME_FACTOR.observe(job['real_time_factor'])
+   if job.get('content_hash'):
+       store_cached_result(job['content_hash'], output_paths)
+   catalog_result(output_paths, job)
+   
+   job.update({
+       'progress': 100,
+       'current_stage': 'Обработка завершена',
+       'estimated_time': 0,
+       **result_links(filename)
+   })
+   print(f"[{job['id']}] Обработка завершена успешно. Файлы доступны по путям:")
+   print(f"Видео: {job['video']}")
+   print(f"Субтитры: {job['subtitles']}")
+   return True
+
+def run_worker(db_path=None, poll_interval=2.0, once=False):
+   """Standalone worker: claim jobs from the SQLite queue and process them one at a time
+
+   Inference runs here instead of in the Flask process, so a crash or OOM
+   only loses this worker; its job is requeued once the heartbeat goes stale.
+   """
+   from job_queue import SqliteJobQueue, QueueJobStatus
+   
+   job_queue = SqliteJobQueue(db_path, config=throughput_config())
+   worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+   job_queue.register_worker(worker_id)
+   print(f"Рабочий процесс {worker_id} подключен к очереди {job_queue.path}")
+   
+   current = {'status': None}
+   stop = threading.Event()
+   
+   def heartbeat():
+       while not stop.wait(1.0):
+           status = current['status']
+           try:
+               if status is not None:
+                   status.flush()
+               job_queue.heartbeat(worker_id, status['id'] if status is not None else None, METRICS.snapshot())
+           except Exception as e:
+               print(f"Ошибка при записи прогресса в очередь: {e}")
+   
+   heartbeat_thread = threading.Thread(target=heartbeat, name='worker-heartbeat', daemon=True)
+   heartbeat_thread.start()
+   
+   try:
+       while True:
+           job = job_queue.claim(worker_id)
+           if job is None:
+               if once:
+                   break
+               time.sleep(poll_interval)
+               continue
+           
+           status = QueueJobStatus(job_queue, job)
+           status['expected_real_time_factor'] = job_queue.real_time_factors.estimate(
+               job_queue.config, socket.gethostname())
+           current['status'] = status
+           try:
+               succeeded = process_job(status)
+           except Exception as e:
+               status['current_stage'] = f'Ошибка: {str(e)}'
+               succeeded = False
+           if not succeeded:
+               status['progress'] = 0
+           else:
+               record_job_throughput(status, job_queue.real_time_factors)
+           current['status'] = None
+           status.flush()
+           job_queue.finish(job['id'], succeeded)
+           
+           if once:
+               break
+   except KeyboardInterrupt:
+       print("Остановка рабочего процесса...")
+       if current['status'] is not None:
+           job_queue.release(current['status']['id'])
+   finally:
+       stop.set()
+       job_queue.unregister_worker(worker_id)
+       shutdown_shard_pool()
+
+def has_outputs(video_path):
+   """True if the output folder of video_path holds a finished result (not one interrupted mid-way)"""
+   output_paths = result_paths(video_path)
+   return (os.path.exists(output_paths['chunked_json']) and os.path.exists(output_paths['video'])
+           and not os.path.exists(output_paths['journal']))
+
+def batch_files(sources, recursive=False):
+   """Video files named by sources (files, directories or glob patterns), sorted and without duplicates"""
+   import glob
+   files = []
+   for source in sources:
+       if os.path.isdir(source):
+           pattern = os.path.join(glob.escape(source), '**', '*') if recursive else os.path.join(glob.escape(source), '*')
+           matches = glob.glob(pattern, recursive=recursive)
+       else:
+           matches = glob.glob(source, recursive=True) or ([source] if os.path.exists(source) else [])
+       files.extend(path for path in matches
+                    if os.path.isfile(path) and os.path.splitext(path)[1].lower() in BATCH_EXTENSIONS)
+   return sorted(set(os.path.abspath(path) for path in files))
+
+def run_batch(sources, report_path=None, force=False, recursive=False):
+   """Headless backfill: transcribe every video in sources with one model load
+
+   While file N is transcribed, a prefetch thread decodes the audio of file
+   N+1 to its output folder's .pcm (memory-mapped, removed afterwards).
+   Files whose results already exist are skipped unless force is set.
+   Progress is printed per file; the summary with throughput and failures
+   is returned and written as JSON to report_path.
+   """
+   from concurrent.futures import ThreadPoolExecutor
+   from job_queue import RealTimeFactors
+   
+   batch_start = time.time()
+   real_time_factors = RealTimeFactors()
+   expected_rtf = real_time_factors.estimate(throughput_config(), socket.gethostname())
+   files = batch_files(sources, recursive)
+   results = []
+   pending = []
+   owners = {}
+   for path in files:
+       name = os.path.splitext(os.path.basename(path))[0]
+       if name in owners:
+           # Результаты лежат в папке по имени файла без расширения - второй файл затёр бы первый
+           results.append({'file': path, 'result': 'failed', 'error': f'то же имя результата, что у {owners[name]}'})
+       elif not force and has_outputs(path):
+           owners[name] = path
+           results.append({'file': path, 'result': 'skipped'})
+       else:
+           owners[name] = path
+           pending.append(path)
+   print(f"Файлов найдено: {len(files)}, к обработке: {len(pending)}, "
+         f"пропущено: {sum(entry['result'] == 'skipped' for entry in results)}")
+   
+   if pending and SHARD_WORKERS <= 1:
+       processor, model = get_whisper()
+       if model is None:
+           raise RuntimeError(f'Не удалось загрузить модель {WHISPER_MODEL_NAME}')
+   
+   def decode(path):
+       with STAGE_SECONDS.time(stage='extraction'):
+           return decode_audio_pcm(path, mmap_path=create_output_folder(path)['pcm'])
+   
+   audio_seconds = 0.0
+   processing_seconds = 0.0
+   with ThreadPoolExecutor(max_workers=1, thread_name_prefix='batch-prefetch') as prefetch:
+       decoded = prefetch.submit(decode, pending[0]) if pending else None
+       for index, path in enumerate(pending):
+           current = decoded
+           decoded = prefetch.submit(decode, pending[index + 1]) if index + 1 < len(pending) else None
+           entry = {'file': path}
+           file_start = time.time()
+           status = {'id': f'batch-{index + 1}', 'current_file': os.path.basename(path),
+                     'progress': 0, 'current_stage': '', 'expected_real_time_factor': expected_rtf}
+           try:
+               pcm = current.result()
+               status['media_duration'] = len(pcm) / SAMPLE_RATE
+               succeeded = process_video(path, status, pcm=pcm)
+               del pcm
+           except Exception as e:
+               status['current_stage'] = f'Ошибка: {e}'
+               succeeded = False
+           finally:
+               pcm_path = result_paths(path)['pcm']
+               if os.path.exists(pcm_path):
+                   os.remove(pcm_path)
+           entry['seconds'] = round(time.time() - file_start, 2)
+           JOBS_TOTAL.inc(result='success' if succeeded else 'failure')
+           JOB_SECONDS.observe(entry['seconds'])
+           if succeeded:
+               catalog_result(result_paths(path), status)
+               record_job_throughput(status, real_time_factors)
+               entry.update(result='processed', audio_seconds=status.get('audio_duration'),
+                            real_time_factor=status.get('real_time_factor'))
+               audio_seconds += status.get('audio_duration') or 0
+               processing_seconds += entry['seconds']
+           else:
+               entry.update(result='failed', error=status.get('current_stage') or 'Обработка не удалась')
+           results.append(entry)
+           
+           done = index + 1
+           remaining = (time.time() - batch_start) / done * (len(pending) - done)
+           outcome = (f"готово, аудио {entry['audio_seconds'] or 0:.0f} сек, RTF {entry['real_time_factor']}"
+                      if succeeded else entry['error'])
+           print(f"[{done}/{len(pending)}] {os.path.basename(path)}: {outcome}, {entry['seconds']:.1f} сек"
+                 f" (осталось ~{remaining / 60:.0f} мин)")
+   
+   shutdown_shard_pool()
+   wall_seconds = time.time() - batch_start
+   failures = [entry for entry in results if entry['result'] == 'failed']
+   report = {
+       'sources': list(sources),
+       'model': WHISPER_MODEL_NAME,
+       'backend': INFERENCE_BACKEND,
+       'files': len(files),
+       'processed': sum(entry['result'] == 'processed' for entry in results),
+       'skipped': sum(entry['result'] == 'skipped' for entry in results),
+       'failed': len(failures),
+       'audio_seconds': round(audio_seconds, 2),
+       'wall_seconds': round(wall_seconds, 2),
+       # Секунд аудио за секунду работы: больше 1 - быстрее реального времени
+       'throughput': round(audio_seconds / wall_seconds, 3) if wall_seconds else None,
+       'real_time_factor': round(processing_seconds / audio_seconds, 4) if audio_seconds else None,
+       'failures': failures,
+       'results': results
+   }
+   print(f"\nОбработано: {report['processed']}, пропущено: {report['skipped']}, ошибок: {report['failed']}; "
+         f"аудио {audio_seconds / 3600:.2f} ч за {wall_seconds / 3600:.2f} ч (x{report['throughput']})")
+   for entry in failures:
+       print(f"- {entry['file']}: {entry['error']}")
+   if report_path:
+       with open(report_path, 'w', encoding='utf-8') as f:
+           json.dump(report, f, ensure_ascii=False, indent=2)
+       print(f"Отчёт: {report_path}")
+   return report
+
+def compare_inference_backends(media_path, seconds=120, backends=INFERENCE_BACKENDS, batch_size=None):
+   """Transcribe the same audio with each backend and report real-time factors side by side
+
+   Models are loaded outside the registry, one at a time, so the comparison
+   does not disturb a running service's cached model.
+   """
+   pcm = decode_audio_pcm(media_path)[:int(seconds * SAMPLE_RATE)]
+   audio_seconds = len(pcm) / SAMPLE_RATE
+   threads = configure_torch_threads()
+   report = {
+       'media': os.path.abspath(media_path),
+       'audio_seconds': round(audio_seconds, 2),
+       'model': WHISPER_MODEL_NAME,
+       'batch_size': batch_size or WHISPER_BATCH_SIZE,
+       'torch_threads': threads,
+       'backends': {}
+   }
+   
+   for backend in backends:
+       load_start = time.time()
+       processor, model = initialize_whisper(backend)
+       load_seconds = time.time() - load_start
+       if model is None:
+           report['backends'][backend] = {'error': 'модель не загружена'}
+           continue
+       
+       run_start = time.time()
+       segments = []
+       for new_segments in transcribe_windows(speech_windows(iter_pcm_windows(pcm)), processor, model,
+                                              batch_size=batch_size, audio_duration=audio_seconds):
+           segments.extend(new_segments)
+       transcribe_seconds = time.time() - run_start
+       
+       report['backends'][backend] = {
+           'load_seconds': round(load_seconds, 2),
+           'transcribe_seconds': round(transcribe_seconds, 2),
+           'real_time_factor': round(transcribe_seconds / audio_seconds, 4) if audio_seconds else None,
+           'segments': len(segments),
+           'text': " ".join(segment['text'] for segment in segments)
+       }
+       del processor, model
+       gc.collect()
+   
+   baseline = report['backends'].get('fp32', {}).get('real_time_factor')
+   print(f"\nСравнение режимов на {audio_seconds:.1f} сек аудио ({threads['num_threads']} потоков):")
+   for backend, result in report['backends'].items():
+       if 'error' in result:
+           print(f"- {backend}: {result['error']}")
+           continue
+       if baseline and result['real_time_factor']:
+           result['speedup_vs_fp32'] = round(baseline / result['real_time_factor'], 2)
+       print(f"- {backend}: RTF {result['real_time_factor']}, загрузка {result['load_seconds']} сек"
+             + (f", ускорение x{result['speedup_vs_fp32']}" if 'speedup_vs_fp32' in result else ''))
+   return report
+
+def compare_speculative_decoding(media_path, draft_path=None, seconds=120, backend=None, draft_tokens=None):
+   """Decode the same windows greedily and speculatively, check the outputs match and report the speedup"""
+   pcm = decode_audio_pcm(media_path)[:int(seconds * SAMPLE_RATE)]
+   processor, model = initialize_whisper(backend)
+   if model is None:
+       raise RuntimeError(f'Не удалось загрузить модель {WHISPER_MODEL_NAME}')
+   draft_model = load_draft_whisper(model, draft_path)
+
+   stats = {}
+   greedy_seconds = speculative_seconds = 0.0
+   mismatches = []
+   windows = 0
+   for start_time, end_time, window_pcm in speech_windows(iter_pcm_windows(pcm)):
+       features = window_features([window_pcm], processor.feature_extractor).to(model.device)
+       window = [(start_time, end_time)]
+
+       run_start = time.time()
+       with torch.no_grad():
+           greedy = model.generate(features, logits_processor=transformers.LogitsProcessorList(
+               [_repetition_guard(window, model, 1)]), **GREEDY_DECODING_PARAMS)
+       greedy_seconds += time.time() - run_start
+
+       run_start = time.time()
+       speculative = speculative_generate(features, processor, model, draft_model,
+                                          [_repetition_guard(window, model, 1)],
+                                          draft_tokens=draft_tokens, stats=stats)
+       speculative_seconds += time.time() - run_start
+
+       windows += 1
+       greedy_result = decode_with_offsets(processor, greedy)[0]
+       speculative_result = decode_with_offsets(processor, speculative)[0]
+       if greedy_result != speculative_result:
+           mismatches.append({'start': round(start_time, 2), 'end': round(end_time, 2),
+                              'greedy': greedy_result['text'], 'speculative': speculative_result['text']})
+
+   report = {
+       'media': os.path.abspath(media_path),
+       'audio_seconds': round(len(pcm) / SAMPLE_RATE, 2),
+       'model': WHISPER_MODEL_NAME,
+       'backend': backend or INFERENCE_BACKEND,
+       'draft_model': draft_path or WHISPER_DRAFT_MODEL_PATH,
+       'windows': windows,
+       'greedy_seconds': round(greedy_seconds, 2),
+       'speculative_seconds': round(speculative_seconds, 2),
+       'speedup': round(greedy_seconds / speculative_seconds, 2) if speculative_seconds else None,
+       'identical': not mismatches,
+       'mismatches': mismatches,
+       'speculative': speculative_summary(stats) if stats else None
+   }
+   print(f"\nЖадное декодирование: {report['greedy_seconds']} сек, спекулятивное: {report['speculative_seconds']} сек"
+         f" (x{report['speedup']}), окон: {windows}, совпадают: {'да' if report['identical'] else 'нет'}")
+   if stats:
+       print(f"Доля принятых черновых токенов: {report['speculative']['acceptance_rate']}, "
+             f"токенов на проход основной модели: {report['speculative']['tokens_per_target_pass']}")
+   return report
+
+def _parse_args(argv):
+   import argparse
+   parser = argparse.ArgumentParser(prog='python -m diploma_handle')
+   commands = parser.add_subparsers(dest='command')
+   
+   worker = commands.add_parser('worker', help='обрабатывать задания из очереди SQLite')
+   worker.add_argument('--db', default=None, help='путь к базе очереди (по умолчанию KSR_JOBS_DB)')
+   worker.add_argument('--poll', type=float, default=2.0, help='интервал опроса очереди, сек')
+   worker.add_argument('--once', action='store_true', help='обработать одно задание и выйти')
+   
+   batch = commands.add_parser('batch', help='обработать папку или набор видео без веб-интерфейса')
+   batch.add_argument('sources', nargs='+', help='видеофайлы, папки или шаблоны (records/*.mp4, "records/**/*.mov")')
+   batch.add_argument('--recursive', action='store_true', help='искать видео и во вложенных папках')
+   batch.add_argument('--force', action='store_true', help='обработать заново файлы, у которых уже есть результаты')
+   batch.add_argument('--report', default=None, help='куда записать отчёт JSON (по умолчанию batch_report_<время>.json)')
+   
+   compare = commands.add_parser('compare-backends', help='сравнить RTF режимов fp32 и int8 на одном файле')
+   compare.add_argument('media', help='видео или аудиофайл')
+   compare.add_argument('--seconds', type=float, default=120, help='сколько секунд аудио использовать')
+   compare.add_argument('--batch-size', type=int, default=None)
+   compare.add_argument('--backends', default=','.join(INFERENCE_BACKENDS), help='список через запятую')
+   compare.add_argument('--output', default=None, help='куда записать отчёт JSON')
+   
+   speculative = commands.add_parser('compare-speculative',
+                                     help='сравнить жадное и спекулятивное декодирование на одном файле')
+   speculative.add_argument('media', help='видео или аудиофайл')
+   speculative.add_argument('--draft', default=None, help='локальная папка черновой модели (по умолчанию WHISPER_DRAFT_MODEL_PATH)')
+   speculative.add_argument('--seconds', type=float, default=120, help='сколько секунд аудио использовать')
+   speculative.add_argument('--backend', default=None, choices=INFERENCE_BACKENDS)
+   speculative.add_argument('--draft-tokens', type=int, default=None, help='сколько токенов предлагает черновая модель')
+   speculative.add_argument('--output', default=None, help='куда записать отчёт JSON')
+   
+   return parser.parse_args(argv)
+
 if __name__ == "__main__":
+   args = _parse_args(sys.argv[1:])
+   
+   if args.command == 'worker':
+       run_worker(args.db, args.poll, args.once)
+       sys.exit(0)
+   
+   if args.command == 'batch':
+       report = run_batch(args.sources, args.report or time.strftime('batch_report_%Y%m%d-%H%M%S.json'),
+                          args.force, args.recursive)
+       sys.exit(1 if report['failed'] else 0)
+   
+   if args.command in ('compare-backends', 'compare-speculative'):
+       if args.command == 'compare-backends':
+           report = compare_inference_backends(args.media, args.seconds, args.backends.split(','), args.batch_size)
+       else:
+           report = compare_speculative_decoding(args.media, args.draft, args.seconds, args.backend, args.draft_tokens)
+       if args.output:
+           with open(args.output, 'w', encoding='utf-8') as f:
+               json.dump(report, f, ensure_ascii=False, indent=2)
+       sys.exit(0)
+   
+   import tkinter as tk
+   from tkinter import filedialog
+   
    root = tk.Tk()
    root.withdraw()
    
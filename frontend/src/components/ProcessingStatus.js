@@ -66,7 +66,8 @@ function ProcessingStatus({ status, videoUrl }) {
   const getRemainingTime = () => {
     if (!status || !status.estimated_time) return 'Оценка времени...';
     
-    const remaining = status.estimated_time * (100 - status.progress) / 100;
+    // estimated_time - оставшиеся секунды (по измеренной скорости обработки на сервере)
+    const remaining = status.estimated_time;
     if (remaining < 60) {
       return `Осталось примерно ${Math.ceil(remaining)} сек.`;
     } else {
@@ -0,0 +1,428 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+
+from sqlite_db import connect
+from scheduler import schedule, estimate_wait, expected_seconds, RTF_SMOOTHING, DEFAULT_REAL_TIME_FACTOR
+
+DEFAULT_DB_PATH = os.environ.get(
+    'KSR_JOBS_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend', 'output', 'jobs.sqlite3')
+)
+# Задание, чей рабочий процесс молчит дольше этого, возвращается в очередь
+STALE_JOB_SECONDS = int(os.environ.get('STALE_JOB_SECONDS', 120))
+MAX_JOB_ATTEMPTS = int(os.environ.get('MAX_JOB_ATTEMPTS', 3))
+
+# Поля статуса, которые хранятся в отдельных колонках; остальные - в status_json
+_COLUMNS = ('state', 'progress', 'current_stage', 'estimated_time')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    filepath TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    current_stage TEXT NOT NULL DEFAULT '',
+    estimated_time INTEGER NOT NULL DEFAULT 0,
+    status_json TEXT NOT NULL DEFAULT '{}',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    heartbeat_at REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state_created ON jobs (state, created_at);
+CREATE TABLE IF NOT EXISTS job_subtitles (
+    job_id TEXT NOT NULL,
+    chunk_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (job_id, chunk_id)
+);
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    current_job TEXT,
+    started_at REAL NOT NULL,
+    heartbeat_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS worker_metrics (
+    worker_id TEXT PRIMARY KEY,
+    snapshot_json TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS real_time_factors (
+    host TEXT NOT NULL,
+    config TEXT NOT NULL,
+    real_time_factor REAL NOT NULL,
+    samples INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (host, config)
+);
+"""
+
+
+class JobQueueFull(Exception):
+    """Raised by submit when the waiting queue is at capacity"""
+
+
+def _connect(path):
+    # Транзакции открываются явно (BEGIN IMMEDIATE), чтобы разбор очереди не гонялся за блокировкой
+    return connect(path, autocommit=True)
+
+
+class RealTimeFactors:
+    """Rolling real-time factor (job wall seconds per audio second) per host and configuration
+
+    Workers record every finished job; the scheduler turns media durations
+    into expected costs with it and the API computes ETAs from it.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_DB_PATH
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with _connect(self.path) as db:
+            db.executescript(_SCHEMA)
+
+    def record(self, config, real_time_factor, host=None):
+        host = host or socket.gethostname()
+        with _connect(self.path) as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT real_time_factor, samples FROM real_time_factors WHERE host = ? AND config = ?',
+                             (host, config)).fetchone()
+            if row is not None:
+                real_time_factor = (1 - RTF_SMOOTHING) * row['real_time_factor'] + RTF_SMOOTHING * real_time_factor
+            db.execute(
+                'INSERT OR REPLACE INTO real_time_factors (host, config, real_time_factor, samples, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (host, config, real_time_factor, (row['samples'] if row else 0) + 1, time.time())
+            )
+            db.execute('COMMIT')
+        return real_time_factor
+
+    def estimate(self, config=None, host=None):
+        """Measured factor for this host and config, else the config on any host, else any measurement"""
+        with _connect(self.path) as db:
+            for where, params in (('host = ? AND config = ?', (host, config)),
+                                  ('config = ?', (config,)),
+                                  ('1', ())):
+                if None in params:
+                    continue
+                value = db.execute(f'SELECT AVG(real_time_factor) FROM real_time_factors WHERE {where}',
+                                   params).fetchone()[0]
+                if value is not None:
+                    return value
+        return DEFAULT_REAL_TIME_FACTOR
+
+    def table(self):
+        with _connect(self.path) as db:
+            rows = db.execute('SELECT * FROM real_time_factors ORDER BY host, config').fetchall()
+        return [dict(row) for row in rows]
+
+
+class SqliteJobQueue:
+    """Durable job queue shared by the API process and standalone workers
+
+    The API only calls submit/get/latest/list_jobs/stats; workers started with
+    `python -m diploma_handle worker` claim jobs, write progress back through
+    QueueJobStatus and finish them. Any number of workers, on this or other
+    machines sharing the output directory, can poll the same database.
+    Jobs are claimed shortest-first with aging (see scheduler), by their
+    media_duration and the measured real-time factor of config.
+    """
+
+    def __init__(self, path=None, max_queued=None, config=None):
+        self.path = path or DEFAULT_DB_PATH
+        self.config = config
+        self.max_queued = max_queued if max_queued is not None else int(os.environ.get('MAX_QUEUED_JOBS', 20))
+        self.real_time_factors = RealTimeFactors(self.path)
+
+    def _connect(self):
+        return _connect(self.path)
+
+    # --- API-сторона -------------------------------------------------------
+
+    def submit(self, filepath, filename, **extra):
+        now = time.time()
+        job_id = uuid.uuid4().hex[:12]
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            queued = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                db.execute('ROLLBACK')
+                raise JobQueueFull(f'В очереди уже {queued} заданий')
+            db.execute(
+                'INSERT INTO jobs (id, state, filename, filepath, current_stage, status_json, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, 'queued', filename, filepath, 'В очереди на обработку',
+                 json.dumps(extra, ensure_ascii=False), now)
+            )
+            db.execute('COMMIT')
+        return self.get(job_id)
+
+    def get(self, job_id, since_id=None):
+        """Job status; with since_id only the subtitle chunks after that id are loaded"""
+        with self._connect() as db:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = self._row_to_job(row)
+            job['partial_subtitles'] = [
+                json.loads(payload) for (payload,) in db.execute(
+                    'SELECT payload FROM job_subtitles WHERE job_id = ? AND chunk_id > ? ORDER BY chunk_id',
+                    (job_id, -1 if since_id is None else since_id)
+                )
+            ]
+            job['last_subtitle_id'] = db.execute(
+                'SELECT COALESCE(MAX(chunk_id), -1) FROM job_subtitles WHERE job_id = ?', (job_id,)
+            ).fetchone()[0]
+            if job['state'] == 'queued':
+                now = time.time()
+                workers = db.execute('SELECT COUNT(*) FROM workers WHERE heartbeat_at > ?',
+                                     (now - STALE_JOB_SECONDS,)).fetchone()[0]
+                position, eta = estimate_wait(job_id, self._queued(db), self._running(db), workers, now,
+                                              self.real_time_factors.estimate(self.config))
+                if position is not None:
+                    job['queue_position'] = position
+                    job['estimated_time'] = eta
+        return job
+
+    def _queued(self, db):
+        """Queued jobs with the fields the scheduler needs"""
+        return [
+            {'id': row['id'], 'created_at': row['created_at'],
+             'media_duration': json.loads(row['status_json']).get('media_duration')}
+            for row in db.execute("SELECT id, created_at, status_json FROM jobs WHERE state = 'queued'")
+        ]
+
+    def _running(self, db):
+        return [dict(row) for row in db.execute("SELECT id, estimated_time FROM jobs WHERE state = 'running'")]
+
+    def latest(self, since_id=None):
+        with self._connect() as db:
+            row = db.execute('SELECT id FROM jobs ORDER BY created_at DESC LIMIT 1').fetchone()
+        return self.get(row['id'], since_id) if row else None
+
+    def list_jobs(self, limit=100):
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT jobs.*, (SELECT COUNT(*) FROM job_subtitles WHERE job_id = jobs.id) AS subtitles_count '
+                'FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,)
+            ).fetchall()
+        jobs = []
+        for row in rows:
+            job = self._row_to_job(row)
+            job['subtitles_count'] = row['subtitles_count']
+            job.pop('filepath', None)
+            jobs.append(job)
+        return jobs
+
+    def stats(self):
+        now = time.time()
+        with self._connect() as db:
+            counts = dict(db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+            workers = db.execute(
+                'SELECT COUNT(*) FROM workers WHERE heartbeat_at > ?', (now - STALE_JOB_SECONDS,)
+            ).fetchone()[0]
+        return {
+            'workers': workers,
+            'running': counts.get('running', 0),
+            'queued': counts.get('queued', 0),
+            'max_queued': self.max_queued
+        }
+
+    def worker_metrics(self):
+        """[(worker_id, metrics snapshot)] of the workers that are alive"""
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT m.worker_id, m.snapshot_json FROM worker_metrics m JOIN workers w ON w.id = m.worker_id '
+                'WHERE w.heartbeat_at > ?', (time.time() - STALE_JOB_SECONDS,)
+            ).fetchall()
+        return [(row['worker_id'], json.loads(row['snapshot_json'])) for row in rows]
+
+    # --- сторона рабочего процесса ----------------------------------------
+
+    def register_worker(self, worker_id):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO workers (id, host, pid, started_at, heartbeat_at) VALUES (?, ?, ?, ?, ?)',
+                (worker_id, socket.gethostname(), os.getpid(), now, now)
+            )
+
+    def unregister_worker(self, worker_id):
+        with self._connect() as db:
+            db.execute('DELETE FROM workers WHERE id = ?', (worker_id,))
+            db.execute('DELETE FROM worker_metrics WHERE worker_id = ?', (worker_id,))
+
+    def claim(self, worker_id):
+        """Atomically take the queued job the scheduler puts first, or return None"""
+        now = time.time()
+        self.requeue_stale()
+        real_time_factor = self.real_time_factors.estimate(self.config, socket.gethostname())
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            queued = schedule(self._queued(db), now, real_time_factor)
+            if not queued:
+                db.execute('ROLLBACK')
+                return None
+            row = queued[0]
+            db.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, "
+                "started_at = ?, heartbeat_at = ?, current_stage = ?, estimated_time = ? WHERE id = ?",
+                (worker_id, now, now, 'Инициализация обработки видео',
+                 int(expected_seconds(row, real_time_factor)), row['id'])
+            )
+            db.execute('UPDATE workers SET current_job = ?, heartbeat_at = ? WHERE id = ?',
+                       (row['id'], now, worker_id))
+            db.execute('COMMIT')
+        return self.get(row['id'])
+
+    def requeue_stale(self, stale_seconds=None):
+        """Return jobs of dead workers to the queue (or fail them after MAX_JOB_ATTEMPTS)"""
+        deadline = time.time() - (stale_seconds or STALE_JOB_SECONDS)
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(
+                "UPDATE jobs SET state = 'failed', finished_at = ?, current_stage = ? "
+                "WHERE state = 'running' AND heartbeat_at < ? AND attempts >= ?",
+                (time.time(), 'Ошибка: рабочий процесс завершился аварийно', deadline, MAX_JOB_ATTEMPTS)
+            )
+            requeued = db.execute(
+                "UPDATE jobs SET state = 'queued', worker = NULL, current_stage = ? "
+                "WHERE state = 'running' AND heartbeat_at < ?",
+                ('В очереди на повторную обработку', deadline)
+            ).rowcount
+            db.execute('DELETE FROM workers WHERE heartbeat_at < ?', (deadline,))
+            db.execute('DELETE FROM worker_metrics WHERE worker_id NOT IN (SELECT id FROM workers)')
+            db.execute('COMMIT')
+        return requeued
+
+    def heartbeat(self, worker_id, job_id=None, metrics=None):
+        """Mark the worker alive; metrics is its metrics.Registry snapshot, served by /metrics"""
+        now = time.time()
+        with self._connect() as db:
+            db.execute('UPDATE workers SET heartbeat_at = ?, current_job = ? WHERE id = ?',
+                       (now, job_id, worker_id))
+            if metrics is not None:
+                db.execute('INSERT OR REPLACE INTO worker_metrics (worker_id, snapshot_json, updated_at) '
+                           'VALUES (?, ?, ?)', (worker_id, json.dumps(metrics, ensure_ascii=False), now))
+            if job_id:
+                db.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND state = 'running'", (now, job_id))
+
+    def save_status(self, job_id, fields, new_subtitles=None, reset_subtitles=False):
+        """Persist changed status fields and newly produced subtitle chunks"""
+        columns = {key: fields[key] for key in _COLUMNS if key in fields}
+        extra = {key: value for key, value in fields.items()
+                 if key not in _COLUMNS and key not in ('partial_subtitles', 'id', 'filepath')}
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            if columns:
+                assignments = ', '.join(f'{key} = ?' for key in columns)
+                db.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*columns.values(), job_id))
+            if extra:
+                row = db.execute('SELECT status_json FROM jobs WHERE id = ?', (job_id,)).fetchone()
+                stored = json.loads(row['status_json']) if row else {}
+                stored.update(extra)
+                db.execute('UPDATE jobs SET status_json = ? WHERE id = ?',
+                           (json.dumps(stored, ensure_ascii=False, default=str), job_id))
+            if reset_subtitles:
+                db.execute('DELETE FROM job_subtitles WHERE job_id = ?', (job_id,))
+            if new_subtitles:
+                db.executemany(
+                    'INSERT OR REPLACE INTO job_subtitles (job_id, chunk_id, payload) VALUES (?, ?, ?)',
+                    [(job_id, index, json.dumps(chunk, ensure_ascii=False)) for index, chunk in new_subtitles]
+                )
+            db.execute('COMMIT')
+
+    def finish(self, job_id, succeeded):
+        with self._connect() as db:
+            db.execute(
+                'UPDATE jobs SET state = ?, finished_at = ?, worker = NULL WHERE id = ?',
+                ('done' if succeeded else 'failed', time.time(), job_id)
+            )
+
+    def release(self, job_id):
+        """Put a job a worker is abandoning (e.g. on shutdown) back into the queue"""
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET state = 'queued', worker = NULL, current_stage = ? WHERE id = ? AND state = 'running'",
+                ('В очереди на повторную обработку', job_id)
+            )
+
+    def _row_to_job(self, row):
+        job = json.loads(row['status_json'])
+        job.update({
+            'id': row['id'],
+            'state': row['state'],
+            'is_processing': row['state'] in ('queued', 'running'),
+            'current_file': row['filename'],
+            'filepath': row['filepath'],
+            'progress': row['progress'],
+            'current_stage': row['current_stage'],
+            'estimated_time': row['estimated_time'],
+            'worker': row['worker'],
+            'attempts': row['attempts'],
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at']
+        })
+        return job
+
+
+class _TrackedList(list):
+    """List that remembers how many of its items were already persisted"""
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.saved = 0
+
+
+class QueueJobStatus(dict):
+    """Status dict used by workers: process_video writes it, flush() persists the changes
+
+    Writes only touch memory; a heartbeat thread calls flush() about once a
+    second, so progress reaches the database without slowing down inference.
+    """
+
+    def __init__(self, job_queue, job):
+        super().__init__(job)
+        self._queue = job_queue
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._dirty = set()
+        self._reset_subtitles = False
+        super().__setitem__('partial_subtitles', _TrackedList(job.get('partial_subtitles') or []))
+        self['partial_subtitles'].saved = len(self['partial_subtitles'])
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key == 'partial_subtitles':
+                value = _TrackedList(value)
+                self._reset_subtitles = True
+            super().__setitem__(key, value)
+            self._dirty.add(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def flush(self):
+        # Сбросы выполняются по одному, чтобы старый снимок не перезаписал более новый
+        with self._flush_lock:
+            with self._lock:
+                fields = {key: self[key] for key in self._dirty}
+                subtitles = self['partial_subtitles']
+                reset = self._reset_subtitles
+                start = 0 if reset else subtitles.saved
+                new_subtitles = list(enumerate(subtitles[start:], start))
+                self._dirty = set()
+                self._reset_subtitles = False
+                subtitles.saved = start + len(new_subtitles)
+            if fields or new_subtitles or reset:
+                self._queue.save_status(self['id'], fields, new_subtitles, reset)
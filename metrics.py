@@ -0,0 +1,188 @@
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+# Границы корзин гистограмм по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._registry = registry
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name}: ожидаются метки {self.labels}, получены {tuple(labels)}')
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _describe(self):
+        return {'type': self.kind, 'help': self.documentation, 'labels': list(self.labels)}
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._registry.lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _snapshot(self):
+        return dict(self._describe(), samples=[[list(key), value] for key, value in self._values.items()])
+
+    def _merge(self, samples):
+        for key, value in samples:
+            key = tuple(key)
+            self._values[key] = self._values.get(key, 0.0) + value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._registry.lock:
+            self._values[key] = float(value)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._registry.lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][index] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the with-block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _snapshot(self):
+        return dict(self._describe(), buckets=list(self.buckets),
+                    samples=[[list(key), {'counts': list(state['counts']), 'sum': state['sum'], 'count': state['count']}]
+                             for key, state in self._values.items()])
+
+    def _merge(self, samples):
+        for key, incoming in samples:
+            key = tuple(key)
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            state['counts'] = [a + b for a, b in zip(state['counts'], incoming['counts'])]
+            state['sum'] += incoming['sum']
+            state['count'] += incoming['count']
+
+
+class Registry:
+    """Process-local set of metrics that can be snapshotted to JSON, merged and rendered
+
+    Snapshots let other processes (queue workers, shard processes) hand their
+    metrics to the one that serves /metrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self.lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(self, name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=()):
+        return self._register(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labels, buckets=buckets)
+
+    def snapshot(self, reset=False):
+        """JSON-serializable copy of every metric; with reset the values start again from zero"""
+        with self.lock:
+            snapshot = {name: metric._snapshot() for name, metric in self._metrics.items()}
+            if reset:
+                for metric in self._metrics.values():
+                    metric._values = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """Add the counts of a snapshot (e.g. from a shard process) to this registry"""
+        with self.lock:
+            for name, data in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is not None and metric.kind == data['type'] and metric.kind != 'gauge':
+                    metric._merge(data['samples'])
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(names, values, extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render(sources):
+    """Prometheus text exposition (version 0.0.4) of [(snapshot, extra_labels), ...]
+
+    Metrics with the same name from several sources are written under one
+    HELP/TYPE header and told apart by extra_labels (e.g. worker="...").
+    """
+    merged = {}
+    for snapshot, extra in sources:
+        for name, data in snapshot.items():
+            merged.setdefault(name, (data, []))[1].append((data, extra))
+
+    lines = []
+    for name in sorted(merged):
+        header, parts = merged[name]
+        lines.append(f"# HELP {name} {header['help']}")
+        lines.append(f"# TYPE {name} {header['type']}")
+        for data, extra in parts:
+            for key, value in data['samples']:
+                if data['type'] != 'histogram':
+                    lines.append(f"{name}{_format_labels(data['labels'], key, extra)} {_format_value(value)}")
+                    continue
+                for bound, count in zip(data['buckets'] + [math.inf], value['counts'] + [value['count']]):
+                    labels = _format_labels(data['labels'] + ['le'], list(key) + [_format_value(bound)], extra)
+                    lines.append(f"{name}_bucket{labels} {count}")
+                labels = _format_labels(data['labels'], key, extra)
+                lines.append(f"{name}_sum{labels} {_format_value(value['sum'])}")
+                lines.append(f"{name}_count{labels} {value['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+# Метрики этого процесса: конвейер в diploma_handle пишет сюда
+METRICS = Registry()
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from sqlite_db import connect
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'RESULT_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend', 'output', '.cache')
+)
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_MB', 2048)) * 1024 * 1024
+# Меняется при изменении формата результатов - старые записи перестают совпадать
+CACHE_FORMAT_VERSION = 1
+
+# Какие файлы результата хранятся в кэше (ключи output_paths из create_output_folder)
+CACHED_OUTPUTS = ('transcription_json', 'chunked_json', 'transcription_txt')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    model_name TEXT NOT NULL,
+    params_json TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE INDEX IF NOT EXISTS entries_model ON entries (model_name);
+"""
+
+
+def cache_key(content_hash, params):
+    """Key of a result: the media content plus everything that influences the output"""
+    payload = json.dumps(
+        {'content': content_hash, 'format': CACHE_FORMAT_VERSION, 'params': params},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# ioctl FICLONE: копия-ссылка на те же блоки (btrfs, xfs, overlayfs поверх них)
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst when possible (same filesystem), else reflink it, else copy it"""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp = f'{dst}.tmp{os.getpid()}'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        try:
+            _reflink(src, tmp)
+        except (OSError, ImportError):
+            shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ResultCache:
+    """Content-addressed store of finished transcriptions with size-based LRU eviction"""
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else RESULT_CACHE_MAX_BYTES
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+
+    def _connect(self):
+        return connect(os.path.join(self.cache_dir, 'index.sqlite3'))
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def lookup(self, key):
+        """Paths of the cached outputs for key (and bump its LRU time), or None"""
+        with self._connect() as db:
+            row = db.execute('SELECT key FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            paths = {name: os.path.join(self._entry_dir(key), name) for name in CACHED_OUTPUTS}
+            if not all(os.path.exists(path) for path in paths.values()):
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                return None
+            db.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+        return paths
+
+    def restore(self, key, output_paths):
+        """Copy a cached result into a job's output folder; False on a miss"""
+        paths = self.lookup(key)
+        if paths is None:
+            return False
+        for name, path in paths.items():
+            # Копируем, а не связываем: save_output_files перезаписывает файлы на месте
+            shutil.copyfile(path, output_paths[name] + '.tmp')
+            os.replace(output_paths[name] + '.tmp', output_paths[name])
+        return True
+
+    def store(self, key, content_hash, params, output_paths):
+        """Add a finished job's outputs to the cache, then evict down to max_bytes"""
+        entry_dir = self._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        size = 0
+        for name in CACHED_OUTPUTS:
+            target = os.path.join(entry_dir, name)
+            shutil.copyfile(output_paths[name], target + '.tmp')
+            os.replace(target + '.tmp', target)
+            size += os.path.getsize(target)
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO entries (key, content_hash, model_name, params_json, size, created_at, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, content_hash, params.get('model', ''), json.dumps(params, sort_keys=True, default=str),
+                 size, now, now)
+            )
+        self.evict()
+
+    def evict(self, max_bytes=None):
+        """Drop least recently used entries until the cache fits into max_bytes"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        removed = 0
+        with self._connect() as db:
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= max_bytes:
+                return 0
+            for key, size in db.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall():
+                if total <= max_bytes:
+                    break
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                total -= size
+                removed += 1
+        return removed
+
+    def invalidate(self, model_name=None):
+        """Remove all entries, or only those produced by model_name"""
+        with self._connect() as db:
+            if model_name is None:
+                keys = [row[0] for row in db.execute('SELECT key FROM entries')]
+            else:
+                keys = [row[0] for row in db.execute('SELECT key FROM entries WHERE model_name = ?', (model_name,))]
+            for key in keys:
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+        return len(keys)
+
+    def stats(self):
+        with self._connect() as db:
+            count, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+            models = dict(db.execute('SELECT model_name, COUNT(*) FROM entries GROUP BY model_name').fetchall())
+        return {'entries': count, 'bytes': size, 'max_bytes': self.max_bytes, 'models': models}
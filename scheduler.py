@@ -0,0 +1,52 @@
+import os
+
+# Секунд работы на секунду аудио, пока для конфигурации нет ни одного замера
+DEFAULT_REAL_TIME_FACTOR = float(os.environ.get('DEFAULT_REAL_TIME_FACTOR', 0.5))
+# Длительность, которая предполагается для файла, если ffmpeg её не определил
+UNKNOWN_DURATION_SECONDS = float(os.environ.get('UNKNOWN_DURATION_SECONDS', 1800))
+# Старение: каждая секунда ожидания уменьшает ожидаемую стоимость задания на SCHEDULER_AGING секунд,
+# так что длинное задание пропускает вперёд короткие не дольше, чем (разница стоимостей) / SCHEDULER_AGING
+SCHEDULER_AGING = float(os.environ.get('SCHEDULER_AGING', 1.0))
+# Вес нового замера в скользящем RTF (как в record_real_time_factor)
+RTF_SMOOTHING = float(os.environ.get('RTF_SMOOTHING', 0.3))
+
+
+def expected_seconds(job, real_time_factor=None):
+    """Expected processing time of a job from its media duration and a real-time factor"""
+    duration = job.get('media_duration') or UNKNOWN_DURATION_SECONDS
+    return duration * (real_time_factor or DEFAULT_REAL_TIME_FACTOR)
+
+
+def priority(job, now, real_time_factor=None):
+    """Shortest-job-first key with aging: the job with the smallest value runs next"""
+    return expected_seconds(job, real_time_factor) - SCHEDULER_AGING * (now - job['created_at'])
+
+
+def schedule(jobs, now, real_time_factor=None):
+    """Queued jobs in the order they will be started"""
+    return sorted(jobs, key=lambda job: (priority(job, now, real_time_factor), job['created_at']))
+
+
+def estimate_wait(job_id, queued, running, workers, now, real_time_factor=None):
+    """Queue position and expected seconds until job_id finishes
+
+    queued are the waiting jobs, running the ones in progress (their own
+    estimated_time is the remaining time process_video measures). Work ahead
+    of the job is shared by the workers; the order is today's schedule, which
+    later arrivals of shorter jobs can still change.
+    """
+    order = schedule(queued, now, real_time_factor)
+    position = next((index for index, job in enumerate(order) if job['id'] == job_id), None)
+    if position is None:
+        return None, None
+    ahead = sum(job.get('estimated_time') or 0 for job in running)
+    ahead += sum(expected_seconds(job, real_time_factor) for job in order[:position])
+    wait = ahead / max(1, workers)
+    return position + 1, int(wait + expected_seconds(order[position], real_time_factor))
+
+
+def job_real_time_factor(job):
+    """Wall time of a finished job per second of its audio, or None"""
+    if job.get('processing_seconds') and job.get('audio_duration'):
+        return job['processing_seconds'] / job['audio_duration']
+    return None
@@ -0,0 +1,37 @@
+import sqlite3
+
+
+class Connection:
+    """sqlite3 connection for a with-block: committed (rolled back on an error) and closed on leaving it
+
+    sqlite3's own context manager only ends the transaction and leaves the
+    connection open until it is garbage collected.
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        return self._db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._db.in_transaction:
+                self._db.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+        finally:
+            self._db.close()
+        return False
+
+
+def connect(path, autocommit=False):
+    """Connection to the SQLite database at path in WAL mode, rows as sqlite3.Row
+
+    Use it as `with connect(path) as db:`. With autocommit=True statements run
+    outside a transaction unless the caller opens one with BEGIN (the job
+    queue does, for its IMMEDIATE transactions).
+    """
+    db = sqlite3.connect(path, timeout=30, isolation_level=None if autocommit else '')
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA busy_timeout=30000')
+    return Connection(db)
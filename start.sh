@@ -4,12 +4,39 @@
 cd "$(dirname "$0")"
 source .venv/bin/activate
 
+# Рабочие процессы распознавания (модель загружается в них, а не во Flask)
+WORKERS=${WORKERS:-1}
+WORKER_PIDS=()
+echo "Запуск рабочих процессов: $WORKERS..."
+for _ in $(seq 1 "$WORKERS"); do
+    python -m diploma_handle worker &
+    WORKER_PIDS+=($!)
+done
+
 echo "Запуск бэкенд-сервера Flask..."
 cd backend
 python app.py &
 BACKEND_PID=$!
 
-sleep 10
+# Ждём готовности бэкенда (/api/ready), а не фиксированное время
+READY_TIMEOUT=${READY_TIMEOUT:-120}
+READY=0
+for _ in $(seq 1 "$((READY_TIMEOUT * 2))"); do
+    if curl -sf -o /dev/null http://localhost:5000/api/ready; then
+        echo "Бэкенд готов."
+        READY=1
+        break
+    fi
+    if ! kill -0 $BACKEND_PID 2>/dev/null; then
+        echo "Бэкенд завершился при запуске."
+        kill "${WORKER_PIDS[@]}" 2>/dev/null
+        exit 1
+    fi
+    sleep 0.5
+done
+if [ "$READY" -ne 1 ]; then
+    echo "Бэкенд не готов за $READY_TIMEOUT сек (см. /api/ready), продолжаем запуск."
+fi
 
 # React
 echo "Запуск React-приложения..."
@@ -21,6 +48,7 @@ cleanup() {
     echo "Завершение работы серверов..."
     kill $BACKEND_PID
     kill $FRONTEND_PID
+    kill "${WORKER_PIDS[@]}" 2>/dev/null
     exit 0
 }
 
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# Модули проекта лежат в корне репозитория и в backend/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'backend')]
+
+
+@pytest.fixture(scope='session')
+def tokenizer():
+    """Byte-level Whisper tokenizer with the real special and timestamp token layout (no download)"""
+    transformers = pytest.importorskip('transformers')
+    from transformers.convert_slow_tokenizer import bytes_to_unicode
+    from transformers.models.whisper.tokenization_whisper import LANGUAGES
+    # Порядок как в словаре Whisper: id языка вычисляется от <|startoftranscript|>
+    special_tokens = (['<|endoftext|>', '<|startoftranscript|>'] + [f'<|{code}|>' for code in LANGUAGES]
+                      + ['<|translate|>', '<|transcribe|>', '<|startoflm|>', '<|startofprev|>',
+                         '<|nocaptions|>', '<|notimestamps|>'])
+    vocab = {char: index for index, char in enumerate(bytes_to_unicode().values())}
+    for token in special_tokens:
+        vocab[token] = len(vocab)
+    tokenizer = transformers.WhisperTokenizer(vocab=vocab, merges=[], additional_special_tokens=special_tokens)
+    # Метки времени идут сразу за служебными токенами
+    tokenizer.add_tokens([f'<|{i * 0.02:.2f}|>' for i in range(1501)])
+    return tokenizer
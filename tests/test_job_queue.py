@@ -0,0 +1,72 @@
+import sqlite3
+
+import pytest
+
+from job_queue import MAX_JOB_ATTEMPTS, STALE_JOB_SECONDS, SqliteJobQueue
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+    job_queue = SqliteJobQueue(str(tmp_path / 'jobs.db'))
+    job_queue.register_worker('worker-1')
+    return job_queue
+
+
+def make_stale(job_queue, job_id):
+    """Pretend the worker running job_id stopped sending heartbeats"""
+    with sqlite3.connect(job_queue.path) as db:
+        db.execute('UPDATE jobs SET heartbeat_at = heartbeat_at - ? WHERE id = ?', (STALE_JOB_SECONDS + 1, job_id))
+
+
+def test_claim_takes_the_shortest_queued_job_once(job_queue):
+    assert job_queue.claim('worker-1') is None
+    long_job = job_queue.submit('/uploads/long.mp4', 'long.mp4', media_duration=3600)
+    short_job = job_queue.submit('/uploads/short.mp4', 'short.mp4', media_duration=60)
+
+    claimed = job_queue.claim('worker-1')
+
+    assert claimed['id'] == short_job['id']
+    assert (claimed['state'], claimed['worker'], claimed['attempts']) == ('running', 'worker-1', 1)
+    assert job_queue.claim('worker-1')['id'] == long_job['id']
+    assert job_queue.claim('worker-1') is None
+
+
+def test_jobs_of_dead_workers_are_requeued_until_max_attempts(job_queue):
+    job = job_queue.submit('/uploads/a.mp4', 'a.mp4')
+    for attempt in range(1, MAX_JOB_ATTEMPTS):
+        assert job_queue.claim('worker-1')['attempts'] == attempt
+        assert job_queue.requeue_stale() == 0
+        make_stale(job_queue, job['id'])
+        assert job_queue.requeue_stale() == 1
+        assert job_queue.get(job['id'])['state'] == 'queued'
+
+    job_queue.claim('worker-1')
+    make_stale(job_queue, job['id'])
+    assert job_queue.requeue_stale() == 0
+    assert job_queue.get(job['id'])['state'] == 'failed'
+
+
+def test_release_returns_a_running_job_to_the_queue(job_queue):
+    job = job_queue.submit('/uploads/a.mp4', 'a.mp4')
+    job_queue.claim('worker-1')
+
+    job_queue.release(job['id'])
+
+    released = job_queue.get(job['id'])
+    assert (released['state'], released['worker'], released['queue_position']) == ('queued', None, 1)
+    assert job_queue.claim('worker-1')['attempts'] == 2
+
+
+def test_since_id_returns_only_newer_subtitles(job_queue):
+    job = job_queue.submit('/uploads/a.mp4', 'a.mp4')
+    chunks = [{'id': index, 'start': index * 2.0, 'end': index * 2.0 + 2.0, 'text': f'чанк {index}'} for index in range(3)]
+    job_queue.save_status(job['id'], {'progress': 40}, new_subtitles=list(enumerate(chunks[:2])))
+    job_queue.save_status(job['id'], {'progress': 50}, new_subtitles=[(2, chunks[2])])
+
+    full = job_queue.get(job['id'])
+    newer = job_queue.get(job['id'], since_id=1)
+
+    assert full['partial_subtitles'] == chunks
+    assert newer['partial_subtitles'] == chunks[2:]
+    assert newer['last_subtitle_id'] == 2 and newer['progress'] == 50
+    assert job_queue.get(job['id'], since_id=2)['partial_subtitles'] == []
@@ -0,0 +1,23 @@
+from jobs import JobStatus
+
+
+def chunks(*ids):
+    return [{'id': chunk_id, 'start': chunk_id * 2.0, 'end': chunk_id * 2.0 + 2.0, 'text': f'чанк {chunk_id}'}
+            for chunk_id in ids]
+
+
+def test_snapshot_filters_subtitles_by_chunk_id():
+    # id чанков не совпадают с их позициями в списке
+    status = JobStatus(id='job', partial_subtitles=chunks(3, 4, 5))
+
+    assert [chunk['id'] for chunk in status.snapshot()['partial_subtitles']] == [3, 4, 5]
+    assert [chunk['id'] for chunk in status.snapshot(since_id=3)['partial_subtitles']] == [4, 5]
+    assert status.snapshot(since_id=-1)['partial_subtitles'] == status['partial_subtitles']
+    assert status.snapshot(since_id=10)['partial_subtitles'] == []
+    assert status.snapshot(since_id=4)['last_subtitle_id'] == 5
+
+
+def test_snapshot_without_subtitles():
+    snapshot = JobStatus(id='job').snapshot(since_id=0)
+
+    assert snapshot['partial_subtitles'] == [] and snapshot['last_subtitle_id'] == -1
@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+from metrics import Registry, render
+
+
+def registry():
+    metrics = Registry()
+    metrics.counter('ksr_tokens_total', 'Generated tokens', labels=('stage',))
+    metrics.gauge('ksr_queue_jobs', 'Jobs in the queue')
+    metrics.histogram('ksr_generate_seconds', 'Generate time', buckets=(2.0, 0.5, 1.0))
+    return metrics
+
+
+def sample_lines(text, name):
+    return [line for line in text.splitlines() if line.startswith(name) and not line.startswith('#')]
+
+
+def test_render_prometheus_text_format():
+    metrics = registry()
+    metrics.counter('ksr_tokens_total', '', ('stage',)).inc(3, stage='generate')
+    metrics.counter('ksr_tokens_total', '', ('stage',)).inc(0.5, stage='say "hi"\n')
+    metrics.gauge('ksr_queue_jobs', '').set(7)
+
+    text = render([(metrics.snapshot(), {})])
+
+    assert text.endswith('\n')
+    lines = text.splitlines()
+    # Метрики по имени, у каждой один заголовок HELP/TYPE перед сериями
+    assert lines.index('# HELP ksr_generate_seconds Generate time') < lines.index('# HELP ksr_queue_jobs Jobs in the queue')
+    assert '# TYPE ksr_queue_jobs gauge' in lines and '# TYPE ksr_tokens_total counter' in lines
+    assert sample_lines(text, 'ksr_queue_jobs') == ['ksr_queue_jobs 7']
+    assert sample_lines(text, 'ksr_tokens_total') == [
+        'ksr_tokens_total{stage="generate"} 3',
+        'ksr_tokens_total{stage="say \\"hi\\"\\n"} 0.5',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = registry()
+    histogram = metrics.histogram('ksr_generate_seconds', '')
+    for value in (0.3, 0.5, 0.7, 5.0):
+        histogram.observe(value)
+
+    text = render([(metrics.snapshot(), {})])
+
+    assert '# TYPE ksr_generate_seconds histogram' in text.splitlines()
+    assert sample_lines(text, 'ksr_generate_seconds') == [
+        'ksr_generate_seconds_bucket{le="0.5"} 2',
+        'ksr_generate_seconds_bucket{le="1"} 3',
+        'ksr_generate_seconds_bucket{le="2"} 3',
+        'ksr_generate_seconds_bucket{le="+Inf"} 4',
+        'ksr_generate_seconds_sum 6.5',
+        'ksr_generate_seconds_count 4',
+    ]
+
+
+def test_histogram_time_observes_on_error():
+    metrics = registry()
+    histogram = metrics.histogram('ksr_generate_seconds', '')
+    with pytest.raises(RuntimeError):
+        with histogram.time():
+            raise RuntimeError
+
+    assert metrics.snapshot()['ksr_generate_seconds']['samples'][0][1]['count'] == 1
+
+
+def test_merge_adds_worker_snapshots():
+    main, worker = registry(), registry()
+    main.counter('ksr_tokens_total', '', ('stage',)).inc(2, stage='generate')
+    main.gauge('ksr_queue_jobs', '').set(1)
+    main.histogram('ksr_generate_seconds', '').observe(0.4)
+    worker.counter('ksr_tokens_total', '', ('stage',)).inc(5, stage='generate')
+    worker.counter('ksr_tokens_total', '', ('stage',)).inc(1, stage='fallback')
+    worker.gauge('ksr_queue_jobs', '').set(9)
+    worker.histogram('ksr_generate_seconds', '').observe(1.5)
+    worker.counter('ksr_unknown_total', 'Not registered in main').inc()
+
+    # Снимок приходит из другого процесса в JSON; после reset рабочий начинает с нуля
+    main.merge(json.loads(json.dumps(worker.snapshot(reset=True))))
+
+    snapshot = main.snapshot()
+    assert dict((tuple(key), value) for key, value in snapshot['ksr_tokens_total']['samples']) == {
+        ('generate',): 7, ('fallback',): 1}
+    # Gauge - текущее значение процесса, его не складывают
+    assert snapshot['ksr_queue_jobs']['samples'] == [[[], 1.0]]
+    assert snapshot['ksr_generate_seconds']['samples'] == [[[], {'counts': [1, 1, 2], 'sum': 1.9, 'count': 2}]]
+    assert 'ksr_unknown_total' not in snapshot
+    assert all(not data['samples'] for data in worker.snapshot().values())
+
+
+def test_render_labels_worker_series_under_one_header():
+    main, worker = registry(), registry()
+    main.counter('ksr_tokens_total', '', ('stage',)).inc(2, stage='generate')
+    worker.counter('ksr_tokens_total', '', ('stage',)).inc(5, stage='generate')
+    worker.histogram('ksr_generate_seconds', '').observe(0.1)
+
+    text = render([(main.snapshot(), {}), (worker.snapshot(), {'worker': 'host-1'})])
+
+    assert text.count('# TYPE ksr_tokens_total counter') == 1
+    assert sample_lines(text, 'ksr_tokens_total') == [
+        'ksr_tokens_total{stage="generate"} 2',
+        'ksr_tokens_total{stage="generate",worker="host-1"} 5',
+    ]
+    assert 'ksr_generate_seconds_bucket{le="0.5",worker="host-1"} 1' in text.splitlines()
+    assert 'ksr_generate_seconds_count{worker="host-1"} 1' in text.splitlines()
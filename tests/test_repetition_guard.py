@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+
+import pytest
+
+import diploma_handle
+from diploma_handle import RepetitionGuard, _generate_windows
+
+torch = pytest.importorskip('torch')
+
+EOS = 0
+TIMESTAMP_BEGIN = 100
+VOCAB = 120
+PROMPT = [1, 2, 3]
+
+
+def guard(windows=(10.0,), num_beams=1):
+    return RepetitionGuard(list(windows), num_beams, EOS, TIMESTAMP_BEGIN)
+
+
+def run(guard, *rows):
+    scores = torch.zeros(len(rows), VOCAB)
+    return guard(torch.tensor([PROMPT + row for row in rows]), scores)
+
+
+def test_repeating_ngram_forces_eos():
+    rep = guard()
+    # Первый вызов запоминает длину подсказки
+    run(rep, [])
+    # Триграмма 7 8 9 четыре раза подряд, метки времени между ними не мешают
+    scores = run(rep, [5] + [7, 8, 9, TIMESTAMP_BEGIN + 3] * 4)
+
+    assert scores[0, EOS] == 0.0
+    assert torch.isinf(scores[0, 1:]).all()
+    assert rep.fired == {0: 'repetition'}
+
+
+def test_text_without_loop_is_left_alone():
+    rep = guard()
+    run(rep, [])
+    tokens = [5, 6, 7, 8, 5, 6, 7, 9, 5, 6, 7, 8, 5, 6]
+    scores = run(rep, tokens)
+
+    assert (scores == 0).all() and rep.fired == {}
+
+
+def test_token_budget_and_beams_map_to_windows():
+    # Два окна по две гипотезы; у второго окна бюджет 16 + 12 * 1 = 28 токенов
+    rep = guard(windows=(10.0, 1.0), num_beams=2)
+    run(rep, [], [], [], [])
+    varied = list(range(10, 40))
+    scores = run(rep, varied, varied, varied, varied[:-1] + [EOS])
+
+    assert rep.fired == {1: 'token_budget'}
+    assert (scores[:2] == 0).all()
+    assert scores[2, EOS] == 0.0 and torch.isinf(scores[2, 1:]).all()
+    # Гипотеза, уже закончившая текст, не трогается
+    assert (scores[3] == 0).all()
+
+
+class FakeModel:
+    """Records every generate call; the first (beam) call flags the given rows as looping"""
+
+    device = 'cpu'
+    generation_config = SimpleNamespace(eos_token_id=EOS, no_timestamps_token_id=TIMESTAMP_BEGIN - 1,
+                                        pad_token_id=EOS)
+
+    def __init__(self, looping):
+        self.looping = looping
+        self.calls = []
+
+    def generate(self, input_features, logits_processor, **params):
+        rows = input_features[:, 0, 0].long().tolist()
+        self.calls.append((rows, params['num_beams']))
+        if len(self.calls) == 1:
+            for row in self.looping:
+                logits_processor[0].fired[row] = 'repetition'
+        # Номер окна и то, каким декодированием оно получено
+        return torch.tensor([[row, params['num_beams'], 1] for row in rows])
+
+
+def test_greedy_fallback_only_for_flagged_windows(monkeypatch):
+    monkeypatch.setattr(diploma_handle, 'decode_with_offsets',
+                        lambda processor, sequences: [{'text': f'{row}/{beams}', 'offsets': []}
+                                                      for row, beams, _ in sequences.tolist()])
+    model = FakeModel(looping=[1, 3])
+    features = torch.arange(4, dtype=torch.float32).view(4, 1, 1)
+    windows = [(0.0, 5.0), (5.0, 10.0), (10.0, 15.0), (15.0, 20.0)]
+    events = []
+
+    results = _generate_windows(features, windows, None, model, events)
+
+    beams = diploma_handle.DECODING_PARAMS['num_beams']
+    assert model.calls == [([0, 1, 2, 3], beams), ([1, 3], 1)]
+    assert [result['text'] for result in results] == [f'0/{beams}', '1/1', f'2/{beams}', '3/1']
+    assert events == [{'index': 1, 'reason': 'repetition', 'fallback_stopped': None},
+                      {'index': 3, 'reason': 'repetition', 'fallback_stopped': None}]
+
+
+def test_no_fallback_without_loops(monkeypatch):
+    monkeypatch.setattr(diploma_handle, 'decode_with_offsets',
+                        lambda processor, sequences: [{'text': '', 'offsets': []} for _ in sequences])
+    model = FakeModel(looping=[])
+    events = []
+
+    _generate_windows(torch.zeros(2, 1, 1), [(0.0, 5.0), (5.0, 10.0)], None, model, events)
+
+    assert len(model.calls) == 1 and events == []
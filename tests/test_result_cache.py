@@ -0,0 +1,50 @@
+import itertools
+import os
+
+import pytest
+
+import result_cache
+from result_cache import CACHED_OUTPUTS, ResultCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Strictly increasing time so the LRU order does not depend on timer resolution"""
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(result_cache.time, 'time', lambda: float(next(ticks)))
+
+
+def outputs(directory, text):
+    directory.mkdir()
+    paths = {name: str(directory / name) for name in CACHED_OUTPUTS}
+    for path in paths.values():
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+    return paths
+
+
+def test_least_recently_used_entries_are_evicted_first(tmp_path, clock):
+    # Каждая запись - 3 файла по 10 байт, в кэш помещаются две
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=60)
+    for key in ('a', 'b'):
+        cache.store(key, f'hash-{key}', {'model': 'tiny'}, outputs(tmp_path / key, key * 10))
+    assert cache.lookup('a') is not None
+
+    cache.store('c', 'hash-c', {'model': 'tiny'}, outputs(tmp_path / 'c', 'c' * 10))
+
+    assert cache.lookup('b') is None
+    assert not os.path.exists(cache._entry_dir('b'))
+    assert cache.stats()['entries'] == 2 and cache.stats()['bytes'] == 60
+    restored = outputs(tmp_path / 'restored', '')
+    assert cache.restore('a', restored)
+    with open(restored['chunked_json'], encoding='utf-8') as f:
+        assert f.read() == 'a' * 10
+
+
+def test_evict_to_a_smaller_budget(tmp_path, clock):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    for key in ('a', 'b', 'c'):
+        cache.store(key, f'hash-{key}', {'model': 'tiny'}, outputs(tmp_path / key, key * 10))
+
+    assert cache.evict(max_bytes=30) == 2
+    assert [key for key in 'abc' if cache.lookup(key)] == ['c']
@@ -0,0 +1,40 @@
+from scheduler import SCHEDULER_AGING, UNKNOWN_DURATION_SECONDS, estimate_wait, expected_seconds, schedule
+
+
+def job(job_id, media_duration, created_at):
+    return {'id': job_id, 'media_duration': media_duration, 'created_at': created_at}
+
+
+def test_shorter_jobs_run_first():
+    jobs = [job('long', 600, 0), job('unknown', None, 1), job('short', 60, 2)]
+
+    assert [item['id'] for item in schedule(jobs, now=3, real_time_factor=1.0)] == ['short', 'long', 'unknown']
+    assert expected_seconds(jobs[1], 1.0) == UNKNOWN_DURATION_SECONDS
+
+
+def test_aging_lets_a_long_job_overtake_newer_short_ones():
+    long_job, short_job = job('long', 1000, 0), job('short', 10, 0)
+    # Разница стоимостей 990 сек: короткое задание, пришедшее позже, обгоняет длинное только первые 990 / SCHEDULER_AGING сек
+    overtaken_after = 990 / SCHEDULER_AGING
+    short_job['created_at'] = overtaken_after - 1
+    assert schedule([long_job, short_job], now=overtaken_after, real_time_factor=1.0)[0] is short_job
+    short_job['created_at'] = overtaken_after + 1
+    assert schedule([long_job, short_job], now=overtaken_after + 1, real_time_factor=1.0)[0] is long_job
+
+
+def test_estimate_wait_shares_work_ahead_between_workers():
+    queued = [job('a', 100, 0), job('b', 20, 0)]
+    running = [{'id': 'r', 'estimated_time': 40}]
+
+    # Впереди b только работающее задание: 40 / 2 воркера + 20 сек своей обработки
+    assert estimate_wait('b', queued, running, workers=2, now=0, real_time_factor=1.0) == (1, 40)
+    # Впереди a ещё и b: (40 + 20) / 2 + 100
+    assert estimate_wait('a', queued, running, workers=2, now=0, real_time_factor=1.0) == (2, 130)
+    assert estimate_wait('missing', queued, running, workers=2, now=0, real_time_factor=1.0) == (None, None)
+
+
+def test_estimate_wait_follows_aging():
+    queued = [job('old', 1000, 0), job('new', 10, 2000)]
+
+    assert estimate_wait('new', queued, [], workers=1, now=2000, real_time_factor=1.0) == (2, 1010)
+    assert estimate_wait('old', queued, [], workers=1, now=2000, real_time_factor=1.0) == (1, 1000)
@@ -0,0 +1,21 @@
+from diploma_handle import SmartChunker, smart_chunking
+
+
+def test_repeated_sentences_get_their_own_times():
+    chunks = smart_chunking([{'start': 10.0, 'end': 21.0, 'text': 'Иә. Иә. Иә.'}])
+
+    assert [chunk['text'] for chunk in chunks] == ['Иә.', 'Иә.', 'Иә.']
+    assert [(chunk['start'], chunk['end']) for chunk in chunks] == [(10.0, 13.0), (14.0, 17.0), (18.0, 21.0)]
+    assert [chunk['id'] for chunk in chunks] == [0, 1, 2]
+
+
+def test_feed_closes_chunks_on_duration_and_continues_ids():
+    chunker = SmartChunker(max_duration=3.0, first_id=5)
+    closed = list(chunker.feed({'start': 0.0, 'end': 2.0, 'text': 'бір екі'}))
+    closed += list(chunker.feed({'start': 2.0, 'end': 4.0, 'text': 'үш төрт'}))
+    closed += list(chunker.finish())
+
+    assert [(chunk['id'], chunk['text'], chunk['start'], chunk['end']) for chunk in closed] == [
+        (5, 'бір екі', 0.0, 2.0), (6, 'үш төрт', 2.0, 4.0)
+    ]
+    assert list(chunker.finish()) == []
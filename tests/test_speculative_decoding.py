@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from diploma_handle import GREEDY_DECODING_PARAMS, SAMPLE_RATE, speculative_generate, window_features
+
+transformers = pytest.importorskip('transformers')
+torch = pytest.importorskip('torch')
+
+# Короче, чем в работе (448), чтобы тест шёл секунды; обрезка сегментов и seek те же
+MAX_LENGTH = 96
+
+
+@pytest.fixture(scope='module')
+def processor(tokenizer):
+    return transformers.WhisperProcessor(transformers.WhisperFeatureExtractor(), tokenizer)
+
+
+def tiny_whisper(tokenizer, seed):
+    """Randomly initialised two-layer Whisper over the test tokenizer"""
+    from transformers.models.whisper.tokenization_whisper import LANGUAGES
+    ids = tokenizer.convert_tokens_to_ids
+    special = {'decoder_start_token_id': ids('<|startoftranscript|>'), 'eos_token_id': ids('<|endoftext|>'),
+               'pad_token_id': ids('<|endoftext|>'), 'bos_token_id': ids('<|endoftext|>')}
+    torch.manual_seed(seed)
+    model = transformers.WhisperForConditionalGeneration(transformers.WhisperConfig(
+        vocab_size=len(tokenizer), d_model=32, encoder_layers=2, decoder_layers=2,
+        encoder_attention_heads=2, decoder_attention_heads=2, encoder_ffn_dim=64, decoder_ffn_dim=64,
+        max_target_positions=448, **special
+    )).eval()
+    model.generation_config = transformers.GenerationConfig(
+        is_multilingual=True, lang_to_id={f'<|{code}|>': ids(f'<|{code}|>') for code in LANGUAGES},
+        task_to_id={'transcribe': ids('<|transcribe|>'), 'translate': ids('<|translate|>')},
+        no_timestamps_token_id=ids('<|notimestamps|>'), max_initial_timestamp_index=50,
+        begin_suppress_tokens=[ids('<|endoftext|>')], suppress_tokens=[], max_length=448, **special
+    )
+    return model
+
+
+def window(seconds, seed):
+    return (np.random.default_rng(seed).uniform(-0.3, 0.3, int(seconds * SAMPLE_RATE)) * 32767).astype(np.int16)
+
+
+# У seed 0 первый проход обрывается посреди сегмента - generate обрезает его и делает seek
+@pytest.mark.parametrize('seed, seconds', [(0, 10.0), (1, 25.0), (5, 3.0)])
+def test_speculative_output_equals_greedy_generate(processor, tokenizer, seed, seconds):
+    model, draft = tiny_whisper(tokenizer, seed), tiny_whisper(tokenizer, seed + 100)
+    features = window_features([window(seconds, seed)], processor.feature_extractor)
+
+    with torch.no_grad():
+        greedy = model.generate(features, **dict(GREEDY_DECODING_PARAMS, max_length=MAX_LENGTH))
+    stats = {}
+    speculative = speculative_generate(features, processor, model, draft, max_length=MAX_LENGTH, stats=stats)
+
+    assert speculative.tolist() == greedy.tolist()
+    assert stats['windows'] == 1 and stats['generated_tokens'] == greedy.shape[1]
+    assert stats['accepted_tokens'] <= stats['draft_tokens']
+
+
+def test_draft_equal_to_model_is_always_accepted(processor, tokenizer):
+    model = tiny_whisper(tokenizer, 2)
+    features = window_features([window(10.0, 2)], processor.feature_extractor)
+
+    with torch.no_grad():
+        greedy = model.generate(features, **dict(GREEDY_DECODING_PARAMS, max_length=MAX_LENGTH))
+    stats = {}
+    speculative = speculative_generate(features, processor, model, model, max_length=MAX_LENGTH, draft_tokens=4,
+                                       stats=stats)
+
+    assert speculative.tolist() == greedy.tolist()
+    assert stats['accepted_tokens'] == stats['draft_tokens']
+    # Каждый проход основной модели подтверждает несколько черновых токенов
+    assert stats['accepted_tokens'] >= 3 * stats['target_passes']
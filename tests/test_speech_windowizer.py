@@ -0,0 +1,51 @@
+import numpy as np
+
+from diploma_handle import SAMPLE_RATE, SpeechWindowizer
+
+
+def speech(seconds, seed=0):
+    """Loud noise that the energy VAD treats as speech"""
+    return (np.random.default_rng(seed).uniform(-0.3, 0.3, int(seconds * SAMPLE_RATE)) * 32767).astype(np.int16)
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * SAMPLE_RATE), dtype=np.int16)
+
+
+def feed_blocks(windowizer, pcm, block_seconds=1.0):
+    block = int(block_seconds * SAMPLE_RATE)
+    windows = []
+    for start in range(0, len(pcm), block):
+        windows += list(windowizer.feed(pcm[start:start + block]))
+    return windows
+
+
+def test_finish_flushes_speech_at_the_end_of_the_stream():
+    # 3.05 сек: хвост не кратен ни блоку, ни кадру VAD
+    pcm = np.concatenate([silence(2.0), speech(1.05)])
+    windowizer = SpeechWindowizer()
+
+    assert feed_blocks(windowizer, pcm) == []
+    windows = list(windowizer.finish())
+
+    assert len(windows) == 1
+    start, end, window = windows[0]
+    assert 1.7 <= start < 2.0
+    assert end == len(pcm) / SAMPLE_RATE
+    assert len(window) == round((end - start) * SAMPLE_RATE)
+    assert np.array_equal(window, pcm[round(start * SAMPLE_RATE):])
+
+
+def test_windows_without_pauses_never_exceed_max_seconds():
+    pcm = speech(70.0, seed=1)
+    windowizer = SpeechWindowizer(max_seconds=30.0)
+
+    windows = feed_blocks(windowizer, pcm) + list(windowizer.finish())
+
+    assert len(windows) == 3
+    assert all(end - start <= 30.0 for start, end, _ in windows)
+    # Окна идут встык: при отсутствии пауз ничего не пропускается
+    assert windows[0][0] == 0.0 and windows[-1][1] == 70.0
+    assert all(previous[1] == following[0] for previous, following in zip(windows, windows[1:]))
+    assert np.array_equal(np.concatenate([window for _, _, window in windows]), pcm)
+    assert windowizer.skipped_samples == 0
@@ -0,0 +1,35 @@
+from diploma_handle import TranscriptionJournal
+
+SEGMENTS = [{'start': 0.5, 'end': 2.0, 'text': 'Сәлем'}]
+
+
+def test_restarted_job_resumes_windows_and_drops_a_torn_line(tmp_path):
+    path = str(tmp_path / 'video.journal.jsonl')
+    journal = TranscriptionJournal(path, 'fingerprint')
+    journal.record(0.0, 29.97, SEGMENTS)
+    journal.record(29.97, 58.5, [])
+    journal.close()
+    # Процесс упал посреди записи следующего окна
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"start": 58.5, "end": 80.0, "segm')
+
+    resumed = TranscriptionJournal(path, 'fingerprint')
+
+    assert resumed.lookup(0.0, 29.97) == SEGMENTS
+    assert resumed.lookup(29.9700001, 58.5) == []
+    assert resumed.lookup(58.5, 80.0) is None
+    resumed.record(58.5, 80.0, SEGMENTS)
+    resumed.close()
+    assert TranscriptionJournal(path, 'fingerprint').lookup(58.5, 80.0) == SEGMENTS
+
+
+def test_journal_of_other_media_or_params_is_discarded(tmp_path):
+    path = tmp_path / 'video.journal.jsonl'
+    journal = TranscriptionJournal(str(path), 'old')
+    journal.record(0.0, 30.0, SEGMENTS)
+    journal.close()
+
+    resumed = TranscriptionJournal(str(path), 'new')
+
+    assert resumed.lookup(0.0, 30.0) is None
+    assert not path.exists()
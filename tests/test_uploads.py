@@ -0,0 +1,102 @@
+import io
+import os
+import json
+import hashlib
+
+import pytest
+
+import uploads
+from uploads import UploadError, UploadStore
+
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # Маленький блок, чтобы чтение шло в несколько проходов
+    monkeypatch.setattr(uploads, 'UPLOAD_BLOCK_SIZE', 1000)
+    return UploadStore(str(tmp_path))
+
+
+def part_size(store, upload_id):
+    with open(os.path.join(store.sessions_dir, f'{upload_id}.json'), encoding='utf-8') as f:
+        return os.path.getsize(json.load(f)['part'])
+
+
+def test_offset_mismatch_is_refused_with_current_offset(store):
+    upload_id = store.create('video.mp4', len(DATA))['upload_id']
+    store.append(upload_id, 0, io.BytesIO(DATA[:100]))
+
+    with pytest.raises(UploadError) as error:
+        store.append(upload_id, 50, io.BytesIO(DATA[50:150]))
+
+    assert error.value.status == 409 and error.value.offset == 100
+    assert part_size(store, upload_id) == 100
+
+
+@pytest.mark.parametrize('declared', [True, False])
+def test_oversize_chunk_is_refused_whole(store, declared):
+    upload_id = store.create('video.mp4', len(DATA))['upload_id']
+    store.append(upload_id, 0, io.BytesIO(DATA[:4000]))
+    extra = DATA[4000:] + 'лишнее'.encode()
+
+    # Без длины запроса лишние данные замечаются только при чтении
+    with pytest.raises(UploadError) as error:
+        store.append(upload_id, 4000, io.BytesIO(extra), len(extra) if declared else None)
+
+    assert error.value.status == 413 and error.value.offset == 4000
+    assert part_size(store, upload_id) == 4000
+    # После отказа загрузку можно продолжить правильной частью
+    assert store.append(upload_id, 4000, io.BytesIO(DATA[4000:]))['complete']
+
+
+def test_resume_after_partial_append(store, tmp_path):
+    upload_id = store.create('video.mp4', len(DATA))['upload_id']
+    state = store.append(upload_id, 0, io.BytesIO(DATA[:3333]))
+    assert state['offset'] == 3333 and not state['complete']
+
+    # Перезапуск сервера: новое хранилище пересчитывает хэш по данным на диске
+    restarted = UploadStore(str(tmp_path))
+    assert restarted.status(upload_id)['offset'] == 3333
+    with pytest.raises(UploadError) as error:
+        restarted.complete(upload_id)
+    assert error.value.status == 409 and error.value.offset == 3333
+
+    restarted.append(upload_id, 3333, io.BytesIO(DATA[3333:]))
+    filepath, filename, content_hash = restarted.complete(upload_id, hashlib.sha256(DATA).hexdigest())
+
+    assert filename == 'video.mp4' and filepath == str(tmp_path / 'video.mp4')
+    assert content_hash == hashlib.sha256(DATA).hexdigest()
+    with open(filepath, 'rb') as f:
+        assert f.read() == DATA
+    assert restarted.status(upload_id) is None
+
+
+def test_hash_mismatch_on_complete_discards_upload(store, tmp_path):
+    upload_id = store.create('video.mp4', len(DATA))['upload_id']
+    corrupted = bytearray(DATA)
+    corrupted[1234] ^= 0xFF
+    store.append(upload_id, 0, io.BytesIO(bytes(corrupted)))
+
+    with pytest.raises(UploadError) as error:
+        store.complete(upload_id, hashlib.sha256(DATA).hexdigest())
+
+    assert error.value.status == 422
+    assert store.status(upload_id) is None
+    assert not (tmp_path / 'video.mp4').exists()
+    assert os.listdir(tmp_path) == ['.sessions'] and os.listdir(store.sessions_dir) == []
+
+
+def test_expire_removes_stale_partials(store, monkeypatch):
+    stale = store.create('old.mp4', len(DATA))['upload_id']
+    store.append(stale, 0, io.BytesIO(DATA[:10]))
+    # Срок жизни первой сессии истёк
+    now = uploads.time.time()
+    monkeypatch.setattr(uploads.time, 'time', lambda: now + uploads.UPLOAD_SESSION_TTL + 1)
+    fresh = store.create('new.mp4', len(DATA))['upload_id']
+
+    assert store.status(stale) is None
+    assert store.status(fresh)['offset'] == 0
+    assert sorted(os.listdir(store.upload_dir)) == ['.sessions', f'new.mp4.{fresh}.part']
+    assert store.expire() == 0
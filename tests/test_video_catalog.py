@@ -0,0 +1,88 @@
+import pytest
+
+from video_catalog import VideoCatalog, normalize_text, search_expression
+
+
+def test_prune_removes_entry_and_search_segments_of_deleted_output(tmp_path):
+    output = tmp_path / 'output'
+    (output / 'kept').mkdir(parents=True)
+    catalog = VideoCatalog(str(tmp_path / 'catalog.sqlite3'))
+    for name in ('kept', 'deleted'):
+        catalog.record(name, f'/api/files/{name}/{name}.mp4', f'/api/files/{name}/{name}.srt')
+        catalog.index_transcript(name, [{'start': 0.0, 'end': 1.0, 'text': 'Сәлем әлем'}])
+
+    assert catalog.prune(str(output)) == 1
+
+    assert catalog.get('deleted') is None
+    assert not catalog.is_indexed('deleted')
+    results, total, ranked = catalog.search('сәлем')
+    assert total == 1 and [result['name'] for result in results] == ['kept']
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('Ёлка', 'елка'),
+    # е + комбинируемое двоеточие (другая раскладка) - та же буква после NFC
+    ('Е\u0308лка', 'елка'),
+    ('и\u0306', 'й'),
+    # Латинские c, o, i внутри казахских слов
+    ('cәлем', 'сәлем'),
+    ('кoрiнiс', 'корініс'),
+    # Слова без кириллицы не меняются, казахские буквы остаются отдельными
+    ('Hello ӘЛЕМ', 'hello әлем'),
+    ('қоңыр ұлы', 'қоңыр ұлы'),
+])
+def test_normalize_text(text, expected):
+    assert normalize_text(text) == expected
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('сәлем', '"сәлем"*'),
+    ('Сәлем Әлем', '"сәлем" "әлем"*'),
+    ('  "Сәлем  әлем"  ', '"сәлем әлем"'),
+    # Спецсимволы FTS5 из пользовательского ввода не становятся операторами
+    ('x"y', '"x" "y"*'),
+    ('әлем*', '"әлем"*'),
+    ('-сәлем', '"сәлем"*'),
+    ('сәлем NEAR әлем', '"сәлем" "near" "әлем"*'),
+    ('NEAR(сәлем әлем, 2)', '"near" "сәлем" "әлем" "2"*'),
+    ('AND OR NOT', '"and" "or" "not"*'),
+    ('"', None),
+    (' - * ', None),
+])
+def test_search_expression(query, expected):
+    assert search_expression(query) == expected
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = VideoCatalog(str(tmp_path / 'catalog.sqlite3'))
+    catalog.record('lesson', '/api/files/lesson/lesson.mp4', '/api/files/lesson/lesson.srt')
+    catalog.index_transcript('lesson', [
+        {'start': 0.0, 'end': 2.0, 'text': 'Сәлем, әлем!'},
+        {'start': 2.0, 'end': 4.0, 'text': 'Ёлка в лесу'},
+        {'start': 4.0, 'end': 6.0, 'text': 'әлем сәлем near'},
+    ])
+    return catalog
+
+
+def texts(catalog, query):
+    hits, total, ranked = catalog.search(query)
+    assert total == len(hits) and ranked
+    return sorted(hit['text'] for hit in hits)
+
+
+def test_search_normalizes_query_and_matches_prefix(catalog):
+    assert texts(catalog, 'елка') == ['Ёлка в лесу']
+    assert texts(catalog, 'cәл') == ['Сәлем, әлем!', 'әлем сәлем near']
+    assert texts(catalog, 'лес') == ['Ёлка в лесу']
+    # Префиксом считается только последнее слово
+    assert texts(catalog, 'лес ёлка') == []
+
+
+def test_search_phrase_and_special_characters(catalog):
+    assert texts(catalog, '"сәлем әлем"') == ['Сәлем, әлем!']
+    assert texts(catalog, 'сәлем NEAR әлем') == ['әлем сәлем near']
+    assert texts(catalog, 'NEAR(сәлем әлем)') == ['әлем сәлем near']
+    assert texts(catalog, '-сәлем') == ['Сәлем, әлем!', 'әлем сәлем near']
+    assert texts(catalog, 'сәлем" OR "ёлка') == []
+    assert catalog.search('"*') == ([], 0, True)
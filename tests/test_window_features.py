@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from diploma_handle import window_features
+
+transformers = pytest.importorskip('transformers')
+
+
+@pytest.fixture(scope='module')
+def feature_extractor():
+    return transformers.WhisperFeatureExtractor()
+
+
+def speech(seconds, seed):
+    """Tones with an envelope and noise, as int16 PCM (loud enough that the max-8 floor matters)"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * 16000)) / 16000
+    signal = 0.3 * np.sin(2 * np.pi * 180 * t) * np.abs(np.sin(2 * np.pi * 1.5 * t)) + rng.normal(0, 0.01, len(t))
+    return (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+
+
+@pytest.mark.parametrize('seconds', [0.37, 4.2, 15.0, 30.0])
+def test_matches_whisper_feature_extractor(feature_extractor, seconds):
+    pcm = speech(seconds, seed=int(seconds * 100))
+    expected = feature_extractor(pcm.astype(np.float32) / 32768.0, sampling_rate=16000,
+                                 return_tensors='np').input_features[0]
+    features = window_features([pcm], feature_extractor)[0].numpy()
+    assert features.shape == expected.shape
+    np.testing.assert_allclose(features, expected, atol=1e-4)
+
+
+def test_each_window_of_a_batch_is_independent(feature_extractor):
+    # Короткое тихое окно рядом с громким: нормализация и края STFT - только по своему окну
+    loud = speech(15.0, seed=1)
+    quiet = (speech(0.37, seed=2) // 50).astype(np.int16)
+    batch = window_features([loud, quiet], feature_extractor).numpy()
+    for row, pcm in zip(batch, (loud, quiet)):
+        expected = feature_extractor(pcm.astype(np.float32) / 32768.0, sampling_rate=16000,
+                                     return_tensors='np').input_features[0]
+        np.testing.assert_allclose(row, expected, atol=1e-4)
@@ -0,0 +1,50 @@
+import pytest
+
+from diploma_handle import decode_with_offsets, _append_window_chunks
+
+
+def generated(tokenizer, *parts):
+    """Token ids as generate returns them: prompt, then text and <|t|> timestamps, then end-of-text"""
+    ids = tokenizer.convert_tokens_to_ids(['<|startoftranscript|>', '<|kk|>', '<|transcribe|>'])
+    for part in parts:
+        if isinstance(part, float):
+            ids.append(tokenizer.convert_tokens_to_ids(f'<|{part:.2f}|>'))
+        else:
+            ids.extend(tokenizer.encode(part, add_special_tokens=False))
+    return ids + [tokenizer.eos_token_id]
+
+
+def test_offsets_map_to_absolute_time(tokenizer):
+    sequences = [generated(tokenizer, 0.0, ' Сәлем әлем.', 2.4, 2.4, ' Екінші сөйлем.', 5.0),
+                 generated(tokenizer, 1.0, ' Үшінші.', 3.0)]
+    # generate возвращает одну матрицу, короткие строки дополнены концом текста
+    torch = pytest.importorskip('torch')
+    width = max(len(sequence) for sequence in sequences)
+    batch = torch.tensor([sequence + [tokenizer.eos_token_id] * (width - len(sequence)) for sequence in sequences])
+    results = decode_with_offsets(tokenizer, batch)
+    segments = []
+    _append_window_chunks(results[0], 30.0, 45.0, 600.0, segments)
+    _append_window_chunks(results[1], 45.0, 60.0, 600.0, segments)
+    assert [(s['start'], s['end'], s['text']) for s in segments] == [
+        (30.0, 32.4, 'Сәлем әлем.'),
+        (32.4, 35.0, 'Екінші сөйлем.'),
+        (46.0, 48.0, 'Үшінші.'),
+    ]
+    assert [s['id'] for s in segments] == [0, 1, 2]
+
+
+def test_text_after_last_timestamp_runs_to_window_end(tokenizer):
+    result = decode_with_offsets(tokenizer, [generated(tokenizer, 0.0, ' Бірінші.', 4.0, 4.0, ' үзілген сөйл')])[0]
+    segments = []
+    _append_window_chunks(result, 0.0, 15.0, 12.5, segments)
+    assert [(s['start'], s['end'], s['text']) for s in segments] == [
+        (0.0, 4.0, 'Бірінші.'),
+        (4.0, 12.5, 'үзілген сөйл'),
+    ]
+
+
+def test_window_without_timestamps_is_one_segment(tokenizer):
+    result = decode_with_offsets(tokenizer, [generated(tokenizer, ' Мәтін ғана')])[0]
+    segments = []
+    _append_window_chunks(result, 15.0, 30.0, None, segments)
+    assert [(s['start'], s['end'], s['text']) for s in segments] == [(15.0, 30.0, 'Мәтін ғана')]
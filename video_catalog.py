@@ -0,0 +1,283 @@
+import os
+import re
+import json
+import time
+import unicodedata
+
+from sqlite_db import connect
+
+DEFAULT_CATALOG_PATH = os.environ.get(
+    'VIDEO_CATALOG_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend', 'output', 'catalog.sqlite3')
+)
+
+# Поля, по которым можно сортировать /api/videos (имя параметра -> колонка)
+SORT_FIELDS = {
+    'name': 'name',
+    'created_at': 'created_at',
+    'duration': 'duration',
+    'segments': 'segment_count',
+    'subtitles': 'subtitle_count',
+    'processing_time': 'processing_seconds'
+}
+
+# Сколько совпадений ещё ранжируется по bm25 (см. VideoCatalog.search)
+SEARCH_RANK_LIMIT = int(os.environ.get('SEARCH_RANK_LIMIT', 20000))
+# Растёт, когда rebuild() должен заново пройти по папкам результатов (2 - поисковый индекс)
+CATALOG_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    name TEXT PRIMARY KEY,
+    video TEXT NOT NULL,
+    subtitles TEXT NOT NULL,
+    duration REAL,
+    segment_count INTEGER,
+    subtitle_count INTEGER,
+    processing_seconds REAL,
+    real_time_factor REAL,
+    content_hash TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS videos_created ON videos (created_at);
+CREATE INDEX IF NOT EXISTS videos_duration ON videos (duration);
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    text TEXT NOT NULL,
+    norm TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_name ON segments (name);
+CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts USING fts5(
+    norm, content='segments', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 0', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS segments_ai AFTER INSERT ON segments BEGIN
+    INSERT INTO segments_fts (rowid, norm) VALUES (new.id, new.norm);
+END;
+CREATE TRIGGER IF NOT EXISTS segments_ad AFTER DELETE ON segments BEGIN
+    INSERT INTO segments_fts (segments_fts, rowid, norm) VALUES ('delete', old.id, old.norm);
+END;
+"""
+
+# Латинские буквы, которые распознавание иногда ставит вместо похожих кириллических
+# (в казахском тексте прежде всего і); применяются только внутри кириллических слов
+_LOOKALIKES = str.maketrans({'i': 'і', 'a': 'а', 'e': 'е', 'o': 'о', 'p': 'р', 'c': 'с', 'x': 'х', 'y': 'у'})
+_CYRILLIC = re.compile(r'[\u0400-\u04ff]')
+_WORD = re.compile(r'\w+')
+
+
+def normalize_text(text):
+    """Form of a transcript or query text that goes into the search index
+
+    Unicode NFC (combining marks from other keyboards are folded into single
+    letters), lower case, ё -> е, and Latin look-alikes inside Cyrillic words
+    replaced. Kazakh letters (ә, ғ, қ, ң, ө, ұ, ү, һ, і) and й stay distinct:
+    the index tokenizer runs with remove_diacritics 0.
+    """
+    text = unicodedata.normalize('NFC', text).lower().replace('ё', 'е')
+    return _WORD.sub(lambda m: m.group(0).translate(_LOOKALIKES) if _CYRILLIC.search(m.group(0)) else m.group(0), text)
+
+
+def search_expression(query):
+    """FTS5 MATCH expression for a user query, or None if it has no words
+
+    Words must all occur in a segment; the last word also matches as a prefix.
+    A query in double quotes must occur as a phrase.
+    """
+    words = _WORD.findall(normalize_text(query))
+    if not words:
+        return None
+    stripped = query.strip()
+    if len(stripped) > 1 and stripped.startswith('"') and stripped.endswith('"'):
+        return '"' + ' '.join(words) + '"'
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+_FIELDS = ('name', 'video', 'subtitles', 'duration', 'segment_count', 'subtitle_count',
+           'processing_seconds', 'real_time_factor', 'content_hash', 'created_at')
+
+
+class VideoCatalog:
+    """Index of processed videos, written when a job finishes and read by /api/videos
+
+    Listing, sorting and per-video stats come from here, so the API never has
+    to walk the output folder. The transcript segments of every video are kept
+    in an FTS5 index for /api/search. rebuild() fills the catalog from the folders
+    already on disk once, for outputs produced before it existed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_CATALOG_PATH
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+
+    def _connect(self):
+        return connect(self.path)
+
+    def record(self, name, video, subtitles, duration=None, segment_count=None, subtitle_count=None,
+               processing_seconds=None, real_time_factor=None, content_hash=None, created_at=None):
+        """Add or replace the entry of a processed video"""
+        values = (name, video, subtitles, duration, segment_count, subtitle_count,
+                  processing_seconds, real_time_factor, content_hash,
+                  created_at if created_at is not None else time.time())
+        with self._connect() as db:
+            db.execute(
+                f'INSERT OR REPLACE INTO videos ({", ".join(_FIELDS)}) VALUES ({", ".join("?" * len(_FIELDS))})',
+                values
+            )
+
+    def remove(self, name):
+        """Drop a video and its searchable segments; returns True if it was in the catalog"""
+        with self._connect() as db:
+            db.execute('DELETE FROM segments WHERE name = ?', (name,))
+            return db.execute('DELETE FROM videos WHERE name = ?', (name,)).rowcount > 0
+
+    def get(self, name):
+        with self._connect() as db:
+            row = db.execute('SELECT * FROM videos WHERE name = ?', (name,)).fetchone()
+        return dict(row) if row else None
+
+    def list(self, limit=50, offset=0, sort='created_at', descending=True):
+        """One page of entries and the total number of entries"""
+        column = SORT_FIELDS[sort]
+        direction = 'DESC' if descending else 'ASC'
+        with self._connect() as db:
+            total = db.execute('SELECT COUNT(*) FROM videos').fetchone()[0]
+            rows = db.execute(
+                f'SELECT * FROM videos ORDER BY {column} IS NULL, {column} {direction}, name LIMIT ? OFFSET ?',
+                (limit, offset)
+            ).fetchall()
+        return [dict(row) for row in rows], total
+
+    def index_transcript(self, name, segments):
+        """Replace the searchable segments of a video with segments [{start, end, text}]"""
+        rows = [(name, segment['start'], segment['end'], segment['text'], normalize_text(segment['text']))
+                for segment in segments if segment.get('text')]
+        with self._connect() as db:
+            db.execute('DELETE FROM segments WHERE name = ?', (name,))
+            db.executemany('INSERT INTO segments (name, start, end, text, norm) VALUES (?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def is_indexed(self, name):
+        with self._connect() as db:
+            return db.execute('SELECT 1 FROM segments WHERE name = ? LIMIT 1', (name,)).fetchone() is not None
+
+    def search(self, query, limit=20, offset=0, name=None):
+        """Segments matching query and the number of matches
+
+        Returns (hits, total, ranked). Up to SEARCH_RANK_LIMIT matches are
+        ordered by bm25; bm25 has to score every match, so for a more common
+        query the newest segments come first instead, ranked is False and
+        total is only a lower bound.
+        """
+        expression = search_expression(query)
+        if expression is None:
+            return [], 0, True
+        where = 'segments_fts MATCH ?'
+        params = (expression,)
+        with self._connect() as db:
+            if name:
+                # index_transcript вставляет сегменты видео одной транзакцией, их id идут подряд:
+                # диапазон rowid FTS5 проверяет сам, не перебирая все совпадения
+                first, last = db.execute('SELECT MIN(id), MAX(id) FROM segments WHERE name = ?', (name,)).fetchone()
+                if first is None:
+                    return [], 0, True
+                where += ' AND rowid BETWEEN ? AND ?'
+                params += (first, last)
+            total = db.execute(
+                f'SELECT COUNT(*) FROM (SELECT 1 FROM segments_fts WHERE {where} LIMIT ?)',
+                params + (SEARCH_RANK_LIMIT + 1,)
+            ).fetchone()[0]
+            ranked = total <= SEARCH_RANK_LIMIT
+            order = 'rank' if ranked else 'rowid DESC'
+            # Сначала страница совпадений из FTS5, затем сегменты к ней
+            rows = db.execute(
+                f'SELECT s.name, s.start, s.end, s.text, f.rank AS score FROM '
+                f'(SELECT rowid, rank FROM segments_fts WHERE {where} ORDER BY {order} LIMIT ? OFFSET ?) f '
+                f'JOIN segments s ON s.id = f.rowid ORDER BY f.{order}',
+                params + (limit, offset)
+            ).fetchall()
+        hits = []
+        for row in rows:
+            hit = dict(row)
+            hit['score'] = round(-hit['score'], 4)
+            hit['video'] = f"/api/files/{hit['name']}/{hit['name']}.mp4"
+            hit['subtitles'] = f"/api/files/{hit['name']}/{hit['name']}_chunked.json"
+            hits.append(hit)
+        return hits, total, ranked
+
+    def needs_rebuild(self):
+        """True until rebuild() has run with the current CATALOG_VERSION"""
+        with self._connect() as db:
+            return db.execute('PRAGMA user_version').fetchone()[0] < CATALOG_VERSION
+
+    def prune(self, output_folder):
+        """Remove the entries whose output folder was deleted; returns how many were removed"""
+        with self._connect() as db:
+            names = [row[0] for row in db.execute('SELECT name FROM videos')]
+            names += [row[0] for row in db.execute('SELECT DISTINCT name FROM segments')]
+        removed = 0
+        for name in sorted(set(names)):
+            if not os.path.isdir(os.path.join(output_folder, name)):
+                removed += self.remove(name)
+        return removed
+
+    def rebuild(self, output_folder):
+        """Index finished output folders missing from the catalog or from the search index
+
+        Returns how many folders were added or reindexed.
+        """
+        added = 0
+        for folder in sorted(os.listdir(output_folder)):
+            folder_path = os.path.join(output_folder, folder)
+            if folder.startswith('.') or not os.path.isdir(folder_path):
+                continue
+            if self.get(folder) is None:
+                entry = entry_from_files(folder_path, folder)
+                if entry is None:
+                    continue
+                self.record(**entry)
+            elif self.is_indexed(folder):
+                continue
+            transcription = os.path.join(folder_path, f'{folder}_transcription.json')
+            try:
+                with open(transcription, encoding='utf-8') as f:
+                    self.index_transcript(folder, json.load(f))
+            except (OSError, ValueError):
+                pass
+            added += 1
+        with self._connect() as db:
+            db.execute(f'PRAGMA user_version = {CATALOG_VERSION}')
+        return added
+
+
+def entry_from_files(folder_path, name):
+    """Catalog entry read back from a finished output folder, or None if it is incomplete"""
+    video = os.path.join(folder_path, f'{name}.mp4')
+    chunked = os.path.join(folder_path, f'{name}_chunked.json')
+    transcription = os.path.join(folder_path, f'{name}_transcription.json')
+    if not (os.path.exists(video) and os.path.exists(chunked)):
+        return None
+    try:
+        with open(chunked, encoding='utf-8') as f:
+            subtitles = json.load(f)
+        segments = None
+        if os.path.exists(transcription):
+            with open(transcription, encoding='utf-8') as f:
+                segments = json.load(f)
+    except (OSError, ValueError):
+        return None
+    last = (segments or subtitles or [{}])[-1]
+    return {
+        'name': name,
+        'video': f'/api/files/{name}/{name}.mp4',
+        'subtitles': f'/api/files/{name}/{name}_chunked.json',
+        'duration': last.get('end'),
+        'segment_count': len(segments) if segments is not None else None,
+        'subtitle_count': len(subtitles),
+        'created_at': os.path.getmtime(chunked)
+    }